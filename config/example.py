@@ -19,8 +19,15 @@ SERVER_CONFIG = {
     # Log Section
     "LOG_DIR": "/log/",
     "LOG_FILE_NAME": "deploy_server",
+    # SSH Section
+    "SSH_MULTIPLEXING": True,  # reuse one ssh master connection per host
+    "SSH_COMMAND": "ssh",  # ssh executable
+    "SSH_CONTROL_DIR": "/tmp/niner_ssh",  # directory of ssh control sockets
+    "SSH_IDLE_TIMEOUT": 300,  # seconds before closing an idle ssh master connection
     # Biz Section
-    "TAG_LIST_SIZE": 10  # size of tag list in admin interface
+    "TAG_LIST_SIZE": 10,  # size of tag list in admin interface
+    # Scheduler Section
+    "MAX_CONCURRENT_DEPLOYS": 2  # max deployments of all repositories running at the same time, 0 means no limit
 }
 
 # Configuration of Redis
@@ -50,6 +57,12 @@ REPOSITORY = [
         "DEPLOY_PATH": "/home/deploy/_online/", # path where deploy to, needed in production mode
         "PACKAGE_PATH": "/home/deploy/_package/", # path where packages save to, need in production mode
         "BACKUP_PATH": "/home/deploy/_backup/", # path where backup tar file save to, need in production mode
+        # tar: backup deploy directory as a tar.gz file
+        # snapshot: backup as a directory hard linked to the latest snapshot, only changed files take time and
+        # disk, rollback releases it without decompressing
+        "BACKUP_MODE": "tar",
+        "KEEP_BACKUPS": 10,  # snapshots kept in snapshot mode, at least 2
+        "STAGING_PATH": "/tmp/niner_staging/", # path where packages are decompressed to before release, need in production mode
         "STRATEGY": DeployStrategy.PRO_MODE, # mode switcher
         "BRANCH": "master", # branch filter
         # services should restart when files have changed, key is first child directory of repo root('*' matches anything else like finally), value is service name in supervisor, 'None' means no service need restart, also support list if multi services need restart.
@@ -69,6 +82,18 @@ REPOSITORY = [
             "telesales:telesales_3335": 3,
             "mf2:mf2_3333": 2,
         },
+        # port of supervisor XML-RPC interface(inet_http_server) on hosts
+        "SUPERVISOR_PORT": 9001,
+        # readiness check after restart: service should be RUNNING in supervisor for MIN_UPTIME seconds
+        # within TIMEOUT seconds
+        "READINESS": {
+            "TIMEOUT": 60,
+            "MIN_UPTIME": 3,
+        },
+        # readiness config per service overriding READINESS, HEALTH_URL is optional and '{host}' is replaced
+        "SERVICES_READINESS": {
+            "api:api_2919": {"HEALTH_URL": "http://{host}:2919/health", "TIMEOUT": 120},
+        },
         # map from hostname to roles of host
         "HOSTS": {
             "zqhua01": ["web", "data"],
@@ -93,7 +118,64 @@ REPOSITORY = [
         # Exclude filename which contains file pattern should not rsync
         "EXCLUDE_FILENAME": None,
         # Pip script path live in virtualenv
-        "PIP_SCRIPT": ""
+        "PIP_SCRIPT": "",
+        # Max number of hosts released at the same time, 1 means one host after another
+        "MAX_PARALLEL_HOSTS": 1,
+        # Host released alone before others, hostname or True to use the first host, None means no canary
+        "CANARY_HOST": None,
+        # Max percent of hosts of one role released in the same wave, roles not listed are not limited
+        "WAVE_ROLE_PERCENT": {
+            "web": 25,
+        },
+        # Only deploy the highest one if several release tags are waiting, lower ones are skipped(production mode)
+        "SKIP_SUPERSEDED_TAGS": False,
+        # Quiet period in seconds, waiting tasks start only when no push arrived for so long, 0 means no wait
+        "DEBOUNCE_SECONDS": 0,
+        # Roll back at once if deploy fails, False to keep hosts released and resume from the failed host later
+        # by operation 'resume'(production mode)
+        "AUTO_ROLLBACK": True,
+        # Max seconds of every step type, a command running longer is killed with its children, not listed means
+        # no limit. restart limits restarting all services of a host including readiness waiting
+        "STEP_TIMEOUTS": {
+            "fetch": 300,
+            "tar": 600,
+            "rsync": 1800,
+            "install": 1800,
+            "restart": 600,
+            "post_action": 600,
+        },
+        # full: rsync the whole tree to every host
+        # delta: rsync only files changed since the commit recorded in .niner_revision of host, whole tree if
+        # the host is at another commit or first deployed, or POST_ACTIONS are configured since their outputs
+        # are not in diff. Needs rsync 3.1+ on both sides
+        # batch: rsync to MIRROR_PATH once writing a batch file, then replay it to hosts at the same commit as
+        # mirror, whole tree to other hosts
+        "SYNC_MODE": "full",
+        "MIRROR_PATH": "/home/deploy/_mirror/",  # path of local mirror of deployed tree, need in batch sync mode
+        # inplace: rsync into DEPLOY_PATH/<repo> directly
+        # symlink: DEPLOY_PATH/<repo> is a symlink to DEPLOY_PATH/releases/<repo>/<tag>/<repo>. A new release is
+        # hard linked from current one, synced and then activated by switching the symlink atomically, rollback
+        # switches it back. SYNC_MODE is not used
+        "RELEASE_LAYOUT": "inplace",
+        "KEEP_RELEASES": 5,  # releases kept at every host in symlink layout, at least 2
+        # direct: deploy server sends package to every host
+        # tree: deploy server sends package to FANOUT hosts, which forward it to FANOUT hosts each, and so on.
+        # Package is checked by sha256 at every host, hosts must be able to rsync to each other as user deploy
+        "DISTRIBUTION": {
+            "MODE": "direct",
+            "FANOUT": 2,
+            "REMOTE_PATH": "/tmp/niner_packages/",  # directory of packages at hosts
+        },
+        # Priority class in global scheduler, the lower is admitted earlier. Default 0 for production mode and 1
+        # for test mode
+        "DEPLOY_PRIORITY": 0,
+        # Retries allowed for one deployment in total, transient errors of git, ssh, rsync and supervisor are
+        # retried with exponential backoff until MAX_RETRIES or MAX_SECONDS of waiting is spent, not set means
+        # no limit
+        "RETRY_BUDGET": {
+            "MAX_RETRIES": 10,
+            "MAX_SECONDS": 120,
+        },
     }
 ]
 
@@ -0,0 +1,74 @@
+__author__ = 'magus0219'
+import threading
+
+
+class DeployCheckpoint():
+    def __init__(self, event_id, tag=None, base_commit=None, change_files=None, backup_filename=None,
+                 package_filename=None, prepared=False, hosts_done=None):
+        """Progress of one deployment, used to resume a failed or interrupted deployment
+
+        A deployment is prepared once the repository is reset to tag and backup and package files are made,
+        afterwards every host released successfully is recorded. Resume skips preparation and those hosts,
+        and releases the same package with the same backup.
+
+        :param event_id: event id of payload
+        :param tag: tag to deploy
+        :param base_commit: commit deployed before
+        :param change_files: changed files between base_commit and tag
+        :param backup_filename: backup of deploy directory
+        :param package_filename: package to release
+        :param prepared: True if preparation done
+        :param hosts_done: hostnames released successfully
+        """
+        self.event_id = event_id
+        self.tag = tag
+        self.base_commit = base_commit
+        self.change_files = change_files or []
+        self.backup_filename = backup_filename
+        self.package_filename = package_filename
+        self.prepared = prepared
+        self.hosts_done = list(hosts_done or [])
+        self._lock = threading.Lock()
+
+    def prepare(self, base_commit, change_files, backup_filename, package_filename):
+        self.base_commit = base_commit
+        self.change_files = change_files
+        self.backup_filename = backup_filename
+        self.package_filename = package_filename
+        self.prepared = True
+
+    def set_host_done(self, host):
+        # hosts of one wave finish concurrently
+        with self._lock:
+            if host not in self.hosts_done:
+                self.hosts_done.append(host)
+
+    def is_host_done(self, host):
+        with self._lock:
+            return host in self.hosts_done
+
+    def to_dict(self):
+        with self._lock:
+            return {'event_id': self.event_id,
+                    'tag': self.tag,
+                    'base_commit': self.base_commit,
+                    'change_files': list(self.change_files),
+                    'backup_filename': self.backup_filename,
+                    'package_filename': self.package_filename,
+                    'prepared': self.prepared,
+                    'hosts_done': list(self.hosts_done)}
+
+    @staticmethod
+    def create_by_dict(checkpoint_dict):
+        return DeployCheckpoint(checkpoint_dict['event_id'],
+                                checkpoint_dict.get('tag'),
+                                checkpoint_dict.get('base_commit'),
+                                checkpoint_dict.get('change_files'),
+                                checkpoint_dict.get('backup_filename'),
+                                checkpoint_dict.get('package_filename'),
+                                checkpoint_dict.get('prepared', False),
+                                checkpoint_dict.get('hosts_done'))
+
+    def __repr__(self):
+        return "<DeployCheckpoint {event_id} prepared={prepared} hosts_done={hosts}>".format(
+            event_id=self.event_id, prepared=self.prepared, hosts=self.hosts_done)
@@ -1,15 +1,25 @@
 __author__ = 'magus0219'
-from .repository import Repository, RepositoryException
+from .repository import Repository, RepositoryException, CommandCancelled, LAYOUT_SYMLINK
+from .wave_planner import WavePlanner
+from .distribution import PackageDistributor
+from .tag import release_tag_cmp
+from .deploy_queue import DeployQueueStore
+from .deploy_checkpoint import DeployCheckpoint
+from .scheduler import scheduler
 from config import REPOSITORY as _REPOSITORY_CFG, DEBUG as _DEBUG
 from utils.mongo_handler import mongodb_client, serialize_status
 from utils.enums import *
 from utils.mail import mail_manager
+from utils.command import CancelToken
+from utils.retry import RetryBudget
 import datetime
 import logging
+import os
 import time
 import re
 import threading
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 
 logger_server = logging.getLogger("DeployServer.DeployManager")
 
@@ -26,6 +36,11 @@ class DeployCancel(Exception):
     pass
 
 
+class HostAbort(Exception):
+    """Raised inside a host worker to stop releasing once deployment is canceled"""
+    pass
+
+
 class DeployManagerStatus:
     def __init__(self, repo):
         self.repo = repo
@@ -36,6 +51,7 @@ class DeployManagerStatus:
             'status': DeployStatus.IDLE,  # 当前部署状态
             'task_running': None,  # 正在执行的payload
             'task_waiting': [],  # 等待执行的payload
+            'task_interrupted': None,  # 服务重启时被中断的payload, 等待恢复或放弃
             'last_commit': None,  # 当前仓库的commit(供展示，与仓库实际情况不完全同步)
             'last_commit_tag': None,  # 当前仓库last_commit对应的tag object(供展示，与仓库实际情况不完全同步)
             'last_tags': None,  # 仓库最后N个标签，tag object的列表
@@ -45,10 +61,26 @@ class DeployManagerStatus:
             'hosts_roles': repo.hosts_roles,  # host角色字典
             'hosts_status': {},  # host状态字典{ hostname1: HostStatus, hostname2: HostStatus }
             'stage': None,  # 当前部署阶段
+            'waves': [],  # 发布批次, host列表的列表
+            'current_wave': None,  # 正在发布的批次序号
             'cancel_flag': False,  # 是否取消部署
-            'process_percent': 0  # 部署进度, 整数
+            'process_percent': 0,  # 部署进度, 整数
+            'debounce_seconds': repo.debounce_seconds,  # 静默期秒数, 最后一次推送后等待多久开始部署
+            'debounce_until': None,  # 静默期结束时间戳
+            'queue_metrics': {  # 任务队列统计
+                'depth': 0,  # 当前等待任务数
+                'max_depth': 0,  # 最大等待任务数
+                'processed': 0,  # 已执行任务数
+                'last_wait': 0,  # 最近一个任务的等待秒数
+                'max_wait': 0,  # 最大等待秒数
+                'total_wait': 0  # 累计等待秒数
+            }
         }
+        self.last_event_time = None
         self.locks = threading.RLock()
+        # Notify deploy worker when task added or auto deployment enabled, share the same lock of status
+        self.task_condition = threading.Condition(self.locks)
+        self.progress_lock = threading.Lock()
         self.init_host_status()
         self.update_last_commit()
         self.update_last_release_tags()
@@ -78,6 +110,13 @@ class DeployManagerStatus:
     def get_hosts(self):
         return self.status['hosts']
 
+    def set_waves(self, waves):
+        self.status['waves'] = waves
+        self.status['current_wave'] = None
+
+    def set_current_wave(self, wave_index):
+        self.status['current_wave'] = wave_index
+
     def get_fault_count(self):
         return self.status['fault_count']
 
@@ -94,6 +133,10 @@ class DeployManagerStatus:
         return self.status['status']
 
     def set_status(self, status):
+        if _DEBUG:
+            logger_server.debug("Status of {repo}: {old} -> {new}".format(repo=self.repo.repo_name,
+                                                                         old=self.status['status'],
+                                                                         new=status))
         self.status['status'] = status
 
     def set_running_task(self, payload):
@@ -102,8 +145,17 @@ class DeployManagerStatus:
     def get_running_task(self):
         return self.status['task_running']
 
-    def add_waiting_task(self, payload):
-        self.status['task_waiting'].append(payload)
+    def add_waiting_task(self, payload, first=False):
+        if not payload.enqueue_time:
+            payload.enqueue_time = time.time()
+        if first:
+            self.status['task_waiting'].insert(0, payload)
+        else:
+            self.status['task_waiting'].append(payload)
+
+        metrics = self.status['queue_metrics']
+        metrics['depth'] = len(self.status['task_waiting'])
+        metrics['max_depth'] = max(metrics['max_depth'], metrics['depth'])
 
     def has_waiting_task(self):
         if len(self.status['task_waiting']) > 0:
@@ -111,7 +163,72 @@ class DeployManagerStatus:
         return False
 
     def get_first_waiting_task(self):
-        return self.status['task_waiting'].pop(0)
+        payload = self.status['task_waiting'].pop(0)
+
+        metrics = self.status['queue_metrics']
+        metrics['depth'] = len(self.status['task_waiting'])
+        if payload.enqueue_time:
+            wait_seconds = round(time.time() - payload.enqueue_time, 3)
+            metrics['last_wait'] = wait_seconds
+            metrics['max_wait'] = max(metrics['max_wait'], wait_seconds)
+            metrics['total_wait'] += wait_seconds
+        metrics['processed'] += 1
+        return payload
+
+    def get_waiting_tasks(self):
+        return self.status['task_waiting']
+
+    def remove_waiting_task(self, payload):
+        self.status['task_waiting'].remove(payload)
+        self.status['queue_metrics']['depth'] = len(self.status['task_waiting'])
+
+    def get_debounce_seconds(self):
+        return self.status['debounce_seconds']
+
+    def set_debounce_seconds(self, seconds):
+        self.status['debounce_seconds'] = seconds
+        self._update_debounce_until()
+
+    def touch_debounce(self):
+        """Record a relevant event, quiet period restarts from now
+
+        :return:
+        """
+        self.last_event_time = time.time()
+        self._update_debounce_until()
+
+    def _update_debounce_until(self):
+        if self.last_event_time and self.status['debounce_seconds'] > 0:
+            self.status['debounce_until'] = self.last_event_time + self.status['debounce_seconds']
+        else:
+            self.status['debounce_until'] = None
+
+    def get_debounce_remaining(self):
+        """Seconds left in quiet period
+
+        :return: seconds, 0 if not in quiet period
+        """
+        if not self.status['debounce_until']:
+            return 0
+        return max(0, self.status['debounce_until'] - time.time())
+
+    def get_queue_metrics(self):
+        return self.status['queue_metrics']
+
+    def set_interrupted_task(self, payload):
+        self.status['task_interrupted'] = payload
+
+    def get_interrupted_task(self):
+        return self.status['task_interrupted']
+
+    def set_last_commit(self, commit):
+        """Set last commit & tag to a known commit instead of reading repository
+
+        :param commit:
+        :return:
+        """
+        self.status['last_commit'] = commit
+        self.status['last_commit_tag'] = self.repo.get_commit_tag(commit)
 
     def update_last_commit(self):
         """Update last commit & tag
@@ -158,6 +275,19 @@ class DeployManagerStatus:
         self.status['stage'] = stage_info
         self.status['process_percent'] = process_percent
 
+    def add_stage_info(self, stage_info, process_interval):
+        """Set stage & add interval to process percent atomically
+
+        Used by host workers which may run concurrently.
+
+        :param stage_info:
+        :param process_interval:
+        :return:
+        """
+        with self.progress_lock:
+            self.status['stage'] = stage_info
+            self.status['process_percent'] += process_interval
+
     def set_cancel_flag(self, flag):
         self.status['cancel_flag'] = flag
 
@@ -168,52 +298,578 @@ class DeployManagerStatus:
 class DeployManager:
     def __init__(self, repo_name, repo_config):
         self.repo = Repository(repo_name, repo_config)
+        self.repo.step_timeout_callback = self.log_step_timeout
+        self.wave_planner = WavePlanner(self.repo)
+        self.distributor = PackageDistributor(self.repo)
         self.status = DeployManagerStatus(self.repo)
         if _DEBUG:
             logger_server.debug("Init status" + str(self.status.export_status()))
 
+        self.queue_store = DeployQueueStore(repo_name, self.repo.branch)
+        self.checkpoint = None  # checkpoint of the last deployment
+        self.cancel_token = None  # CancelToken of running deployment
+        self.time_to_cancel = None  # seconds from cancel to running work stopped
+        self.retry_budget = None  # RetryBudget of running or last deployment
+        self._rollback_event_ids = set()  # interrupted payloads to roll back instead of deploy
+        self._resume_event_ids = set()  # interrupted payloads resumed by operator
+        self.recover()
+
+        # One long-lived worker runs waiting tasks one by one
+        self._stopping = False
+        self.worker = threading.Thread(target=self._work,
+                                       name="DeployWorker-{repo}-{branch}".format(repo=repo_name,
+                                                                                 branch=self.repo.branch))
+        self.worker.daemon = True
+        self.worker.start()
+
     def handle_event(self, event_id, event_type, payload):
+        """Queue payload for deploy worker, return at once
+
+        :param event_id:
+        :param event_type:
+        :param payload:
+        :return:
+        """
         if self.need_handle(payload):
-            # Acquire lock here to get enable_auto_deploy and status
             self.status.lock_acquire()
-            if self.status.is_enable_auto_deploy():
-                if _DEBUG:
-                    logger_server.debug(self.status.export_status())
-
-                repo_status = self.status.get_status()
-                # If idle, start deployment
-                if repo_status == DeployStatus.IDLE:
-                    self.deploy(payload)
-                elif repo_status in (DeployStatus.RUNNING, DeployStatus.ROLLBACK):
-                    # Add to Task List
-                    if self.need_handle(payload):
+            try:
+                if self.status.is_enable_auto_deploy() and not self._stopping:
+                    if not self.is_operator_task(payload):
+                        # only pushes restart quiet period, manual rollbacks start at once
+                        self.status.touch_debounce()
+                    skipped_payloads, superseding_payload = self.supersede_waiting_tasks(payload)
+                    for one_payload in skipped_payloads:
+                        if one_payload is not payload:
+                            self.status.remove_waiting_task(one_payload)
+                            self.queue_store.remove(one_payload)
+                        self.log_skipped_task(one_payload, superseding_payload)
+
+                    if payload not in skipped_payloads:
                         self.status.add_waiting_task(payload)
-                    self.status.lock_release()
+                        self.queue_store.push(payload)
+                        self.status.task_condition.notify()
                     if _DEBUG:
                         logger_server.debug("after adding waiting:" + str(self.status.export_status()))
+            finally:
+                self.status.lock_release()
+
+    def recover(self):
+        """Recover task queue persisted before last server stop
+
+        Waiting payloads are queued again. A payload still running was interrupted in the middle of deploy and
+        hosts may be half deployed, so it is flagged as interrupted and auto deployment is disabled until an
+        operator resumes or discards it. Last commit is set back to the commit before the interrupted deploy,
+        so both resume and rollback work on the right change files. If more than one payload was interrupted,
+        only the oldest one is kept and the others are discarded.
+
+        :return:
+        """
+        waiting_payloads, interrupted_payloads = self.queue_store.load()
+
+        for payload, base_commit in interrupted_payloads:
+            logger_server.info("Event[{event_id}] of {repo} was interrupted".format(event_id=payload.event_id,
+                                                                                   repo=self.repo.repo_name))
+            self.queue_store.mark_interrupted(payload)
+            mongodb_client['deployment']['deploy_log'].insert({'event_id': payload.event_id,
+                                                               'type': 'deploy_interrupted',
+                                                               'repo_name': self.repo.repo_name,
+                                                               'result': 'interrupted',
+                                                               'base_commit': base_commit,
+                                                               'createdTimeStamp': int(time.time())})
+        if interrupted_payloads:
+            # only one can be resumed or rolled back, the oldest one started from the last known good commit
+            kept_payload, base_commit = interrupted_payloads[0]
+            self.status.set_interrupted_task(kept_payload)
+            if base_commit:
+                self.status.set_last_commit(base_commit)
+            self.status.disable_auto_deploy()
+
+            for payload, base_commit in interrupted_payloads[1:]:
+                logger_server.info("Discard Event[{event_id}] of {repo}, Event[{kept_id}] is kept to resume".format(
+                    event_id=payload.event_id, repo=self.repo.repo_name, kept_id=kept_payload.event_id))
+                self.queue_store.remove(payload)
+                mongodb_client['deployment']['deploy_log'].insert({'event_id': payload.event_id,
+                                                                   'type': 'deploy_discard',
+                                                                   'repo_name': self.repo.repo_name,
+                                                                   'result': 'discarded',
+                                                                   'base_commit': base_commit,
+                                                                   'kept_event_id': kept_payload.event_id,
+                                                                   'createdTimeStamp': int(time.time())})
+
+        for payload in waiting_payloads:
+            self.status.add_waiting_task(payload)
+
+        if waiting_payloads or interrupted_payloads:
+            logger_server.info("Recover {waiting} waiting and {interrupted} interrupted tasks of {repo}".format(
+                waiting=len(waiting_payloads), interrupted=len(interrupted_payloads), repo=self.repo.repo_name))
+
+    def resume_interrupted_task(self):
+        """Deploy interrupted payload again before other waiting tasks and enable auto deployment
+
+        Deployment resumes from its checkpoint if any, hosts released before are skipped.
+
+        :return: True if there is an interrupted task
+        """
+        self.status.lock_acquire()
+        try:
+            payload = self.status.get_interrupted_task()
+            if not payload:
+                return False
+
+            self._resume_event_ids.add(payload.event_id)
+            self.status.set_interrupted_task(None)
+            self.status.add_waiting_task(payload, first=True)
+            self.queue_store.mark_waiting(payload)
+            self.status.enable_auto_deploy()
+            self.status.task_condition.notify()
+            return True
+        finally:
+            self.status.lock_release()
+
+    def rollback_interrupted_task(self):
+        """Roll back interrupted payload before other waiting tasks
+
+        :return: True if there is an interrupted task
+        """
+        self.status.lock_acquire()
+        try:
+            payload = self.status.get_interrupted_task()
+            if not payload:
+                return False
+
+            self._rollback_event_ids.add(payload.event_id)
+            self.status.set_interrupted_task(None)
+            self.status.add_waiting_task(payload, first=True)
+            self.queue_store.mark_waiting(payload)
+            self.status.enable_auto_deploy()
+            self.status.task_condition.notify()
+            return True
+        finally:
+            self.status.lock_release()
+
+    def hold_for_resume(self, payload, checkpoint):
+        """Keep a failed deployment as interrupted instead of rolling back, operator decides to resume or rollback
+
+        :param payload:
+        :param checkpoint:
+        :return:
+        """
+        logger_server.info("Hold Event[{event_id}] to resume, hosts done: {hosts}".format(
+            event_id=payload.event_id, hosts=checkpoint.hosts_done))
+        self.save_checkpoint(payload, checkpoint)
+
+        self.status.lock_acquire()
+        self.status.disable_auto_deploy()
+        self.status.set_interrupted_task(payload)
+        self.status.lock_release()
+
+    def get_checkpoint(self, payload):
+        """Get checkpoint of payload, a new one if it never ran
+
+        :param payload:
+        :return: DeployCheckpoint
+        """
+        if self.checkpoint and self.checkpoint.event_id == payload.event_id:
+            return self.checkpoint
+
+        checkpoint_dict = self.queue_store.load_checkpoint(payload)
+        if checkpoint_dict:
+            self.checkpoint = DeployCheckpoint.create_by_dict(checkpoint_dict)
+        else:
+            self.checkpoint = DeployCheckpoint(payload.event_id, payload.tag)
+        return self.checkpoint
+
+    def save_checkpoint(self, payload, checkpoint):
+        self.checkpoint = checkpoint
+        self.queue_store.save_checkpoint(payload, checkpoint)
+
+    def discard_interrupted_task(self):
+        """Forget interrupted payload, e.g. after hosts are rolled back manually
+
+        :return: True if there is an interrupted task
+        """
+        self.status.lock_acquire()
+        try:
+            payload = self.status.get_interrupted_task()
+            if not payload:
+                return False
+
+            self.status.set_interrupted_task(None)
+            self.queue_store.remove(payload)
+            return True
+        finally:
+            self.status.lock_release()
+
+    def is_operator_task(self, payload):
+        """Check if payload was queued by an operator, i.e. a manual rollback or a resumed or rolled back
+        interrupted payload, such payloads are never superseded
+
+        :param payload:
+        :return:
+        """
+        return payload.event_type == 'rollback' or payload.event_id in self._resume_event_ids or \
+               payload.event_id in self._rollback_event_ids
+
+    def supersede_waiting_tasks(self, payload):
+        """Coalescing policy of waiting tasks, decide which payloads need not deploy once payload arrives
+
+        Called with status lock held. No payload is skipped by default. Payloads queued by an operator must not
+        be skipped, see is_operator_task.
+
+        :param payload: payload to add
+        :return: (skipped payloads which may include payload itself, payload superseding them)
+        """
+        return [], None
+
+    def log_skipped_task(self, payload, superseding_payload):
+        logger_server.info("Skip Event[{event_id}] superseded by Event[{superseding_id}]".format(
+            event_id=payload.event_id, superseding_id=superseding_payload.event_id))
+        mongodb_client['deployment']['deploy_log'].insert({'event_id': payload.event_id,
+                                                           'type': 'deploy_skip',
+                                                           'repo_name': self.repo.repo_name,
+                                                           'result': 'skipped',
+                                                           'superseded_by': superseding_payload.event_id,
+                                                           'head_commit': payload.head_commit,
+                                                           'tag': payload.tag,
+                                                           'createdTimeStamp': int(time.time())})
+
+    def log_step_timeout(self, step, elapsed, msg):
+        payload = self.status.get_running_task()
+        mongodb_client['deployment']['deploy_log'].insert({'event_id': payload.event_id if payload else None,
+                                                           'type': 'step_timeout',
+                                                           'repo_name': self.repo.repo_name,
+                                                           'step': step,
+                                                           'elapsed': elapsed,
+                                                           'stage': self.status.export_status()['stage'],
+                                                           'exception': msg,
+                                                           'createdTimeStamp': int(time.time())})
+
+    def log_retries(self, payload):
+        """Log retries of finished deployment if any
+
+        :param payload: finished payload
+        :return:
+        """
+        stats = self.retry_budget.export() if self.retry_budget else None
+        if not stats or not (stats['retries'] or stats['give_ups']):
+            return
+        logger_server.info("Event[{event_id}] retried {retries} times in {seconds}s".format(
+            event_id=payload.event_id, retries=stats['retries'], seconds=stats['retry_seconds']))
+        try:
+            mongodb_client['deployment']['deploy_log'].insert({'event_id': payload.event_id,
+                                                               'type': 'deploy_retry',
+                                                               'repo_name': self.repo.repo_name,
+                                                               'retries': stats['retries'],
+                                                               'retry_seconds': stats['retry_seconds'],
+                                                               'give_ups': stats['give_ups'],
+                                                               'functions': stats['functions'],
+                                                               'createdTimeStamp': int(time.time())})
+        except Exception as ex:
+            logger_server.exception(str(ex))
+
+    def get_release_name(self, payload):
+        """Name of release directory of payload at hosts in RELEASE_LAYOUT symlink
+
+        :param payload:
+        :return: tag, or first 12 characters of head commit for branch payload
+        """
+        return payload.tag if payload.tag else (payload.head_commit or '')[:12]
+
+    def get_retry_stats(self):
+        """Retries of running or last deployment
+
+        :return: dict or None
+        """
+        return self.retry_budget.export() if self.retry_budget else None
+
+    def enable_auto_deploy(self):
+        """Enable auto deployment and wake up worker to run waiting tasks
+
+        :return:
+        """
+        self.status.lock_acquire()
+        try:
+            self.status.enable_auto_deploy()
+            self.status.task_condition.notify()
+        finally:
+            self.status.lock_release()
+
+    def set_debounce_seconds(self, seconds):
+        """Change quiet period, worker is woken up to apply it at once
+
+        :param seconds: quiet period in seconds, 0 to disable
+        :return:
+        """
+        self.status.lock_acquire()
+        try:
+            self.status.set_debounce_seconds(seconds)
+            self.status.task_condition.notify()
+        finally:
+            self.status.lock_release()
+
+    def _next_task(self):
+        """Wait until a task can run and change status to Running
+
+        Tasks stay in queue while auto deployment is disabled, e.g. after a rollback, and during quiet period
+        of debounce so a burst of pushes is coalesced and deployed once. A task queued by operator at the head of
+        queue starts without waiting for quiet period.
+
+        :return: payload or None if shutting down
+        """
+        self.status.lock_acquire()
+        try:
+            while not self._stopping:
+                if not (self.status.has_waiting_task() and self.status.is_enable_auto_deploy()):
+                    self.status.task_condition.wait()
+                    continue
+
+                # Wait until no more push arrives during quiet period, tasks queued by operator do not wait
+                remaining = self.status.get_debounce_remaining()
+                if remaining <= 0 or self.is_operator_task(self.status.get_waiting_tasks()[0]):
+                    break
+                self.status.task_condition.wait(remaining)
+
+            if self._stopping:
+                return None
+
+            payload = self.status.get_first_waiting_task()
+            self.queue_store.mark_running(payload, self.status.get_last_commit())
+            self.cancel_token = CancelToken()
+            self.repo.cancel_token = self.cancel_token
+            self.retry_budget = RetryBudget(self.repo.retry_budget_config.get('MAX_RETRIES'),
+                                            self.repo.retry_budget_config.get('MAX_SECONDS'),
+                                            self.cancel_token)
+            self.repo.retry_budget = self.retry_budget
+            self.time_to_cancel = None
+            # IDLE -> RUNNING
+            self.status.set_status(DeployStatus.RUNNING)
+            self.status.set_running_task(payload)
+            self.status.init_host_status()
+            self.status.set_cancel_flag(False)
+            return payload
+        finally:
+            self.status.lock_release()
+
+    def _finish_task(self, payload, requeue=False):
+        """Change status back to Idle after deploy or rollback finished
+
+        :param payload: finished payload
+        :param requeue: True to keep payload waiting in queue store, it did not start
+        :return:
+        """
+        self.status.lock_acquire()
+        try:
+            if requeue:
+                self.queue_store.mark_waiting(payload)
+            elif self.status.get_interrupted_task() is payload:
+                # held to resume, keep it with checkpoint
+                self.queue_store.mark_interrupted(payload)
+            else:
+                self.queue_store.remove(payload)
+                self.checkpoint = None
+            if not requeue:
+                self._resume_event_ids.discard(payload.event_id)
+                self._rollback_event_ids.discard(payload.event_id)
+            self.repo.cancel_token = None
+            self.cancel_token = None
+            self.repo.retry_budget = None
+            self.repo.clear_batches()
+            # RUNNING/ROLLBACK -> IDLE
+            self.status.set_status(DeployStatus.IDLE)
+            self.status.set_stage_info(None)
+            self.status.set_running_task(None)
+            self.status.set_cancel_flag(False)
+            if _DEBUG:
+                logger_server.debug("Status" + str(self.status.export_status()))
+        finally:
+            self.status.lock_release()
+
+    def _work(self):
+        while True:
+            payload = self._next_task()
+            if payload is None:
+                logger_server.info("Deploy worker of {repo} stopped".format(repo=self.repo.repo_name))
+                return
+
+            # Wait for a slot of global scheduler
+            self.status.set_stage_info("Waiting for deploy slot")
+            job = scheduler.admit(self.repo, payload.event_id,
+                                  lambda: self._stopping or self.status.is_cancel())
+            if job is None:
+                self.abort_unadmitted_task(payload)
+                continue
+
+            try:
+                if payload.event_id in self._rollback_event_ids:
+                    self._rollback_event_ids.discard(payload.event_id)
+                    self.rollback_interrupted(payload)
+                else:
+                    self.deploy(payload)
+            except Exception as ex:
+                # deploy handles its own exceptions, keep worker alive anyway
+                logger_server.exception(str(ex))
+            finally:
+                scheduler.release(job)
+                self.log_retries(payload)
+                self._finish_task(payload)
+
+    def abort_unadmitted_task(self, payload):
+        """Give up a task canceled or shut down before scheduler admitted it, nothing has been changed yet
+
+        :param payload:
+        :return:
+        """
+        if self._stopping:
+            # keep it in queue store for next start
+            self._finish_task(payload, requeue=True)
+            return
+
+        logger_server.info("Event[{event_id}] canceled before deploy started".format(event_id=payload.event_id))
+        mongodb_client['deployment']['deploy_log'].insert({'event_id': payload.event_id,
+                                                           'type': 'deploy_cancel',
+                                                           'result': 'success',
+                                                           'repo_name': self.repo.repo_name,
+                                                           'head_commit': payload.head_commit,
+                                                           'tag': payload.tag,
+                                                           'time_to_cancel': 0,
+                                                           'createdTimeStamp': int(time.time())})
+        self._finish_task(payload)
+
+    def shutdown(self, timeout=None):
+        """Stop worker after the running task finished, waiting tasks are kept in queue store for next start
+
+        :param timeout: seconds to wait for worker
+        :return: True if worker stopped
+        """
+        self.status.lock_acquire()
+        try:
+            self._stopping = True
+            self.status.task_condition.notify_all()
+        finally:
+            self.status.lock_release()
+        scheduler.wake()
+
+        self.worker.join(timeout)
+        return not self.worker.is_alive()
 
     def stage(self, stage_info, process_percent=0):
         self.status.set_stage_info(stage_info, process_percent)
         # Adjust if deploy canceled
         if self.status.is_cancel() and self.status.get_status() == DeployStatus.RUNNING:
-            payload = self.status.get_running_task()
+            if self.rollback_on_cancel(self.status.get_running_task()):
+                raise DeployCancel()
+
+    def rollback_on_cancel(self, payload):
+        """Roll back canceled deployment
+
+        :param payload: running payload
+        :return: True if rolled back
+        """
+        self.time_to_cancel = self.cancel_token.elapsed() if self.cancel_token else None
+        logger_server.info("Event[{event_id}] canceled, running work stopped after {elapsed}s".format(
+            event_id=payload.event_id,
+            elapsed=round(self.time_to_cancel, 3) if self.time_to_cancel is not None else None))
+        # Commands of rollback should not be killed by token of the canceled deployment
+        self.repo.cancel_token = None
+        if self.retry_budget:
+            self.retry_budget.cancel_token = None
+
+        try:
+            self.rollback(payload)
+            return True
+        except Exception as ex:
+            datetime_end = datetime.datetime.now()
+            exception_str = str(ex)
+            stack_info = traceback.format_exc()
+            mongodb_client['deployment']['deploy_log'].insert({'event_id': payload.event_id,
+                                                               'type': 'deploy_cancel',
+                                                               'result': 'fail',
+                                                               'exception': exception_str,
+                                                               'trace': stack_info,
+                                                               'time_to_cancel': self.time_to_cancel,
+                                                               'createdTimeStamp': int(time.time())})
+            if self.get_repo_strategy() == DeployStrategy.PRO_MODE:
+                mail_manager.send_cancel_fail_mail(payload,
+                                                   self.repo.get_tag_info(payload.tag), datetime_end, stack_info)
+            return False
+
+    def cancel(self):
+        """Cancel running deployment, running command is killed at once and rollback starts
+
+        :return:
+        """
+        self.status.lock_acquire()
+        try:
+            self.status.set_cancel_flag(True)
+            cancel_token = self.cancel_token if self.status.get_status() == DeployStatus.RUNNING else None
+        finally:
+            self.status.lock_release()
+
+        if cancel_token:
+            cancel_token.cancel()
+            # stop waiting for deploy slot
+            scheduler.wake()
+
+    def host_stage(self, stage_info, process_interval):
+        """Set stage inside a host worker
+
+        Rollback can not start while other hosts are still releasing, so cancel here only aborts the host pool,
+        the following stage() in main thread will do the rollback.
+
+        :param stage_info:
+        :param process_interval: percent to add
+        :return:
+        """
+        self.status.add_stage_info(stage_info, process_interval)
+        if self.status.is_cancel() and self.status.get_status() == DeployStatus.RUNNING:
+            raise HostAbort()
+
+    def release_hosts(self, hosts, release_func):
+        """Run release_func on hosts wave by wave
+
+        Hosts are split into waves by WavePlanner, a canary host first and then role limited waves. Hosts in
+        one wave are released concurrently, next wave starts only when the whole wave succeed. Once one host
+        fails hosts not started yet are skipped, the first exception is raised after in-flight hosts finish.
+
+        :param hosts: hostnames
+        :param release_func: function to release one host
+        :return:
+        """
+        abort = threading.Event()
+        errors = []
+
+        def release_one_host(host):
+            if abort.is_set():
+                return
             try:
-                self.rollback(payload)
+                release_func(host)
+            except (HostAbort, CommandCancelled):
+                # canceled, the following stage() does rollback
+                abort.set()
             except Exception as ex:
-                datetime_end = datetime.datetime.now()
-                exception_str = str(ex)
-                stack_info = traceback.format_exc()
-                mongodb_client['deployment']['deploy_log'].insert({'event_id': payload.event_id,
-                                                                   'type': 'deploy_cancel',
-                                                                   'result': 'fail',
-                                                                   'exception': exception_str,
-                                                                   'trace': stack_info,
-                                                                   'createdTimeStamp': int(time.time())})
-                if self.get_repo_strategy() == DeployStrategy.PRO_MODE:
-                    mail_manager.send_cancel_fail_mail(payload,
-                                                       self.repo.get_tag_info(payload.tag), datetime_end, stack_info)
+                errors.append(ex)
+                abort.set()
+
+        waves = self.wave_planner.plan(hosts)
+        self.status.set_waves(waves)
+
+        for wave_index, one_wave in enumerate(waves):
+            if abort.is_set():
+                break
+
+            logger_server.info("Release wave {index}/{total}: {hosts}".format(index=wave_index + 1,
+                                                                             total=len(waves),
+                                                                             hosts=one_wave))
+            self.status.set_current_wave(wave_index)
+
+            if len(one_wave) == 1:
+                release_one_host(one_wave[0])
             else:
-                raise DeployCancel()
+                with ThreadPoolExecutor(max_workers=len(one_wave)) as executor:
+                    list(executor.map(release_one_host, one_wave))
+
+        if errors:
+            raise errors[0]
 
     def get_status_info(self):
         return self.status.export_status()
@@ -221,6 +877,24 @@ class DeployManager:
     def get_repo_strategy(self):
         return self.repo.strategy
 
+    def rollback_interrupted(self, payload):
+        """Roll back an interrupted payload on operator request
+
+        :param payload:
+        :return:
+        """
+        # Rollback requested by operator is not canceled
+        self.repo.cancel_token = None
+        try:
+            self.rollback(payload)
+            mongodb_client['deployment']['deploy_log'].insert({'event_id': payload.event_id,
+                                                               'type': 'deploy_rollback',
+                                                               'result': 'success',
+                                                               'createdTimeStamp': int(time.time())})
+        except Exception as ex:
+            # failure is logged by rollback itself
+            logger_server.exception(str(ex))
+
     def deploy(self, payload):
         raise NotImplementedError
 
@@ -236,6 +910,16 @@ class GitBaseDeployManager(DeployManager):
 
         return False
 
+    def supersede_waiting_tasks(self, payload):
+        """Deploy always pulls the newest head of branch, so a new push supersedes all waiting pushes
+
+        :param payload: payload to add
+        :return: (skipped payloads, payload superseding them)
+        """
+        skipped_payloads = [one_payload for one_payload in self.status.get_waiting_tasks()
+                            if one_payload.is_branch and not self.is_operator_task(one_payload)]
+        return skipped_payloads, payload
+
     def deploy(self, payload):
         try:
             event_id = payload.event_id
@@ -243,13 +927,6 @@ class GitBaseDeployManager(DeployManager):
             logger_server.info("Start deploy Event[{event_id}]...".format(event_id=event_id))
             datetime_start = datetime.datetime.now()
 
-            # Change & init status to Running
-            self.status.set_status(DeployStatus.RUNNING)
-            self.status.set_running_task(payload)
-            self.status.init_host_status()
-            self.status.set_cancel_flag(False)
-            # Release lock to let other event occur
-            self.status.lock_release()
             if _DEBUG:
                 logger_server.debug(self.status.export_status())
 
@@ -281,22 +958,27 @@ class GitBaseDeployManager(DeployManager):
 
                 # Step 5.Release
                 self.stage("Release", 70)
-                for one_host in self.status.get_hosts():
+
+                def release_host(one_host):
                     try:
                         self.status.set_host_status(one_host, HostStatus.DEPLOYING)
                         # Step 6.1.SYNC
                         if _DEBUG:
                             logger_server.debug("Rsync files to {host}".format(host=one_host))
-                        self.stage("Rsync files to {host}".format(host=one_host),
-                                   self.status.get_process_percent() + self.status.calculate_process_interval(30, 3))
-                        repo.rsync(self.repo.git_path[:-1],
-                                   "deploy@{host}:{deploy}".format(host=one_host, deploy=self.repo.deploy_path),
-                                   "{git_path}{file}".format(git_path=self.repo.git_path,file=self.repo.exclude_filename) if
-                                       self.repo.exclude_filename else None)
+                        self.host_stage("Rsync files to {host}".format(host=one_host),
+                                        self.status.calculate_process_interval(30, 3))
+                        repo.sync_to_host(self.repo.git_path[:-1],
+                                          one_host,
+                                          "{git_path}{file}".format(git_path=self.repo.git_path,file=self.repo.exclude_filename) if
+                                              self.repo.exclude_filename else None,
+                                          change_files,
+                                          commit_before_pull,
+                                          commit_after_pull,
+                                          self.get_release_name(payload))
 
                         # Step 6.2.NPM & Python Package Install
-                        self.stage("NPM & Python Package Install to {host}".format(host=one_host),
-                                   self.status.get_process_percent() + self.status.calculate_process_interval(30, 3))
+                        self.host_stage("NPM & Python Package Install to {host}".format(host=one_host),
+                                        self.status.calculate_process_interval(30, 3))
                         repo.install_pkg(repo.get_pkg_to_install(change_files), one_host)
 
                         # Step 6.3.Get Services to restart
@@ -306,14 +988,16 @@ class GitBaseDeployManager(DeployManager):
                         # Step 6.4.Restart Services
                         if _DEBUG:
                             logger_server.debug("Restart services at {host}".format(host=one_host))
-                        self.stage("Restart services at {host}".format(host=one_host),
-                                   self.status.get_process_percent() + self.status.calculate_process_interval(30, 3))
+                        self.host_stage("Restart services at {host}".format(host=one_host),
+                                        self.status.calculate_process_interval(30, 3))
                         repo.restart_services(restart_services, one_host)
                         self.status.set_host_status(one_host, HostStatus.SUCCESS)
                     except RepositoryException as ex:
                         self.status.set_host_status(one_host, HostStatus.FAULT)
                         raise ex
 
+                self.release_hosts(self.status.get_hosts(), release_host)
+
                 """
                 # Step 6.Get Services to restarts
                 self.stage("Get Services to restart", 80)
@@ -340,27 +1024,17 @@ class GitBaseDeployManager(DeployManager):
                                                                'cost_time': str(datetime_end - datetime_start),
                                                                'createdTimeStamp': int(time.time())})
 
-            # Check if exist waiting task to run
             self.status.lock_acquire()
             self.status.update_last_commit()
-
-            if self.status.has_waiting_task():
-                self.deploy(self.status.get_first_waiting_task())
-                return
-
-            # Change Status to Idle, Trick: Here will be reached once during one working list
-            self.status.set_status(DeployStatus.IDLE)
-            self.stage(None)
-            self.status.set_running_task(None)
-            self.status.set_cancel_flag(False)
-            if _DEBUG:
-                logger_server.debug("Status" + str(self.status.export_status()))
-
             self.status.lock_release()
-        except DeployCancel as ex:
+        except (DeployCancel, CommandCancelled) as ex:
+            # Command killed by cancel, roll back here as no stage() is reached
+            if isinstance(ex, CommandCancelled) and not self.rollback_on_cancel(payload):
+                return
             mongodb_client['deployment']['deploy_log'].insert({'event_id': payload.event_id,
                                                                'type': 'deploy_cancel',
                                                                'result': 'success',
+                                                               'time_to_cancel': self.time_to_cancel,
                                                                'createdTimeStamp': int(time.time())})
         except Exception as ex:
             exception_str = str(ex)
@@ -441,30 +1115,40 @@ class GitBaseDeployManager(DeployManager):
 
             # Step 4.Release
             self.stage("Release", 80)
-            for one_host in self.status.get_hosts():
+
+            def release_host(one_host):
                 try:
                     self.status.set_host_status(one_host, HostStatus.DEPLOYING)
                     # Step 4.1.SYNC
                     if _DEBUG:
                         logger_server.debug("Rsync files to {host}".format(host=one_host))
-                    self.stage("Rsync files to {host}".format(host=one_host),
-                               self.status.get_process_percent() + self.status.calculate_process_interval(20, 2))
-                    repo.rsync(self.repo.git_path[:-1],
-                               "deploy@{host}:{deploy}".format(host=one_host, deploy=self.repo.deploy_path),
-                               "{git_path}{file}".format(git_path=self.repo.git_path,file=self.repo.exclude_filename) if
-                                    self.repo.exclude_filename else None)
+                    self.host_stage("Rsync files to {host}".format(host=one_host),
+                                    self.status.calculate_process_interval(20, 2))
+                    if repo.release_layout == LAYOUT_SYMLINK:
+                        repo.rollback_release(one_host, self.get_release_name(payload))
+                    else:
+                        # Hosts reached head_commit sync back the diff, others sync the whole tree
+                        repo.sync_to_host(self.repo.git_path[:-1],
+                                          one_host,
+                                          "{git_path}{file}".format(git_path=self.repo.git_path,file=self.repo.exclude_filename) if
+                                              self.repo.exclude_filename else None,
+                                          change_files,
+                                          head_commit,
+                                          self.status.get_last_commit())
 
                     # Step 4.2.Restart Services
                     if _DEBUG:
                         logger_server.debug("Restart services at {host}".format(host=one_host))
-                    self.stage("Restart services at {host}".format(host=one_host),
-                               self.status.get_process_percent() + self.status.calculate_process_interval(20, 2))
+                    self.host_stage("Restart services at {host}".format(host=one_host),
+                                    self.status.calculate_process_interval(20, 2))
                     repo.restart_services(restart_services, one_host)
                     self.status.set_host_status(one_host, HostStatus.SUCCESS)
                 except RepositoryException as ex:
                     self.status.set_host_status(one_host, HostStatus.FAULT)
                     raise ex
 
+            self.release_hosts(self.status.get_hosts(), release_host)
+
             """
             # Step 4.Restart Services
             self.stage("Restart Services", 80)
@@ -474,14 +1158,9 @@ class GitBaseDeployManager(DeployManager):
             logger_server.info(
                 "Rollback Event[{event_id}] done.".format(event_id=event_id))
 
-            # Change Status to Idle
+            # Status is changed to Idle by deploy worker
             self.status.lock_acquire()
-            self.status.set_status(DeployStatus.IDLE)
-            self.status.set_running_task(None)
-            self.stage(None)
             self.status.update_last_commit()
-            if _DEBUG:
-                logger_server.debug("Status" + str(self.status.export_status()))
             self.status.lock_release()
         except Exception as ex:
             mongodb_client['deployment']['deploy_log'].insert({'event_id': payload.event_id,
@@ -507,80 +1186,146 @@ class PackageBaseDeployManager(DeployManager):
 
         return False
 
+    def supersede_waiting_tasks(self, payload):
+        """Keep only the highest waiting release tag if SKIP_SUPERSEDED_TAGS is set
+
+        Manual rollbacks never skip others, payloads queued by an operator are never skipped.
+
+        :param payload: payload to add
+        :return: (skipped payloads which may include payload itself, payload superseding them)
+        """
+        if not self.repo.skip_superseded_tags or payload.event_type == 'rollback':
+            return [], None
+
+        waiting_payloads = [one_payload for one_payload in self.status.get_waiting_tasks()
+                            if not self.is_operator_task(one_payload)]
+        higher_payloads = [one_payload for one_payload in waiting_payloads
+                           if release_tag_cmp(one_payload.tag) >= release_tag_cmp(payload.tag)]
+        if higher_payloads:
+            return [payload], max(higher_payloads, key=lambda one_payload: release_tag_cmp(one_payload.tag))
+        return waiting_payloads, payload
+
+    def can_resume(self, checkpoint):
+        """Check if a prepared checkpoint can be resumed, package and backup files must still exist
+
+        :param checkpoint:
+        :return:
+        """
+        return checkpoint.prepared and os.path.exists(checkpoint.package_filename) and \
+               os.path.exists(checkpoint.backup_filename)
+
     def deploy(self, payload):
         try:
+            checkpoint = None
             event_id = payload.event_id
             repo = self.repo
             logger_server.info("Start deploy Event[{event_id}]...".format(event_id=event_id))
             datetime_start = datetime.datetime.now()
 
-            # Change & init status to Running
-            self.status.set_status(DeployStatus.RUNNING)
-            self.status.set_running_task(payload)
-            self.status.init_host_status()
-            self.status.set_cancel_flag(False)
-            # Release lock to let other event occur
-            self.status.lock_release()
             if _DEBUG:
                 logger_server.debug(self.status.export_status())
 
-            # Step 1.Clean Git Work Dir
-            self.stage("Clean Git Work Dir", 10)
-            repo.clean()
-            # Step 2.Fetch data
-            self.stage("Fetch data", 20)
-            fetch_content = repo.fetch()
-            # Step 3.Reset to tag
-            self.stage("Reset to tag", 30)
-            repo.reset(payload.tag)
+            checkpoint = self.get_checkpoint(payload)
+            if checkpoint.prepared and not self.can_resume(checkpoint):
+                logger_server.info("Package or backup of Event[{event_id}] is missing, deploy from scratch".format(
+                    event_id=event_id))
+                checkpoint = DeployCheckpoint(event_id, payload.tag)
+
+            if checkpoint.prepared:
+                logger_server.info("Resume Event[{event_id}], hosts done: {hosts}".format(event_id=event_id,
+                                                                                         hosts=checkpoint.hosts_done))
+                # Step 1-6 done before, only reset to tag for installing packages
+                self.stage("Reset to tag", 30)
+                repo.reset(payload.tag)
+
+                change_files = checkpoint.change_files
+                backup_tar_file = checkpoint.backup_filename
+                package_file = checkpoint.package_filename
+                self.status.set_backup_filename(backup_tar_file)
+                self.status.set_package_filename(package_file)
+            else:
+                # Step 1.Clean Git Work Dir
+                self.stage("Clean Git Work Dir", 10)
+                repo.clean()
+                # Step 2.Fetch data
+                self.stage("Fetch data", 20)
+                fetch_content = repo.fetch()
+                # Step 3.Reset to tag
+                self.stage("Reset to tag", 30)
+                repo.reset(payload.tag)
+
+                commit_after_pull = self.repo.get_last_commit()
+                commit_before_pull = self.status.get_last_commit()
 
-            commit_after_pull = self.repo.get_last_commit()
-            commit_before_pull = self.status.get_last_commit()
+                if _DEBUG:
+                    logger_server.debug(
+                        "Start commit:{start},end commit:{end}".format(start=commit_before_pull, end=commit_after_pull))
 
-            if _DEBUG:
-                logger_server.debug(
-                    "Start commit:{start},end commit:{end}".format(start=commit_before_pull, end=commit_after_pull))
+                change_files = self.repo.get_change_files(commit_before_pull, commit_after_pull)
 
-            change_files = self.repo.get_change_files(commit_before_pull, commit_after_pull)
+                if _DEBUG:
+                    logger_server.debug("Change files:" + str(change_files))
 
-            if _DEBUG:
-                logger_server.debug("Change files:" + str(change_files))
+                if change_files:
+                    # Step 4.Run Post-actions
+                    self.stage("Run Post-actions", 40)
+                    repo.handle_post_actions()
+                    # Step 5.Backup Deploy Directory
+                    self.stage("Backup Deploy Directory", 50)
+                    backup_tar_file = repo.backup_deploy_dir()
+                    self.status.set_backup_filename(backup_tar_file)
 
-            if change_files:
-                # Step 4.Run Post-actions
-                self.stage("Run Post-actions", 40)
-                repo.handle_post_actions()
-                # Step 5.Backup Deploy Directory
-                self.stage("Backup Deploy Directory", 50)
-                backup_tar_file = repo.backup_deploy_dir()
-                self.status.set_backup_filename(backup_tar_file)
+                    if _DEBUG:
+                        logger_server.debug("Backup File:" + backup_tar_file)
 
-                if _DEBUG:
-                    logger_server.debug("Backup File:" + backup_tar_file)
+                    # Step 6.Tar directory
+                    self.stage("Tar directory", 60)
+                    package_file = repo.tar_git_dir(payload.tag)
+                    self.status.set_package_filename(package_file)
 
-                # Step 6.Tar directory
-                self.stage("Tar directory", 60)
-                package_file = repo.tar_git_dir(payload.tag)
-                self.status.set_package_filename(package_file)
+                    if _DEBUG:
+                        logger_server.debug("Package File:" + package_file)
 
-                if _DEBUG:
-                    logger_server.debug("Package File:" + package_file)
+                    checkpoint.prepare(commit_before_pull, change_files, backup_tar_file, package_file)
+                    self.save_checkpoint(payload, checkpoint)
 
+            if change_files:
                 # Step 8.Release Tar
                 self.stage("Release Package", 70)
-                for one_host in self.status.get_hosts():
+                release_commit = repo.get_last_commit()
+
+                # Hosts received package from peers install it locally, others are released from deploy server
+                distributed_packages = {}
+                if self.distributor.enabled:
+                    self.stage("Distribute Package", 70)
+                    distributed_packages = self.distributor.distribute(
+                        package_file, [one_host for one_host in self.status.get_hosts()
+                                       if not checkpoint.is_host_done(one_host)])
+
+                def release_host(one_host):
+                    if checkpoint.is_host_done(one_host):
+                        self.status.set_host_status(one_host, HostStatus.SUCCESS)
+                        self.host_stage("Skip {host} released before".format(host=one_host),
+                                        self.status.calculate_process_interval(30, 1))
+                        return
+
                     try:
                         self.status.set_host_status(one_host, HostStatus.DEPLOYING)
                         # Step 8.1.SYNC package
                         if _DEBUG:
                             logger_server.debug("Rsync files to {host}".format(host=one_host))
-                        self.stage("Rsync files to {host}".format(host=one_host),
-                                   self.status.get_process_percent() + self.status.calculate_process_interval(30, 3))
-                        repo.release(package_file, one_host)
+                        self.host_stage("Rsync files to {host}".format(host=one_host),
+                                        self.status.calculate_process_interval(30, 3))
+                        if one_host in distributed_packages:
+                            self.distributor.install(one_host, distributed_packages[one_host], release_commit,
+                                                     self.get_release_name(payload))
+                        else:
+                            repo.release(package_file, one_host, change_files, checkpoint.base_commit,
+                                         release_commit, self.get_release_name(payload))
 
                         # Step 8.2.NPM & Python Package Install
-                        self.stage("NPM & Python Package Install to {host}".format(host=one_host),
-                                   self.status.get_process_percent() + self.status.calculate_process_interval(30, 3))
+                        self.host_stage("NPM & Python Package Install to {host}".format(host=one_host),
+                                        self.status.calculate_process_interval(30, 3))
 
                         repo.install_pkg(repo.get_pkg_to_install(change_files), one_host)
 
@@ -591,13 +1336,17 @@ class PackageBaseDeployManager(DeployManager):
                         # Step 8.4.Restart Services
                         if _DEBUG:
                             logger_server.debug("Restart services at {host}".format(host=one_host))
-                        self.stage("Restart services at {host}".format(host=one_host),
-                                   self.status.get_process_percent() + self.status.calculate_process_interval(30, 3))
+                        self.host_stage("Restart services at {host}".format(host=one_host),
+                                        self.status.calculate_process_interval(30, 3))
                         repo.restart_services(restart_services, one_host)
                         self.status.set_host_status(one_host, HostStatus.SUCCESS)
+                        checkpoint.set_host_done(one_host)
+                        self.save_checkpoint(payload, checkpoint)
                     except RepositoryException as ex:
                         self.status.set_host_status(one_host, HostStatus.FAULT)
                         raise ex
+
+                self.release_hosts(self.status.get_hosts(), release_host)
                 self.stage("Finish", 100)
 
             else:
@@ -617,32 +1366,22 @@ class PackageBaseDeployManager(DeployManager):
 
             mail_manager.send_success_mail(payload, self.repo.get_tag_info(payload.tag), datetime_start, datetime_end)
 
-            # Check if exist waiting task to run
             self.status.lock_acquire()
             self.status.update_last_commit()
-
-            if self.status.has_waiting_task():
-                self.deploy(self.status.get_first_waiting_task())
-                return
-
-            # Change Status to Idle, Trick: Here will be reached once during one working list
-            self.status.set_status(DeployStatus.IDLE)
             self.status.init_host_status()
-            self.stage(None)
             self.status.update_last_release_tags()
-            self.status.set_running_task(None)
-            self.status.set_cancel_flag(False)
             self.status.set_backup_filename(None)
             self.status.set_package_filename(None)
-            if _DEBUG:
-                logger_server.debug("Status" + str(self.status.export_status()))
-
             self.status.lock_release()
-        except DeployCancel as ex:
+        except (DeployCancel, CommandCancelled) as ex:
+            # Command killed by cancel, roll back here as no stage() is reached
+            if isinstance(ex, CommandCancelled) and not self.rollback_on_cancel(payload):
+                return
             datetime_end = datetime.datetime.now()
             mongodb_client['deployment']['deploy_log'].insert({'event_id': payload.event_id,
                                                                'type': 'deploy_cancel',
                                                                'result': 'success',
+                                                               'time_to_cancel': self.time_to_cancel,
                                                                'createdTimeStamp': int(time.time())})
             mail_manager.send_cancel_success_mail(payload, self.repo.get_tag_info(payload.tag), datetime_start, datetime_end)
 
@@ -659,6 +1398,17 @@ class PackageBaseDeployManager(DeployManager):
                                                                'createdTimeStamp': int(time.time()),
                                                                'status_snapshot': serialize_status(
                                                                    self.status.export_status())})
+
+            # Package released to some hosts, keep them and wait for operator to resume or rollback
+            if not self.repo.auto_rollback and checkpoint and checkpoint.prepared:
+                self.hold_for_resume(payload, checkpoint)
+                mongodb_client['deployment']['deploy_log'].insert({'event_id': payload.event_id,
+                                                                   'type': 'deploy_hold',
+                                                                   'result': 'wait_resume',
+                                                                   'hosts_done': checkpoint.hosts_done,
+                                                                   'createdTimeStamp': int(time.time())})
+                return
+
             try:
                 self.rollback(payload)
                 datetime_end = datetime.datetime.now()
@@ -689,7 +1439,25 @@ class PackageBaseDeployManager(DeployManager):
                                                                        self.status.export_status())})
                 mail_manager.send_rollback_fail_mail(payload, self.repo.get_tag_info(payload.tag), datetime_start,
                                                         datetime_end, stack_info, rollback_stack_info)
+        finally:
+            # Staged package and backup are not needed after deploy or rollback finished
+            self.repo.clear_staged_packages()
+
 
+    def rollback_interrupted(self, payload):
+        """Roll back an interrupted payload with backup in its checkpoint
+
+        :param payload:
+        :return:
+        """
+        checkpoint = self.get_checkpoint(payload)
+        if checkpoint.prepared:
+            self.status.set_backup_filename(checkpoint.backup_filename)
+            self.status.set_package_filename(checkpoint.package_filename)
+        try:
+            super().rollback_interrupted(payload)
+        finally:
+            self.repo.clear_staged_packages()
 
     def rollback(self, payload):
         try:
@@ -729,22 +1497,29 @@ class PackageBaseDeployManager(DeployManager):
 
                     # Step 3.Release backup package
                     self.stage("Release backup package", 50)
-                    for one_host in self.status.get_hosts():
+
+                    def release_host(one_host):
                         # Step 3.1 SYNC package
                         self.status.set_host_status(one_host, HostStatus.DEPLOYING)
                         if _DEBUG:
                             logger_server.debug("Rsync files to {host}".format(host=one_host))
-                        self.stage("Rsync files to {host}".format(host=one_host),
-                                   self.status.get_process_percent() + self.status.calculate_process_interval(30, 2))
-                        self.repo.release(backup_package, one_host)
+                        self.host_stage("Rsync files to {host}".format(host=one_host),
+                                        self.status.calculate_process_interval(30, 2))
+                        if repo.release_layout == LAYOUT_SYMLINK:
+                            repo.rollback_release(one_host, self.get_release_name(payload))
+                        else:
+                            # Backup is not a clean tree of a commit, always sync the whole tree
+                            self.repo.release(backup_package, one_host, target_commit=self.status.get_last_commit())
 
                         # Step 3.2.Restart Services
                         if _DEBUG:
                             logger_server.debug("Restart services at {host}".format(host=one_host))
-                        self.stage("Restart services at {host}".format(host=one_host),
-                                   self.status.get_process_percent() + self.status.calculate_process_interval(30, 2))
+                        self.host_stage("Restart services at {host}".format(host=one_host),
+                                        self.status.calculate_process_interval(30, 2))
                         repo.restart_services(restart_services, one_host)
                         self.status.set_host_status(one_host, HostStatus.SUCCESS)
+
+                    self.release_hosts(self.status.get_hosts(), release_host)
                 else:
                     logger_server.info("Nothing has been changed")
             else:
@@ -758,19 +1533,13 @@ class PackageBaseDeployManager(DeployManager):
             logger_server.info(
                 "Rollback Event[{event_id}] done.".format(event_id=event_id))
 
-            # Change Status to Idle
+            # Status is changed to Idle by deploy worker
             self.status.lock_acquire()
-            self.status.set_status(DeployStatus.IDLE)
             self.status.init_host_status()
-            self.stage(None)
             self.status.update_last_release_tags()
-            self.status.set_running_task(None)
-            self.status.set_cancel_flag(False)
             self.status.set_backup_filename(None)
             self.status.set_package_filename(None)
             self.status.update_last_commit()
-            if _DEBUG:
-                logger_server.debug("Status" + str(self.status.export_status()))
             self.status.lock_release()
         except Exception as ex:
             mongodb_client['deployment']['deploy_log'].insert({'event_id': payload.event_id,
@@ -794,6 +1563,14 @@ class DeployManagerFactory():
 
 class DeployManagerCenter():
     def __init__(self, repository_config):
+        """Hold deploy managers of all repositories and branches
+
+        Deploy managers run independently in their own worker threads. Repository passes an explicit working
+        directory to every command and never changes the process working directory, so different
+        repositories can deploy at the same time, as many as the global scheduler admits.
+
+        :param repository_config: REPOSITORY configuration
+        """
         self.dms = {}
 
         for repo_config in repository_config:
@@ -802,6 +1579,27 @@ class DeployManagerCenter():
                 self.dms[repo_name] = {}
             self.dms[repo_name][repo_config['BRANCH']] = DeployManagerFactory.create_deploy_manager(repo_name, repo_config)
 
+    def handle_tag_push(self, payload):
+        """Record pushed tag into tag index of every deploy manager of this repository
+
+        :param payload: tag payload
+        :return:
+        """
+        if payload.is_tag and payload.repository_name in self.dms:
+            for branch, dm in self.dms[payload.repository_name].items():
+                dm.repo.tag_index.add_pending(payload.tag)
+
+    def handle_tag_delete(self, repository_name, tag_name):
+        """Remove deleted tag from tag index of every deploy manager of this repository
+
+        :param repository_name:
+        :param tag_name:
+        :return:
+        """
+        if repository_name in self.dms:
+            for branch, dm in self.dms[repository_name].items():
+                dm.repo.tag_index.remove(tag_name)
+
     def need_handle_payload(self, payload):
         repo_name = payload.repository_name
 
@@ -833,6 +1631,18 @@ class DeployManagerCenter():
                 repos_with_branch.append('{repo_name}/{branch}'.format(repo_name=repo_name, branch=branch))
         return repos_with_branch
 
+    def shutdown(self, timeout=None):
+        """Stop workers of all deploy managers, running deployments are allowed to finish
+
+        :param timeout: seconds to wait for every worker
+        :return:
+        """
+        for repo_name, branch_dms in self.dms.items():
+            for branch, dm in branch_dms.items():
+                if not dm.shutdown(timeout):
+                    logger_server.info("Deploy worker of {repo}/{branch} still running".format(repo=repo_name,
+                                                                                              branch=branch))
+
     def __contains__(self, item):
         return item in self.dms
 
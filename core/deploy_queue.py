@@ -0,0 +1,120 @@
+__author__ = 'magus0219'
+import logging
+import time
+from .payload import PayLoad
+from utils.mongo_handler import mongodb_client
+
+logger_server = logging.getLogger("DeployServer.DeployQueue")
+
+
+class QueueState():
+    WAITING = 'waiting'
+    RUNNING = 'running'
+    INTERRUPTED = 'interrupted'
+
+
+class DeployQueueStore():
+    def __init__(self, repo_name, branch):
+        """Durable copy of task queue of a deploy manager in mongo collection deployment.deploy_queue
+
+        One document per payload, it is inserted when the payload is queued, marked running when deploy starts
+        and removed only after deploy finished(at-least-once). So after a restart waiting payloads can be queued
+        again, and a payload still marked running was interrupted in the middle of deploy.
+
+        Writing to mongo should never stop deployment, failures are only logged.
+
+        :param repo_name:
+        :param branch:
+        """
+        self.repo_name = repo_name
+        self.branch = branch
+
+    @property
+    def collection(self):
+        return mongodb_client['deployment']['deploy_queue']
+
+    def _spec(self, payload=None):
+        spec = {'repo_name': self.repo_name, 'branch': self.branch}
+        if payload:
+            spec['event_id'] = payload.event_id
+        return spec
+
+    def push(self, payload):
+        try:
+            document = self._spec(payload)
+            document.update({'payload': payload.to_dict(),
+                             'state': QueueState.WAITING,
+                             'enqueueTimeStamp': payload.enqueue_time or time.time()})
+            self.collection.insert(document)
+        except Exception as ex:
+            logger_server.exception("Fail to persist Event[{event_id}]: {ex}".format(event_id=payload.event_id,
+                                                                                    ex=str(ex)))
+
+    def mark_running(self, payload, base_commit):
+        """Mark payload running
+
+        :param payload:
+        :param base_commit: commit deployed before this payload, needed to resume or rollback after restart
+        :return:
+        """
+        self._update(payload, {'state': QueueState.RUNNING,
+                               'baseCommit': base_commit,
+                               'startTimeStamp': time.time()})
+
+    def mark_waiting(self, payload):
+        self._update(payload, {'state': QueueState.WAITING})
+
+    def mark_interrupted(self, payload):
+        self._update(payload, {'state': QueueState.INTERRUPTED})
+
+    def save_checkpoint(self, payload, checkpoint):
+        self._update(payload, {'checkpoint': checkpoint.to_dict()})
+
+    def load_checkpoint(self, payload):
+        """Load checkpoint saved for payload
+
+        :param payload:
+        :return: checkpoint dict or None
+        """
+        try:
+            document = self.collection.find_one(self._spec(payload))
+            if document:
+                return document.get('checkpoint')
+        except Exception as ex:
+            logger_server.exception("Fail to load checkpoint of Event[{event_id}]: {ex}".format(
+                event_id=payload.event_id, ex=str(ex)))
+        return None
+
+    def _update(self, payload, fields):
+        try:
+            self.collection.update(self._spec(payload), {'$set': fields})
+        except Exception as ex:
+            logger_server.exception("Fail to update Event[{event_id}]: {ex}".format(event_id=payload.event_id,
+                                                                                   ex=str(ex)))
+
+    def remove(self, payload):
+        try:
+            self.collection.remove(self._spec(payload))
+        except Exception as ex:
+            logger_server.exception("Fail to remove Event[{event_id}]: {ex}".format(event_id=payload.event_id,
+                                                                                   ex=str(ex)))
+
+    def load(self):
+        """Load persisted payloads
+
+        :return: (list of waiting payloads in queue order, list of (payload, base_commit) interrupted)
+        """
+        waiting_payloads = []
+        interrupted_payloads = []
+        try:
+            for document in self.collection.find(self._spec()).sort('enqueueTimeStamp', 1):
+                payload = PayLoad.create_by_dict(document['payload'])
+                if document['state'] == QueueState.WAITING:
+                    waiting_payloads.append(payload)
+                else:
+                    interrupted_payloads.append((payload, document.get('baseCommit')))
+        except Exception as ex:
+            logger_server.exception("Fail to load deploy queue of {repo}/{branch}: {ex}".format(repo=self.repo_name,
+                                                                                               branch=self.branch,
+                                                                                               ex=str(ex)))
+        return waiting_payloads, interrupted_payloads
@@ -0,0 +1,269 @@
+__author__ = 'magus0219'
+import hashlib
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from .repository import RepositoryException, CommandCancelled, StepTimeout, STEP_RSYNC, SYNC_FULL, REVISION_FILENAME, \
+    LAYOUT_SYMLINK, RELEASE_ACTIVE, RELEASE_RETAINED
+
+logger_server = logging.getLogger("DeployServer.Distribution")
+
+# MODE of DISTRIBUTION
+DISTRIBUTION_DIRECT = 'direct'
+DISTRIBUTION_TREE = 'tree'
+
+
+class DistributionException(RepositoryException):
+    pass
+
+
+class SshTransport():
+    def __init__(self, repo):
+        """Reach hosts through ssh as user deploy, hosts forward packages to each other by rsync over ssh
+
+        :param repo: Repository
+        """
+        self.repo = repo
+
+    def path(self, host, path):
+        return path
+
+    def run(self, host, command, step=STEP_RSYNC):
+        """Run shell command at host
+
+        :return: output
+        """
+        return self.repo._run_shell_command("{ssh} deploy@{host} \"{command}\"".format(ssh=self.repo._ssh_command(host),
+                                                                                     host=host,
+                                                                                     command=command),
+                                            step=step)
+
+    def send(self, src_host, src_path, dest_host, dest_path):
+        """Copy a file from src_host(None means deploy server) to dest_host
+
+        """
+        if src_host is None:
+            command = "rsync -a -e \"{ssh}\" {src_path} deploy@{host}:{dest_path}".format(
+                ssh=self.repo._ssh_command(dest_host), src_path=src_path, host=dest_host, dest_path=dest_path)
+            self.repo._run_shell_command(command, step=STEP_RSYNC)
+        else:
+            self.run(src_host, "rsync -a {src_path} deploy@{host}:{dest_path}".format(src_path=src_path,
+                                                                                   host=dest_host,
+                                                                                   dest_path=dest_path))
+
+
+class LocalTransport():
+    def __init__(self, repo, root):
+        """Hosts are local directories root/<host>, used to test distribution without real hosts
+
+        Paths of a host are mapped into its directory, commands run locally.
+
+        :param repo: Repository
+        :param root: directory containing host directories
+        """
+        self.repo = repo
+        self.root = root
+
+    def path(self, host, path):
+        return os.path.join(self.root, host, path.lstrip(os.sep))
+
+    def run(self, host, command, step=STEP_RSYNC):
+        return self.repo._run_shell_command("sh -c \"{command}\"".format(command=command), step=step)
+
+    def send(self, src_host, src_path, dest_host, dest_path):
+        src_path = self.path(src_host, src_path) if src_host else src_path
+        self.repo._run_shell_command("cp {src_path} {dest_path}".format(src_path=src_path,
+                                                                         dest_path=self.path(dest_host, dest_path)),
+                                     step=STEP_RSYNC)
+
+
+class PackageDistributor():
+    def __init__(self, repo):
+        """Distribute release packages to hosts in a fan-out tree
+
+        Deploy server only sends package to FANOUT hosts, every host having the package forwards it to the next
+        FANOUT hosts, so uplink of deploy server carries FANOUT copies instead of one copy per host. Hosts are
+        numbered in order, children of host i are hosts (i + 1) * FANOUT ... (i + 1) * FANOUT + FANOUT - 1.
+
+        Every copy is verified by sha256 at the receiving host. If a host fails, its children are seeded by deploy
+        server directly.
+
+        Configured by DISTRIBUTION of repository:
+            MODE: direct(default) or tree
+            FANOUT: hosts every node sends to, default 2
+            REMOTE_PATH: directory of packages at hosts, default /tmp/niner_packages/
+            TRANSPORT: ssh(default) or local for testing with LOCAL_ROOT/<host> directories as hosts
+
+        :param repo: Repository
+        """
+        self.repo = repo
+        config = repo.distribution
+        self.mode = config.get('MODE', DISTRIBUTION_DIRECT)
+        self.fanout = max(1, config.get('FANOUT', 2))
+        self.remote_path = config.get('REMOTE_PATH', '/tmp/niner_packages/')
+        if config.get('TRANSPORT', 'ssh') == 'local':
+            self.transport = LocalTransport(repo, config['LOCAL_ROOT'])
+        else:
+            self.transport = SshTransport(repo)
+
+    @property
+    def enabled(self):
+        return self.mode == DISTRIBUTION_TREE
+
+    @staticmethod
+    def get_checksum(filename):
+        sha256 = hashlib.sha256()
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                sha256.update(chunk)
+        return sha256.hexdigest()
+
+    def get_children(self, index, count):
+        """Indexes of hosts forwarded to by host index, -1 means deploy server
+
+        :param index: index of host
+        :param count: number of hosts
+        :return: list of indexes
+        """
+        start = (index + 1) * self.fanout
+        return list(range(start, min(start + self.fanout, count)))
+
+    def _remote_package(self, package):
+        return os.path.join(self.remote_path, os.path.basename(package))
+
+    def _verify(self, host, remote_package, checksum):
+        output = self.transport.run(host, "sha256sum {package}".format(
+            package=self.transport.path(host, remote_package)))
+        remote_checksum = output.split()[0] if output.split() else None
+        if remote_checksum != checksum:
+            raise DistributionException("Checksum of {package} at {host} is {remote} instead of {checksum}".format(
+                package=remote_package, host=host, remote=remote_checksum, checksum=checksum))
+
+    def _send(self, src_host, host, package, remote_package, checksum):
+        remote_dir = self.transport.path(host, self.remote_path)
+        # keep only the package being distributed
+        self.transport.run(host, "mkdir -p {dir} && find {dir} -name '{repo}_*.tar.gz' ! -name '{name}' -delete".format(
+            dir=remote_dir, repo=self.repo.repo_name, name=os.path.basename(package)))
+        self.transport.send(src_host, remote_package if src_host else package, host, remote_package)
+        self._verify(host, remote_package, checksum)
+
+    def distribute(self, package, hosts):
+        """Distribute package to hosts
+
+        :param package: package file at deploy server
+        :param hosts: hostnames
+        :return: {host: package path at host} of hosts received and verified package
+        """
+        checksum = self.get_checksum(package)
+        remote_package = self._remote_package(package)
+        received = {}
+        lock = threading.Lock()
+        logger_server.info("Distribute {package}[sha256:{checksum}] to {count} hosts with fanout {fanout}".format(
+            package=package, checksum=checksum, count=len(hosts), fanout=self.fanout))
+
+        with ThreadPoolExecutor(max_workers=max(1, min(len(hosts), self.fanout * self.fanout))) as executor:
+            pending = []
+            pending_lock = threading.Lock()
+
+            def submit(src_host, index):
+                with pending_lock:
+                    pending.append(executor.submit(forward, src_host, index))
+
+            def forward(src_host, index):
+                host = hosts[index]
+                try:
+                    logger_server.info("Send package from {src} to {host}".format(src=src_host or 'deploy server',
+                                                                                  host=host))
+                    self._send(src_host, host, package, remote_package, checksum)
+                    with lock:
+                        received[host] = remote_package
+                    parent = host
+                except (CommandCancelled, StepTimeout):
+                    raise
+                except RepositoryException as ex:
+                    logger_server.info("Fail to send package from {src} to {host}: {ex}".format(
+                        src=src_host or 'deploy server', host=host, ex=str(ex)))
+                    if src_host is not None:
+                        # try once more from deploy server
+                        submit(None, index)
+                        return
+                    # children are seeded by deploy server
+                    parent = None
+
+                for child in self.get_children(index, len(hosts)):
+                    submit(parent, child)
+
+            for index in self.get_children(-1, len(hosts)):
+                submit(None, index)
+
+            # futures may submit more futures, wait until no more
+            finished = 0
+            while True:
+                with pending_lock:
+                    if finished >= len(pending):
+                        break
+                    one_future = pending[finished]
+                finished += 1
+                one_future.result()
+
+        logger_server.info("Package received by {received}/{count} hosts".format(received=len(received),
+                                                                                count=len(hosts)))
+        return received
+
+    def install(self, host, remote_package, target_commit=None, release_name=None):
+        """Decompress package at host and sync it into deploy directory of host
+
+        In RELEASE_LAYOUT symlink package is synced into a new release directory which is activated afterwards,
+        a complete release directory retained at host is activated without installing package.
+
+        :param host: hostname
+        :param remote_package: package path at host
+        :param target_commit: commit of package
+        :param release_name: name of release directory
+        :return:
+        """
+        deploy_path = self.transport.path(host, self.repo.deploy_path)
+        dest_path = deploy_path
+        if self.repo.release_layout == LAYOUT_SYMLINK:
+            release_name = release_name or (target_commit or '')[:12]
+            output = self.transport.run(host, self.repo.get_prepare_release_script(release_name, deploy_path))
+            if RELEASE_ACTIVE in output:
+                logger_server.info("Release {release} is active at {host}".format(release=release_name, host=host))
+                return
+            if RELEASE_RETAINED in output:
+                logger_server.info("Release {release} is retained at {host}, activate it...".format(
+                    release=release_name, host=host))
+                self.transport.run(host, self.repo.get_activate_release_script(release_name, deploy_path))
+                return
+            dest_path = "{deploy_path}{release}/".format(deploy_path=deploy_path,
+                                                         release=self.repo.get_release_dir(release_name))
+
+        remote_package = self.transport.path(host, remote_package)
+        extract_path = remote_package[:-len('.tar.gz')] + '.extract'
+        src_path = "{extract}/{repo}".format(extract=extract_path, repo=self.repo.repo_name)
+        exclude = "--exclude-from={src_path}/{filename}".format(
+            src_path=src_path, filename=self.repo.exclude_filename) if self.repo.exclude_filename else ""
+        command = "rm -rf {extract} && mkdir -p {extract} && tar -zxf {package} -C {extract} && " \
+                  "rsync -a --delete {exclude} {src_path} {dest_path}".format(extract=extract_path,
+                                                                             package=remote_package,
+                                                                             exclude=exclude,
+                                                                             src_path=src_path,
+                                                                             dest_path=dest_path)
+        if self.repo.release_layout != LAYOUT_SYMLINK and self.repo.sync_mode != SYNC_FULL:
+            # record commit for delta or batch sync of next deployment
+            revision_file = "{deploy_path}{repo}/{filename}".format(deploy_path=deploy_path,
+                                                                    repo=self.repo.repo_name,
+                                                                    filename=REVISION_FILENAME)
+            if target_commit:
+                command += " && echo {commit} > {file}".format(commit=target_commit, file=revision_file)
+            else:
+                command += " && rm -f {file}".format(file=revision_file)
+        command += "; code=$?; rm -rf {extract}; exit $code".format(extract=extract_path)
+
+        logger_server.info("Install package at {host}[CMD:{cmd}]...".format(host=host, cmd=command))
+        self.transport.run(host, command)
+
+        if self.repo.release_layout == LAYOUT_SYMLINK:
+            logger_server.info("Activate release {release} at {host}...".format(release=release_name, host=host))
+            self.transport.run(host, self.repo.get_activate_release_script(release_name, deploy_path))
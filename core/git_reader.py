@@ -0,0 +1,123 @@
+__author__ = 'magus0219'
+import subprocess
+import threading
+import logging
+
+logger_server = logging.getLogger("DeployServer.GitObjectReader")
+
+
+class GitReaderException(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return self.msg
+
+
+class GitObjectReader():
+    def __init__(self, git_path):
+        """Long-lived object reader of a git repository
+
+        Two processes are kept for one repository and shared by all threads:
+            git cat-file --batch-check: resolve a revision to object name and type
+            git cat-file --batch: read content of an object
+        They are started at first request and restarted if died or invalidated.
+
+        :param git_path: path of git repository
+        """
+        self.git_path = git_path
+        self._processes = {}
+        self._lock = threading.Lock()
+
+    def _get_process(self, option):
+        process = self._processes.get(option)
+        if process is None or process.poll() is not None:
+            logger_server.info("Start git object reader [CMD:git cat-file {option}] at {path}...".format(
+                option=option, path=self.git_path))
+            process = subprocess.Popen(['git', 'cat-file', option],
+                                       cwd=self.git_path,
+                                       stdin=subprocess.PIPE,
+                                       stdout=subprocess.PIPE,
+                                       stderr=subprocess.DEVNULL)
+            self._processes[option] = process
+        return process
+
+    def _close_process(self, option):
+        process = self._processes.pop(option, None)
+        if process is not None:
+            try:
+                process.stdin.close()
+                process.wait(timeout=5)
+            except Exception:
+                process.kill()
+            try:
+                process.stdout.close()
+            except Exception:
+                pass
+
+    def _request(self, option, rev):
+        """Send one revision to cat-file and read the answer
+
+        :param option: --batch or --batch-check
+        :param rev: revision to query
+        :return: (object name, type, content) or None if missing, content is None for --batch-check
+        """
+        if '\n' in rev:
+            raise GitReaderException("Invalid revision {rev}".format(rev=repr(rev)))
+
+        with self._lock:
+            process = self._get_process(option)
+            try:
+                process.stdin.write(rev.encode('utf8') + b'\n')
+                process.stdin.flush()
+                header = process.stdout.readline().decode('utf8').rstrip('\n')
+
+                if not header:
+                    raise GitReaderException("git cat-file {option} exited unexpectedly".format(option=option))
+
+                fields = header.split(' ')
+                if len(fields) != 3:
+                    # <rev> missing or <rev> ambiguous
+                    return None
+
+                object_name, object_type, size = fields
+                content = None
+                if option == '--batch':
+                    content = process.stdout.read(int(size))
+                    # content is followed by a LF
+                    process.stdout.read(1)
+                return object_name, object_type, content
+            except (OSError, ValueError, GitReaderException) as ex:
+                self._close_process(option)
+                raise GitReaderException("Fail to read {rev} from git object reader: {ex}".format(rev=rev, ex=ex))
+
+    def resolve(self, rev):
+        """Resolve revision to object name
+
+        :param rev: revision like HEAD, refs/tags/r0.0.1, commit id...
+        :return: (object name, type) or None if missing
+        """
+        rst = self._request('--batch-check', rev)
+        if rst:
+            return rst[0], rst[1]
+        return None
+
+    def read_object(self, rev):
+        """Read object content
+
+        :param rev: revision like HEAD, refs/tags/r0.0.1, commit id...
+        :return: (object name, type, content text) or None if missing
+        """
+        rst = self._request('--batch', rev)
+        if rst:
+            return rst[0], rst[1], rst[2].decode('utf8', errors='replace')
+        return None
+
+    def invalidate(self):
+        """Stop reader processes, they will be restarted at next request
+
+        Call this after the repository is changed by fetch, pull or reset.
+        """
+        with self._lock:
+            for option in list(self._processes.keys()):
+                self._close_process(option)
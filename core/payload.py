@@ -15,6 +15,7 @@ class PayLoad():
         self.tag = tag
         self.username = username
         self.src = src
+        self.enqueue_time = None  # timestamp when queued by deploy manager
 
     @staticmethod
     def create_by_payload(event_id, event_type, payload):
@@ -53,5 +54,22 @@ class PayLoad():
         tag = tag
         return PayLoad(event_id, event_type, repository_name, is_tag, is_branch, commit_id, username, "手工回滚", tag=tag)
 
+    def to_dict(self):
+        return dict(vars(self))
+
+    @staticmethod
+    def create_by_dict(payload_dict):
+        """Create payload from dict made by to_dict
+
+        :param payload_dict:
+        :return: PayLoad object
+        """
+        payload = PayLoad(payload_dict['event_id'], payload_dict['event_type'], payload_dict['repository_name'],
+                          payload_dict['is_tag'], payload_dict['is_branch'], payload_dict['head_commit'],
+                          payload_dict['username'], payload_dict['src'], payload_dict.get('branch'),
+                          payload_dict.get('tag'))
+        payload.enqueue_time = payload_dict.get('enqueue_time')
+        return payload
+
     def __repr__(self):
         return str(self.event_id)
@@ -2,39 +2,103 @@ __author__ = 'magus0219'
 from config import DEBUG as _DEBUG, SERVER_CONFIG as _SERVER_CFG
 from utils.decorator import retry
 from utils.string_util import remove_quota_pair
-import subprocess
-import traceback
-import uuid
+from utils.command import run_command
+from utils.ssh_pool import ssh_pool
+from utils.supervisor import supervisor_pool, SupervisorException, is_permanent_fault
+from utils.retry import classify_command, classify_message
+from utils.readiness import wait_until_ready, supervisor_probe, http_probe, ReadinessException
 import re
 import os
 import shutil
 import logging
 import datetime
+import threading
 import time
-from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from core.tag import Tag
+from core.tag_index import TagIndex
+from core.git_reader import GitObjectReader
 import shlex
+import tempfile
 
 logger_server = logging.getLogger("DeployServer.Repository")
 
 
-def release_tag_cmp(release_tag):
-    nums = release_tag[1:].split('.')
-    major = int(nums[0])
-    minor = int(nums[1])
-    patch = int(nums[2])
-
-    return major * 10000 * 10000 + minor * 10000 + patch
-
-
 class RepositoryException(Exception):
-    def __init__(self, msg):
+    def __init__(self, msg, result=None):
         self.msg = msg
+        self.result = result
 
     def __str__(self):
         return self.msg
 
 
+class CommandCancelled(RepositoryException):
+    """Raised when a command is killed because deployment is canceled"""
+    pass
+
+
+class StepTimeout(RepositoryException):
+    def __init__(self, msg, step, elapsed, result=None):
+        """Raised when a step runs longer than its timeout in STEP_TIMEOUTS
+
+        :param msg:
+        :param step: step type like 'rsync'
+        :param elapsed: seconds the step ran
+        :param result: CommandResult if a command was killed
+        """
+        super().__init__(msg, result)
+        self.step = step
+        self.elapsed = elapsed
+
+
+# Step types of STEP_TIMEOUTS
+STEP_FETCH = 'fetch'
+STEP_TAR = 'tar'
+STEP_RSYNC = 'rsync'
+STEP_INSTALL = 'install'
+STEP_RESTART = 'restart'
+STEP_POST_ACTION = 'post_action'
+
+# SYNC_MODE
+SYNC_FULL = 'full'
+SYNC_DELTA = 'delta'
+SYNC_BATCH = 'batch'
+# File in deploy directory of a host recording the commit deployed there
+REVISION_FILENAME = '.niner_revision'
+# BACKUP_MODE
+BACKUP_TAR = 'tar'
+BACKUP_SNAPSHOT = 'snapshot'
+# RELEASE_LAYOUT
+LAYOUT_INPLACE = 'inplace'
+LAYOUT_SYMLINK = 'symlink'
+# File in release directory of a host marking release was synced completely and activated once
+RELEASE_COMPLETE_FILENAME = '.niner_complete'
+# Printed by scripts at host
+RELEASE_ACTIVE = 'RELEASE_ACTIVE'
+RELEASE_NOT_ACTIVE = 'RELEASE_NOT_ACTIVE'
+RELEASE_RETAINED = 'RELEASE_RETAINED'
+
+
+def classify_repository_error(ex):
+    """Classify errors of git, ssh, rsync and supervisor for retry
+
+    Cancel and timeout are never retried, supervisor faults are classified by fault code, failed commands by
+    output and exit code. Unknown errors are retried.
+
+    :param ex: exception raised
+    :return: True if transient, False if permanent, None if unknown
+    """
+    if isinstance(ex, (CommandCancelled, StepTimeout)):
+        return False
+    if isinstance(ex.__cause__, SupervisorException):
+        return not is_permanent_fault(ex.__cause__.code)
+    result = getattr(ex, 'result', None)
+    if result is not None:
+        return classify_command(result.args, result.return_code, result.output)
+    return classify_message(str(ex))
+
+
 class Repository():
     def __init__(self, repo_name, repo_config):
         """Initialize this repository
@@ -55,6 +119,42 @@ class Repository():
         self.hosts = sorted(list(repo_config['HOSTS'].keys()))
         self.exclude_filename = repo_config['EXCLUDE_FILENAME']
         self.pip_script = repo_config['PIP_SCRIPT']
+        self.supervisor_port = repo_config.get('SUPERVISOR_PORT', 9001)
+        self.readiness = repo_config.get('READINESS', {})
+        self.services_readiness = repo_config.get('SERVICES_READINESS', {})
+        self.max_parallel_hosts = repo_config.get('MAX_PARALLEL_HOSTS', 1)
+        self.canary_host = repo_config.get('CANARY_HOST', None)
+        self.wave_role_percent = repo_config.get('WAVE_ROLE_PERCENT', {})
+        self.staging_path = repo_config.get('STAGING_PATH', '/tmp/niner_staging/')
+        self.skip_superseded_tags = repo_config.get('SKIP_SUPERSEDED_TAGS', False)
+        self.debounce_seconds = repo_config.get('DEBOUNCE_SECONDS', 0)
+        self.auto_rollback = repo_config.get('AUTO_ROLLBACK', True)
+        self.step_timeouts = repo_config.get('STEP_TIMEOUTS', {})
+        self.retry_budget_config = repo_config.get('RETRY_BUDGET', {})
+        self.deploy_priority = repo_config.get('DEPLOY_PRIORITY', None)
+        self.sync_mode = repo_config.get('SYNC_MODE', SYNC_FULL)
+        self.mirror_path = repo_config.get('MIRROR_PATH', '/tmp/niner_mirror/')
+        self.distribution = repo_config.get('DISTRIBUTION', {})
+        self.release_layout = repo_config.get('RELEASE_LAYOUT', LAYOUT_INPLACE)
+        self.keep_releases = max(2, repo_config.get('KEEP_RELEASES', 5))
+        self.backup_mode = repo_config.get('BACKUP_MODE', BACKUP_TAR)
+        self.keep_backups = max(2, repo_config.get('KEEP_BACKUPS', 10))
+        # function(step, elapsed, msg) called when a step times out
+        self.step_timeout_callback = None
+
+        # package name -> {'lock': lock, 'path': extracted directory}
+        self._staged_packages = {}
+        self._staging_lock = threading.Lock()
+        # target commit -> {'lock': lock, 'done': bool, 'batch': batch file or None, 'base': commit of mirror}
+        self._batches = {}
+        self._batch_lock = threading.Lock()
+
+        self.git_reader = GitObjectReader(self.git_path)
+        # CancelToken of running deployment, commands are killed once it is canceled
+        self.cancel_token = None
+        # RetryBudget of running deployment shared by retries of all steps
+        self.retry_budget = None
+        self.tag_index = TagIndex(self)
 
         self._complete_path_with_sep()
         self._gen_service_index(repo_config)
@@ -78,19 +178,13 @@ class Repository():
         :param commit_id: commit
         :return: tag object
         """
-        command = "git describe --abbrev=0 --exact-match {commit}".format(commit=commit_id)
-
-        logger_server.info("Get tag of commit[CMD:{cmd}]...".format(cmd=command))
-
-        self.cwd(self.git_path)
+        logger_server.info("Get tag of commit {commit} from tag index...".format(commit=commit_id))
 
-        try:
-            tag_name = self._run_shell_command(command=command)
-        except RepositoryException as ex:
-            # commit not map to annotation tag
+        rst = self.git_reader.resolve('{commit}^{{commit}}'.format(commit=commit_id))
+        if not rst:
             return None
 
-        return self.get_tag_info(tag_name[:-1])
+        return self.tag_index.get_commit_tag(rst[0])
 
 
     def _gen_service_index(self, repo_config):
@@ -144,49 +238,86 @@ class Repository():
     def __hash__(self):
         return hash(self.repo_name + self.branch)
 
-    def _run_shell_command(self, command, cwd=None):
+    def _run_shell_command(self, command, cwd=None, timeout=None, line_callback=None, step=None):
         """Inner method to run a shell command
 
-        Run a shell command described in param command and redirect stdout and stderr to a temp text file which
+        Run a shell command described in param command and capture stdout and stderr through a pipe, the
         content will be returned if succeed, else the content will be contained in a RepositoryException raised.
 
         :param command: content of a shell command.
+        :param cwd: working directory of command
+        :param timeout: seconds to wait before killing command, None means timeout of step or wait forever
+        :param line_callback: function called with every output line
+        :param step: step type to look up timeout in STEP_TIMEOUTS
         :return: stdout/stderr content
-        :raise: RepositoryException if failed
+        :raise: RepositoryException if failed, CommandCancelled if killed for cancel, StepTimeout if timeout
         """
-        success = True
+        command_string = command
+        command = shlex.split(command)
+        if timeout is None and step:
+            timeout = self.step_timeouts.get(step)
 
-        # command = command.split(' ')
+        # ssh master used by command must not be closed as idle while command runs
+        with ssh_pool.session(command_string):
+            result = run_command(command, cwd=cwd, timeout=timeout, line_callback=line_callback,
+                                 cancel_token=self.cancel_token)
 
-        # # remove quota pair
-        # for i in range(len(command)):
-        #     command[i] = remove_quota_pair(command[i])
+        if _DEBUG:
+            logger_server.debug("{result} output_truncated={truncated}".format(result=repr(result),
+                                                                                truncated=result.truncated))
+
+        if result.cancelled:
+            raise CommandCancelled("Command canceled: {command}\n{output}".format(command=' '.join(command),
+                                                                              output=result.output), result)
+        elif result.timed_out:
+            self._step_timeout(step, result.duration,
+                               "Command timeout after {timeout}s: {command}\n{output}".format(
+                                   timeout=timeout, command=' '.join(command), output=result.output), result)
+        elif not result.success:
+            raise RepositoryException(result.output, result)
+        else:
+            return result.output
 
-        command = shlex.split(command)
+    def _step_timeout(self, step, elapsed, msg, result=None):
+        """Report a timeout of step and raise StepTimeout
 
-        tmp_filename = '/tmp/' + str(uuid.uuid4())
+        :param step: step type
+        :param elapsed: seconds the step ran
+        :param msg: error message
+        :param result: CommandResult if any
+        :return:
+        """
+        logger_server.info("Step {step} timeout after {elapsed:.1f}s".format(step=step, elapsed=elapsed))
+        if self.step_timeout_callback:
+            try:
+                self.step_timeout_callback(step, elapsed, msg)
+            except Exception as ex:
+                logger_server.exception(str(ex))
+        raise StepTimeout(msg, step, elapsed, result)
+
+    def _get_restart_elapsed(self, deadline):
+        """Seconds restart step has run, restart step of a host starts timeout seconds before its deadline
+
+        :param deadline: timestamp of restart step timeout
+        :return:
+        """
+        start_time = deadline - self.step_timeouts.get(STEP_RESTART)
+        return time.time() - start_time
 
-        with open(tmp_filename, 'w', encoding='utf-8') as w_tmpfile:
-            kwargs = {
-                'args': command,
-                'stdout': w_tmpfile,
-                'stderr': w_tmpfile
-            }
-            if cwd:
-                kwargs['cwd'] = cwd
-            return_code = subprocess.call(**kwargs)
-            if return_code > 0:
-                success = False
+    def _check_cancel(self):
+        """Raise CommandCancelled if running deployment is canceled
 
-        with open(tmp_filename, 'r', encoding='utf-8') as r_tmpfile:
-            std_content = r_tmpfile.read()
+        """
+        if self.cancel_token and self.cancel_token.is_cancelled:
+            raise CommandCancelled("Deployment canceled")
 
-        os.remove(tmp_filename)
+    def _ssh_command(self, host):
+        """Get ssh command to deploy@host reusing pooled master connection
 
-        if not success:
-            raise RepositoryException(std_content)
-        else:
-            return std_content
+        :param host: hostname
+        :return: ssh command string
+        """
+        return ssh_pool.get_ssh_command("deploy@{host}".format(host=host))
 
     def handle_post_actions(self):
         """Hook to handle post actions
@@ -197,27 +328,11 @@ class Repository():
             for one_action in self.post_actions:
                 logger_server.info("Handle post actions {action}".format(action=one_action))
                 try:
-                    self._run_shell_command(one_action['cmd'], one_action['cwd'])
+                    self._run_shell_command(one_action['cmd'], one_action['cwd'], step=STEP_POST_ACTION)
                 except Exception as ex:
                     logger_server.info("Fail to execute post action: {action}".format(action=one_action))
                     raise ex
 
-    def cwd(self, path=None):
-        """Change current work directory
-
-        :param path: Target directory to change, using git_path if None
-        :return:
-        """
-        if not path:
-            path = self.git_path
-        try:
-            if os.getcwd() != path:
-                logger_server.info("Change current dir to {path}...".format(path=path))
-                os.chdir(path)
-        except Exception as ex:
-            logger_server.info("Fail to change current dir to {path}".format(path=path))
-            raise RepositoryException(traceback.print_exc())
-
     def clean(self):
         """Clean git work directory
 
@@ -232,14 +347,12 @@ class Repository():
 
         logger_server.info("Clean files not in version control[CMD:{cmd}]...".format(cmd=command1))
 
-        self.cwd(self.git_path)
-
-        rst = self._run_shell_command(command=command1)
+        rst = self._run_shell_command(command=command1, cwd=self.git_path)
 
         logger_server.info("Clean modified files in version control[CMD:{cmd}]...".format(cmd=command2))
-        rst = self._run_shell_command(command=command2)
+        rst = self._run_shell_command(command=command2, cwd=self.git_path)
 
-    @retry(times=3)
+    @retry(times=3, classifier=classify_repository_error, budget_attr='retry_budget')
     def fetch(self):
         """Fetch data
 
@@ -251,16 +364,16 @@ class Repository():
 
         logger_server.info("Fetch data from github[CMD:{cmd}]...".format(cmd=command))
 
-        self.cwd(self.git_path)
-
-        fetch_content = self._run_shell_command(command=command)
+        fetch_content = self._run_shell_command(command=command, cwd=self.git_path, step=STEP_FETCH)
+        self.git_reader.invalidate()
+        self.tag_index.invalidate()
 
         if _DEBUG:
             logger_server.debug("fetch_content:" + fetch_content)
 
         return fetch_content
 
-    @retry(times=3)
+    @retry(times=3, classifier=classify_repository_error, budget_attr='retry_budget')
     def pull(self):
         """Pull data
 
@@ -272,9 +385,9 @@ class Repository():
 
         logger_server.info("Pull data from github[CMD:{cmd}]...".format(cmd=command))
 
-        self.cwd(self.git_path)
-
-        pull_content = self._run_shell_command(command=command)
+        pull_content = self._run_shell_command(command=command, cwd=self.git_path, step=STEP_FETCH)
+        self.git_reader.invalidate()
+        self.tag_index.invalidate()
 
         if _DEBUG:
             logger_server.debug("pull_content:" + pull_content)
@@ -291,9 +404,8 @@ class Repository():
 
         logger_server.info("Reset to Commit {commit} [CMD:{cmd}]...".format(commit=commit, cmd=command))
 
-        self.cwd(self.git_path)
-
-        self._run_shell_command(command=command)
+        self._run_shell_command(command=command, cwd=self.git_path)
+        self.git_reader.invalidate()
 
     def get_change_files(self, start_commit, end_commit):
         """Analyze commit range and export names of changed files
@@ -302,18 +414,18 @@ class Repository():
         :param end_commit: commit str
         :return: list of names of change files or none
         """
-        command = "git diff --name-only {start} {end}".format(start=start_commit, end=end_commit)
+        # Without renames both old and new paths are listed, paths are not escaped unless really unusual
+        command = "git -c core.quotepath=off diff --name-only --no-renames {start} {end}".format(start=start_commit,
+                                                                                               end=end_commit)
 
         logger_server.info(
             "Get change files from {start}...{end} [CMD:{cmd}]...".format(start=start_commit, end=end_commit,
                                                                           cmd=command))
 
-        self.cwd(self.git_path)
-
         change_files = []
 
         if start_commit is not None and end_commit is not None:
-            change_content = self._run_shell_command(command=command)
+            change_content = self._run_shell_command(command=command, cwd=self.git_path)
 
         for one_file in change_content.split('\n'):
             change_files.append(one_file)
@@ -331,76 +443,46 @@ class Repository():
 
         :return: commit id
         """
-        command = "git log -n 1 --oneline"
-
-        logger_server.info("Get last commit id [CMD:{cmd}]...".format(cmd=command))
-
-        self.cwd(self.git_path)
+        logger_server.info("Get last commit id [git cat-file --batch-check HEAD]...")
 
-        last_commit = self._run_shell_command(command=command)
+        rst = self.git_reader.resolve('HEAD')
+        if not rst:
+            raise RepositoryException("Fail to resolve HEAD of {repo}".format(repo=self.repo_name))
 
-        return last_commit.split(' ')[0]
+        return rst[0]
 
     def get_last_release_tags(self):
-        """Get last release tags and parse tag to get tag object
+        """Get last release tags from tag index
 
-        We only recognize annotation tag here, example of output of git show tagname here:
-        ================================================
-        tag r0.0.3
-        Tagger: Arthur.Qin <magus0219@gmail.com>
-        Date:   Wed May 6 11:42:55 2015 +0800
+        We only recognize annotation tag here, see TagIndex.
 
-        release3
-
-        commit 04591b7527b85182dc517e1068e4cc94bd7d38d4
-        Merge: 32eff1d 9d9b243
-        Author: Arthur.Qin <magus0219@gmail.com>
-        Date:   Wed May 6 10:55:19 2015 +0800
-
-            Merge pull request #6 from baixing/master
-
-            merger baixing/master
-        ================================================
         :return: list of tag object
         """
-        command = 'git tag -l "r*.*.*"'
-
-        logger_server.info("Get last release tags [CMD:{cmd}]...".format(cmd=command))
-
-        self.cwd(self.git_path)
+        logger_server.info("Get last release tags from tag index...")
 
-        tags = self._run_shell_command(command=command)
+        tags = self.tag_index.get_last_release_tags(_SERVER_CFG['TAG_LIST_SIZE'])
 
         if _DEBUG:
             logger_server.debug("Get release tags: {tags}".format(tags=tags))
 
-        tag_list = tags.split('\n')
-        # remove last blank line
-        tag_list = tag_list[:-1]
-        tag_list.sort(key=release_tag_cmp, reverse=True)
-
-        tags = []
-        for i in range(_SERVER_CFG['TAG_LIST_SIZE']):
-            if i + 1 <= len(tag_list):
-                one_tag = tag_list[i]
-                tag = self.get_tag_info(one_tag)
-                if tag:
-                    tags.append(tag)
-
         return tags
 
     def get_tag_info(self, tag_name):
         """Get tag object from tag_name
 
+        Tag object is read by git object reader, lightweight tag is not recognized.
+
         :param tag_name:
-        :return:
+        :return: tag object or None
         """
-        command = "git show {tagname}".format(tagname=tag_name)
-        logger_server.info("Get tag info of {tagname},[CMD:{cmd}]...".format(tagname=tag_name, cmd=command))
+        logger_server.info("Get tag info of {tagname} [git cat-file --batch]...".format(tagname=tag_name))
+
+        rst = self.git_reader.read_object('refs/tags/{tagname}'.format(tagname=tag_name))
+        if not rst or rst[1] != 'tag':
+            return None
 
-        self.cwd(self.git_path)
-        tag_info = self._run_shell_command(command=command)
-        tag = Tag.create_by_tag_info(tag_info)
+        commit = self.git_reader.resolve('refs/tags/{tagname}^{{commit}}'.format(tagname=tag_name))
+        tag = Tag.create_by_tag_object(rst[2], commit[0] if commit else None)
 
         return tag
 
@@ -416,24 +498,29 @@ class Repository():
             filename = one_file.split('/')[-1]
 
             # adjust file exist
-            if not os.path.exists(one_file):
+            if not os.path.exists(os.path.join(self.git_path, one_file)):
                 logger_server.info("{file} not exist.".format(file=one_file))
             else:
                 if filename == "requirements.txt":
-                    command = "ssh deploy@{host} \"cd {deploy_path}; {pip} install -r {file}\"".format(host=host,
-                                            deploy_path="{path}{repo}".format(path=self.deploy_path, repo=self.repo_name),
-                                                                                                    pip=self.pip_script,
-                                                                                                    file=one_file)
+                    command = "{ssh} deploy@{host} \"cd {deploy_path}; {pip} install -r {file}\"".format(
+                        ssh=self._ssh_command(host),
+                        host=host,
+                        deploy_path="{path}{repo}".format(path=self.deploy_path, repo=self.repo_name),
+                        pip=self.pip_script,
+                        file=one_file)
                     logger_server.info("Install python package in {file}[CMD:{cmd}]...".format(file=one_file,
                                                                                                cmd=command))
-                    self._run_shell_command(command=command)
+                    self._run_shell_command(command=command, step=STEP_INSTALL)
 
     def restart_services(self, services, host):
         """Restart services
 
         Services has own priority, which we used to adjust which to restart first.
 
-        The lower pri number is, the higher pri this service is.
+        The lower pri number is, the higher pri this service is. Services of the same priority are restarted
+        concurrently, services of next priority start only when all of them are ready.
+
+        Restarting all services of a host is limited by timeout of step restart in STEP_TIMEOUTS.
 
         :param services: List of services to restart
         :return:
@@ -441,88 +528,196 @@ class Repository():
         if not services:
             logger_server.info("Nothing to restart.")
         else:
-            # Order services by pri.
-            order_services = {}
+            start_time = time.time()
+            timeout = self.step_timeouts.get(STEP_RESTART)
+            deadline = start_time + timeout if timeout else None
+
+            # Group services by pri.
+            pri_groups = {}
             for one_service in services:
                 pri = self.service_pri[one_service]
-                order_services[one_service] = pri
-            order_services = OrderedDict(sorted(order_services.items(), key=lambda t: t[1]))
-
-            for one_service in order_services.keys():
-                self.restart_service(one_service, host)
-
-
-    @retry(3)
-    def restart_service(self, service, host):
+                pri_groups.setdefault(pri, []).append(one_service)
+
+            for pri in sorted(pri_groups.keys()):
+                if deadline and time.time() >= deadline:
+                    self._step_timeout(STEP_RESTART, time.time() - start_time,
+                                       "Restart services at {host} timeout after {timeout}s".format(host=host,
+                                                                                                   timeout=timeout))
+                group = sorted(pri_groups[pri])
+                if len(group) == 1:
+                    self.restart_service(group[0], host, deadline)
+                else:
+                    logger_server.info("Restart services {services} at {hostname} concurrently...".format(
+                        services=group, hostname=host))
+                    with ThreadPoolExecutor(max_workers=len(group)) as executor:
+                        futures = [executor.submit(self.restart_service, one_service, host, deadline)
+                                   for one_service in group]
+                    # raise first error after the whole group finished
+                    for one_future in futures:
+                        one_future.result()
+
+    @retry(3, classifier=classify_repository_error, budget_attr='retry_budget')
+    def restart_service(self, service, host, deadline=None):
         """Restart one service
 
         Here service is identified as supervisor program name. For example: pyds:pyds_3355
 
-        After restart we also check service status to confirm it is really running
+        After restart we wait until service is ready, see _wait_service_ready
 
         :param service: service name
         :param host: hostname
+        :param deadline: timestamp to give up waiting for ready
         :return:
         """
+        self._check_cancel()
+        if deadline and time.time() >= deadline:
+            self._step_timeout(STEP_RESTART, self._get_restart_elapsed(deadline),
+                               "Restart {service} at {host} timeout".format(service=service, host=host))
         if self._need_restart(host, service):
-            command = "supervisorctl -s {server_url} restart {service}".format(server_url="http://{hostname}:9001".format(hostname=host), service=service)
-
-            logger_server.info("Restart service {service} at {hostname}[CMD:{cmd}]...".format(service=service,
-                                                                                              cmd=command,
-                                                                                              hostname=host))
-            self._run_shell_command(command=command)
-
-            # sleep to restart
-            time.sleep(5)
-
-            self._check_service_running(service, host)
+            logger_server.info("Restart service {service} at {hostname}[XML-RPC:{port}]...".format(service=service,
+                                                                                                hostname=host,
+                                                                                                port=self.supervisor_port))
+            try:
+                with supervisor_pool.client(host, self.supervisor_port) as client:
+                    client.restart_process(service, wait=False)
+            except SupervisorException as ex:
+                raise RepositoryException("Fail to restart {service} at {host}: {ex}".format(service=service,
+                                                                                             host=host,
+                                                                                             ex=str(ex))) from ex
+
+            self._wait_service_ready(service, host, deadline)
         else:
             logger_server.info("{hostname} do not need start service {service}".format(service=service,
                                                                                        hostname=host))
 
-    def _check_service_running(self, service, host):
-        """Check service
+    def _get_readiness_config(self, service):
+        """Readiness config of service, SERVICES_READINESS overrides READINESS
 
-        Here service is identified as supervisor program name. For example: pyds:pyds_3355
+        :param service: service name
+        :return: dict with TIMEOUT, MIN_UPTIME, HEALTH_URL
+        """
+        config = {'TIMEOUT': 60, 'MIN_UPTIME': 3, 'HEALTH_URL': None}
+        config.update(self.readiness)
+        config.update(self.services_readiness.get(service, {}))
+        return config
+
+    def _wait_service_ready(self, service, host, deadline=None):
+        """Wait service is ready
+
+        Service is ready if it has been RUNNING in supervisor for MIN_UPTIME seconds, and its HEALTH_URL(if
+        configured) responds successfully. Fail if not ready in TIMEOUT seconds.
 
-        :param service: service to restart
+        :param service: service name
         :param host: hostname
+        :param deadline: timestamp of restart step timeout, wait no longer than it
         :return:
         """
-        command = "supervisorctl -s {server_url} status {service}".format(
-            server_url="http://{hostname}:9001".format(hostname=host), service=service)
-        logger_server.info("Check service {service} at {hostname} [CMD:{cmd}]...".format(service=service,
-                                                                                         cmd=command,
-                                                                                         hostname=host))
-        result_content = self._run_shell_command(command=command)
-        result = re.match(".+RUNNING.+", result_content)
-        # Status is not running
-        if not result:
+        config = self._get_readiness_config(service)
+        timeout = config['TIMEOUT']
+        if deadline:
+            timeout = min(timeout, max(0, deadline - time.time()))
+
+        probes = [supervisor_probe(host, self.supervisor_port, service, config['MIN_UPTIME'])]
+        if config['HEALTH_URL']:
+            probes.append(http_probe(config['HEALTH_URL'].format(host=host)))
+
+        logger_server.info("Wait service {service} at {hostname} ready...".format(service=service, hostname=host))
+        try:
+            elapsed = wait_until_ready(probes, timeout, cancel_token=self.cancel_token)
+        except ReadinessException as ex:
+            self._check_cancel()
+            if deadline and time.time() >= deadline:
+                self._step_timeout(STEP_RESTART, self._get_restart_elapsed(deadline),
+                                   "Service {service} at {host} not ready before restart timeout: {ex}".format(
+                                       service=service, host=host, ex=str(ex)))
             logger_server.info("Fail to restart {service} at {host}".format(service=service, host=host))
-            raise RepositoryException("Fail to restart {service} at {host}".format(service=service, host=host))
+            raise RepositoryException("Fail to restart {service} at {host}: {ex}".format(service=service,
+                                                                                         host=host,
+                                                                                         ex=str(ex)))
+
+        logger_server.info("Service {service} at {hostname} is ready after {elapsed:.1f}s".format(service=service,
+                                                                                                 hostname=host,
+                                                                                                 elapsed=elapsed))
 
 
     def backup_deploy_dir(self):
         """Backup deploy directory
 
+        :return: tar.gz file, or snapshot directory in BACKUP_MODE snapshot
         """
+        if self.backup_mode == BACKUP_SNAPSHOT:
+            return self.snapshot_deploy_dir()
+
         now = datetime.datetime.now()
         target_filename = self.backup_path + '{repo_name}_{time_str}.tar.gz'.format(repo_name=self.repo_name,
                                                                                     time_str=now.strftime(
                                                                                         "%Y_%m_%d_%H_%M_%S"))
 
-        self.cwd(self.deploy_path)
         command = "tar -zcvf {target_filename} {src_path} --exclude='{src_path}/.git'".format(
             target_filename=target_filename,
             src_path=self.repo_name)
 
         logger_server.info("Backup deploy path [CMD:{cmd}]...".format(cmd=command))
 
-        self._run_shell_command(command=command)
+        self._run_shell_command(command=command, cwd=self.deploy_path, step=STEP_TAR)
 
         return target_filename
 
 
+    def snapshot_deploy_dir(self):
+        """Backup deploy directory as a snapshot directory hard linked to the latest snapshot
+
+        Snapshots are BACKUP_PATH/<repo_name>_snapshots/<time>/<repo_name>, unchanged files are hard links to
+        files of the latest snapshot, so time and disk usage of a backup grow with changed files only. Snapshot
+        can be released directly without decompressing. Only the newest KEEP_BACKUPS snapshots are kept.
+
+        :return: snapshot directory
+        """
+        snapshots_path = "{backup}{repo_name}_snapshots".format(backup=self.backup_path, repo_name=self.repo_name)
+        snapshot = os.path.join(snapshots_path, datetime.datetime.now().strftime("%Y_%m_%d_%H_%M_%S"))
+        partial_path = snapshot + '.partial'
+        latest = os.path.join(snapshots_path, 'latest')
+
+        shutil.rmtree(partial_path, ignore_errors=True)
+        os.makedirs(partial_path)
+
+        link_dest = ""
+        if os.path.isdir(latest):
+            link_dest = "--link-dest={latest}/{repo_name}/".format(latest=os.path.realpath(latest),
+                                                                   repo_name=self.repo_name)
+        command = "rsync -a --delete {link_dest} --exclude=/.git {deploy_path}{repo_name}/ " \
+                  "{partial_path}/{repo_name}/".format(link_dest=link_dest,
+                                                       deploy_path=self.deploy_path,
+                                                       repo_name=self.repo_name,
+                                                       partial_path=partial_path)
+
+        logger_server.info("Snapshot deploy path [CMD:{cmd}]...".format(cmd=command))
+
+        self._run_shell_command(command=command, step=STEP_TAR)
+        os.rename(partial_path, snapshot)
+
+        # switch latest atomically
+        latest_tmp = latest + '.tmp'
+        if os.path.lexists(latest_tmp):
+            os.remove(latest_tmp)
+        os.symlink(os.path.basename(snapshot), latest_tmp)
+        os.replace(latest_tmp, latest)
+
+        self._prune_snapshots(snapshots_path)
+        return snapshot
+
+    def _prune_snapshots(self, snapshots_path):
+        """Remove snapshots except the newest KEEP_BACKUPS
+
+        :param snapshots_path: directory of snapshots
+        :return:
+        """
+        snapshots = sorted(one_dir for one_dir in os.listdir(snapshots_path)
+                           if one_dir not in ('latest', 'latest.tmp') and not one_dir.endswith('.partial'))
+        for one_dir in snapshots[:-self.keep_backups]:
+            logger_server.info("Remove old snapshot {snapshot}...".format(snapshot=one_dir))
+            shutil.rmtree(os.path.join(snapshots_path, one_dir), ignore_errors=True)
+
     def tar_git_dir(self, tag_name):
         """Release git directory with a tag without .git directory
 
@@ -531,18 +726,17 @@ class Repository():
                                                                                      tag_name=tag_name)
         # if file exist, do not tar again
         if not os.path.exists(target_filename):
-            self.cwd(self.git_path)
-            self.cwd('..')
             command = "tar -zcvf {target_filename} {src_path} --exclude='{src_path}/.git'".format(
                 target_filename=target_filename,
                 src_path=self.repo_name)
 
             logger_server.info("Tar git path [CMD:{cmd}]...".format(cmd=command))
 
-            self._run_shell_command(command=command)
+            self._run_shell_command(command=command, cwd=os.path.dirname(self.git_path.rstrip(os.sep)), step=STEP_TAR)
 
         return target_filename
 
+    @retry(times=3, classifier=classify_repository_error, budget_attr='retry_budget')
     def rsync(self, src_path, dest_path, exclude_file=None):
         """Rsync file from scr to dest
 
@@ -552,41 +746,545 @@ class Repository():
         :return:
         """
 
-        command = "rsync -a --delete {exclude} {src_path} {dest_path}".format(exclude="--exclude-from={file}".format(
+        # Reuse ssh master connection if dest is remote like deploy@host:path
+        remote_shell = ""
+        if ':' in dest_path.split('/')[0]:
+            remote_shell = "-e \"{ssh}\"".format(ssh=ssh_pool.get_ssh_command(dest_path.split(':')[0]))
+
+        command = "rsync -a --delete {shell} {exclude} {src_path} {dest_path}".format(shell=remote_shell,
+                                                                              exclude="--exclude-from={file}".format(
                                                                               file=exclude_file) if exclude_file else "",
                                                                               src_path=src_path,
                                                                               dest_path=dest_path)
 
         logger_server.info("Rsync to deploy directory[CMD:{cmd}]....".format(cmd=command))
-        self._run_shell_command(command)
+        self._run_shell_command(command, step=STEP_RSYNC)
         return
 
-    def release(self, release_package, host):
-        """Release release_file to deploy_path
+    @retry(times=3, classifier=classify_repository_error, budget_attr='retry_budget')
+    def rsync_files(self, src_path, dest_path, files, exclude_file=None):
+        """Rsync only files listed from src to dest
 
-        :param release_package: package to release
-        :param host: hostname to release
+        Files missing in src are deleted in dest, so added, modified and deleted files of a diff can be synced in
+        one command without walking the whole tree.
+
+        :param src_path: src directory
+        :param dest_path: dest directory
+        :param files: paths relative to src_path
+        :param exclude_file: filename of exclude if exists
+        :return:
+        """
+        remote_shell = ""
+        if ':' in dest_path.split('/')[0]:
+            remote_shell = "-e \"{ssh}\"".format(ssh=ssh_pool.get_ssh_command(dest_path.split(':')[0]))
+
+        with tempfile.NamedTemporaryFile('w', prefix='niner_files_', suffix='.txt') as files_from:
+            files_from.write('\n'.join(files) + '\n')
+            files_from.flush()
+
+            command = "rsync -a --delete-missing-args --files-from={files_from} {shell} {exclude} {src_path}/ " \
+                      "{dest_path}/".format(files_from=files_from.name,
+                                            shell=remote_shell,
+                                            exclude="--exclude-from={file}".format(
+                                                file=exclude_file) if exclude_file else "",
+                                            src_path=src_path.rstrip(os.sep),
+                                            dest_path=dest_path.rstrip(os.sep))
+
+            logger_server.info("Rsync {count} changed files to deploy directory[CMD:{cmd}]....".format(count=len(files),
+                                                                                                   cmd=command))
+            self._run_shell_command(command, step=STEP_RSYNC)
+
+    def get_deleted_dirs(self, src_path, files):
+        """Directories of deleted files which do not exist in src_path any more
+
+        :param src_path: src directory
+        :param files: paths relative to src_path
+        :return: directories relative to src_path, deepest first
+        """
+        deleted_dirs = set()
+        for one_file in files:
+            if os.path.lexists(os.path.join(src_path, one_file)):
+                continue
+            one_dir = os.path.dirname(one_file)
+            while one_dir and not os.path.isdir(os.path.join(src_path, one_dir)):
+                deleted_dirs.add(one_dir)
+                one_dir = os.path.dirname(one_dir)
+        return sorted(deleted_dirs, key=lambda one_dir: (-one_dir.count('/'), one_dir))
+
+    def remove_empty_dirs(self, src_path, host, files):
+        """Remove directories left empty at host by deleted files, rsync --delete-missing-args deletes files only
+
+        Directories still containing files, e.g. excluded ones, are kept like rsync --delete does.
+
+        :param src_path: src directory
+        :param host: hostname
+        :param files: changed files synced by rsync_files
         :return:
         """
+        deleted_dirs = self.get_deleted_dirs(src_path, files)
+        if not deleted_dirs:
+            return
+
+        script = "cd {path} && rmdir {dirs} 2>/dev/null; true".format(
+            path=self._remote_deploy_path(),
+            dirs=' '.join(shlex.quote(one_dir) for one_dir in deleted_dirs))
+        logger_server.info("Remove {count} empty directories at {host}...".format(count=len(deleted_dirs),
+                                                                                  host=host))
+        self._run_at_host(host, script)
+
+    def _remote_deploy_path(self):
+        return "{path}{repo}".format(path=self.deploy_path, repo=self.repo_name)
+
+    def get_remote_revision(self, host):
+        """Read commit deployed at host from REVISION_FILENAME
+
+        :param host: hostname
+        :return: commit or None if unknown
+        """
+        command = "{ssh} deploy@{host} \"cat {path}/{filename} 2>/dev/null || true\"".format(
+            ssh=self._ssh_command(host),
+            host=host,
+            path=self._remote_deploy_path(),
+            filename=REVISION_FILENAME)
+        try:
+            output = self._run_shell_command(command, step=STEP_RSYNC)
+        except (CommandCancelled, StepTimeout):
+            raise
+        except RepositoryException as ex:
+            logger_server.info("Fail to read revision at {host}: {ex}".format(host=host, ex=str(ex)))
+            return None
+        # output may contain warnings of ssh
+        revisions = re.findall(r'\b[0-9a-f]{40}\b', output)
+        return revisions[-1] if revisions else None
 
-        # Delete first, ignore error if not exsit.
-        shutil.rmtree("/tmp/{repo_name}".format(repo_name=self.repo_name), ignore_errors=True)
+    def set_remote_revision(self, host, commit):
+        """Record commit deployed at host, or remove record if commit unknown
 
-        # TODO here i just untar package every time, to be optimized.
-        command = "tar -zxvf {release_package} -C /tmp/".format(release_package=release_package)
+        :param host: hostname
+        :param commit: commit or None
+        :return:
+        """
+        path = "{path}/{filename}".format(path=self._remote_deploy_path(), filename=REVISION_FILENAME)
+        if commit:
+            remote_command = "echo {commit} > {path}".format(commit=commit, path=path)
+        else:
+            remote_command = "rm -f {path}".format(path=path)
+        command = "{ssh} deploy@{host} \"{remote_command}\"".format(ssh=self._ssh_command(host),
+                                                                     host=host,
+                                                                     remote_command=remote_command)
+        self._run_shell_command(command, step=STEP_RSYNC)
+
+    def sync_to_host(self, src_path, host, exclude_file=None, change_files=None, base_commit=None,
+                     target_commit=None, release_name=None):
+        """Sync src_path to deploy directory of host
+
+        In SYNC_MODE delta only change_files are synced if host is known to be at base_commit, so sync time
+        scales with size of diff instead of size of repository. Otherwise, including first deploy to a host,
+        unknown diff, unusual paths or POST_ACTIONS which may change files out of diff, the whole tree is synced.
+        Record of host is removed before the sync and target_commit is recorded only after it succeeded, so an
+        interrupted sync is never taken as base of a delta.
+
+        In RELEASE_LAYOUT symlink src_path is synced to a new release directory and activated instead, see
+        _sync_to_release_dir.
+
+        :param src_path: directory to sync, without tailing os.sep
+        :param host: hostname
+        :param exclude_file: filename of exclude if exists
+        :param change_files: changed files between base_commit and target_commit
+        :param base_commit: commit host should be at before sync
+        :param target_commit: commit of src_path
+        :param release_name: name of release directory, default first 12 characters of target_commit
+        :return:
+        """
+        dest_path = "deploy@{host}:{deploy}".format(host=host, deploy=self.deploy_path)
+        if self.release_layout == LAYOUT_SYMLINK:
+            release_name = release_name or (target_commit or '')[:12]
+            if not release_name:
+                raise RepositoryException("Unknown release of {src_path} to {host}".format(src_path=src_path,
+                                                                                           host=host))
+            self._sync_to_release_dir(src_path, host, exclude_file, release_name)
+            return
+        if self.sync_mode == SYNC_BATCH:
+            self._sync_to_host_by_batch(src_path, host, exclude_file, target_commit)
+            return
+        if self.sync_mode != SYNC_DELTA:
+            self.rsync(src_path, dest_path, exclude_file)
+            return
+
+        delta = False
+        if change_files and base_commit and target_commit:
+            if self.post_actions:
+                logger_server.info("Post actions may change files out of diff, full sync to {host}".format(host=host))
+            elif any(one_file.startswith('"') for one_file in change_files):
+                logger_server.info("Unusual path in change files, full sync to {host}".format(host=host))
+            else:
+                remote_revision = self.get_remote_revision(host)
+                if remote_revision == base_commit:
+                    delta = True
+                else:
+                    logger_server.info("{host} is at {remote} instead of {base}, full sync".format(
+                        host=host, remote=remote_revision, base=base_commit))
+
+        # host tree is unknown until this sync finished
+        self.set_remote_revision(host, None)
+        if delta:
+            self.rsync_files(src_path, "deploy@{host}:{path}".format(host=host, path=self._remote_deploy_path()),
+                             change_files, exclude_file)
+            self.remove_empty_dirs(src_path, host, change_files)
+        else:
+            self.rsync(src_path, dest_path, exclude_file)
+        self.set_remote_revision(host, target_commit)
 
-        logger_server.info("Decompress release_package [CMD:{cmd}]...".format(cmd=command))
+    def _run_at_host(self, host, script, step=STEP_RSYNC):
+        return self._run_shell_command("{ssh} deploy@{host} \"{script}\"".format(ssh=self._ssh_command(host),
+                                                                                host=host,
+                                                                                script=script),
+                                       step=step)
 
-        self._run_shell_command(command=command)
+    def get_release_dir(self, release_name):
+        """Release directory relative to DEPLOY_PATH, repository tree is <release dir>/<repo_name>
 
-        self.rsync("/tmp/{repo_name}".format(repo_name=self.repo_name),
-                   "deploy@{host}:{deploy}".format(host=host, deploy=self.deploy_path),
-                   "/tmp/{repo_name}/{filename}".format(repo_name=self.repo_name,
-                                                        filename=self.exclude_filename) if self.exclude_filename else None)
+        """
+        return "releases/{repo}/{name}".format(repo=self.repo_name, name=release_name)
+
+    def get_prepare_release_script(self, release_name, deploy_path=None):
+        """Shell script creating release directory as hard links of current release
+
+        Hard links keep unchanged files and files excluded from rsync without copying, rsync replaces changed
+        files by new files so current release is not touched. Prints RELEASE_ACTIVE if the release is current,
+        or RELEASE_RETAINED if a complete release directory is retained, e.g. at a rollback to an older tag, which
+        can be activated without sync.
+
+        :param release_name: name of release
+        :param deploy_path: DEPLOY_PATH at host
+        :return: script
+        """
+        return "cd {deploy} && mkdir -p releases/{repo} && " \
+               "if [ x$(readlink {repo}) = x{release}/{repo} ]; then echo {active}; " \
+               "elif [ -f {release}/{complete} ] && [ -d {release}/{repo} ]; then echo {retained}; " \
+               "else rm -rf {release} && mkdir -p {release} && " \
+               "if [ -d {repo} ]; then cp -al {repo}/ {release}/{repo}; fi; fi".format(
+                   deploy=deploy_path or self.deploy_path,
+                   repo=self.repo_name,
+                   release=self.get_release_dir(release_name),
+                   complete=RELEASE_COMPLETE_FILENAME,
+                   active=RELEASE_ACTIVE,
+                   retained=RELEASE_RETAINED)
+
+    def get_activate_release_script(self, release_name, deploy_path=None):
+        """Shell script switching DEPLOY_PATH/<repo_name> symlink to release atomically
+
+        Current release is recorded in releases/.<repo_name>.previous for rollback, release is marked complete
+        by RELEASE_COMPLETE_FILENAME and old releases are removed except the newest KEEP_RELEASES. A deploy
+        directory which is not a symlink yet is moved to releases/<repo_name>/_initial first.
+
+        :param release_name: name of release
+        :param deploy_path: DEPLOY_PATH at host
+        :return: script
+        """
+        return "cd {deploy} && if [ -d {repo} ] && [ ! -L {repo} ]; then " \
+               "mkdir -p releases/{repo}/_initial && mv {repo} releases/{repo}/_initial/{repo} && " \
+               "ln -s releases/{repo}/_initial/{repo} {repo}; fi && " \
+               "readlink {repo} > releases/.{repo}.previous; touch {release} {release}/{complete} && " \
+               "ln -sfn {release}/{repo} .{repo}.tmp && mv -T .{repo}.tmp {repo} && " \
+               "ls -1t releases/{repo} | tail -n +{keep} | while read old; do " \
+               "[ releases/{repo}/$old/{repo} = $(readlink {repo}) ] || " \
+               "[ releases/{repo}/$old/{repo} = $(cat releases/.{repo}.previous) ] || " \
+               "rm -rf releases/{repo}/$old; done".format(deploy=deploy_path or self.deploy_path,
+                                                          repo=self.repo_name,
+                                                          release=self.get_release_dir(release_name),
+                                                          complete=RELEASE_COMPLETE_FILENAME,
+                                                          keep=self.keep_releases + 1)
+
+    def get_rollback_release_script(self, release_name, deploy_path=None):
+        """Shell script switching symlink back to previous release if release is current
+
+        Prints RELEASE_NOT_ACTIVE if release was not activated, then current release is still the old one.
+
+        :param release_name: name of release to roll back
+        :param deploy_path: DEPLOY_PATH at host
+        :return: script
+        """
+        return "cd {deploy} && if [ x$(readlink {repo}) = x{release}/{repo} ] && [ -s releases/.{repo}.previous ]; " \
+               "then ln -sfn $(cat releases/.{repo}.previous) .{repo}.tmp && mv -T .{repo}.tmp {repo}; " \
+               "else echo {not_active}; fi".format(deploy=deploy_path or self.deploy_path,
+                                                   repo=self.repo_name,
+                                                   release=self.get_release_dir(release_name),
+                                                   not_active=RELEASE_NOT_ACTIVE)
+
+    def _sync_to_release_dir(self, src_path, host, exclude_file, release_name):
+        """Stage src_path in a new release directory at host, then switch to it
+
+        Live deploy directory is never modified, services see either the old or the new tree. A complete release
+        directory retained at host is activated directly.
+
+        :param src_path: directory to sync
+        :param host: hostname
+        :param exclude_file: filename of exclude if exists
+        :param release_name: name of release
+        :return:
+        """
+        logger_server.info("Prepare release {release} at {host}...".format(release=release_name, host=host))
+        output = self._run_at_host(host, self.get_prepare_release_script(release_name))
+        if RELEASE_ACTIVE in output:
+            logger_server.info("Release {release} is active at {host}".format(release=release_name, host=host))
+            return
+
+        if RELEASE_RETAINED in output:
+            logger_server.info("Release {release} is retained at {host}, skip sync".format(release=release_name,
+                                                                                         host=host))
+        else:
+            self.rsync(src_path,
+                       "deploy@{host}:{deploy}{release}/".format(host=host,
+                                                                deploy=self.deploy_path,
+                                                                release=self.get_release_dir(release_name)),
+                       exclude_file)
+
+        logger_server.info("Activate release {release} at {host}...".format(release=release_name, host=host))
+        self._run_at_host(host, self.get_activate_release_script(release_name))
+
+    def rollback_release(self, host, release_name):
+        """Switch host back to previous release
+
+        :param host: hostname
+        :param release_name: name of release to roll back
+        :return:
+        """
+        logger_server.info("Roll back release {release} at {host}...".format(release=release_name, host=host))
+        if RELEASE_NOT_ACTIVE in self._run_at_host(host, self.get_rollback_release_script(release_name)):
+            logger_server.info("Release {release} is not active at {host}, nothing to roll back".format(
+                release=release_name, host=host))
 
-        self._run_shell_command(command=command)
+    def _sync_to_host_by_batch(self, src_path, host, exclude_file, target_commit):
+        """Replay batch computed against mirror at host, full sync if host is not at commit of mirror
 
-        shutil.rmtree("/tmp/{repo_name}".format(repo_name=self.repo_name), ignore_errors=True)
+        Revision file is the only hint that host tree is identical to mirror, if host tree drifted anyway and
+        replay fails, host is fully synced instead.
+
+        :param src_path: directory to sync
+        :param host: hostname
+        :param exclude_file: filename of exclude if exists
+        :param target_commit: commit of src_path
+        :return:
+        """
+        batch = self.write_batch(src_path, exclude_file, target_commit) if target_commit else None
+
+        remote_revision = self.get_remote_revision(host) if batch and batch['batch'] else None
+        # host tree is unknown until this sync finished
+        self.set_remote_revision(host, None)
+
+        applied = False
+        if batch and batch['batch']:
+            if remote_revision == batch['base']:
+                try:
+                    self.apply_batch(batch['batch'], host, exclude_file)
+                    applied = True
+                except (CommandCancelled, StepTimeout):
+                    raise
+                except RepositoryException as ex:
+                    logger_server.info("Fail to replay batch at {host}, full sync: {ex}".format(host=host,
+                                                                                               ex=str(ex)))
+            else:
+                logger_server.info("{host} is at {remote} instead of {base}, full sync".format(
+                    host=host, remote=remote_revision, base=batch['base']))
+
+        if not applied:
+            self.rsync(src_path, "deploy@{host}:{deploy}".format(host=host, deploy=self.deploy_path), exclude_file)
+        self.set_remote_revision(host, target_commit)
+
+    def _get_mirror_path(self):
+        return "{mirror}{repo}_{branch}".format(mirror=self.mirror_path, repo=self.repo_name, branch=self.branch)
+
+    def write_batch(self, src_path, exclude_file, target_commit):
+        """Sync src_path to local mirror of the last deployed tree and record the changes in a batch file once
+
+        Hosts released concurrently wait for the first writer and then share the batch. The batch can only be
+        replayed to a tree identical to mirror before the sync, which is recorded by REVISION_FILENAME of mirror.
+
+        :param src_path: directory to sync
+        :param exclude_file: filename of exclude if exists
+        :param target_commit: commit of src_path
+        :return: {'batch': batch file or None if mirror was unknown, 'base': commit of mirror before sync}
+        """
+        with self._batch_lock:
+            if target_commit not in self._batches:
+                self._batches[target_commit] = {'lock': threading.Lock(), 'done': False, 'batch': None, 'base': None}
+            batch = self._batches[target_commit]
+
+        with batch['lock']:
+            if batch['done']:
+                return batch
+
+            mirror_path = self._get_mirror_path()
+            revision_file = os.path.join(mirror_path, REVISION_FILENAME)
+            base_commit = None
+            if os.path.exists(revision_file):
+                with open(revision_file) as f:
+                    base_commit = f.read().strip() or None
+            else:
+                os.makedirs(mirror_path, exist_ok=True)
+            # mirror is unknown until this sync finished
+            if base_commit:
+                os.remove(revision_file)
+
+            batch_file = None
+            write_batch = ""
+            if base_commit:
+                batch_file = "{staging}{repo}/batch_{commit}".format(staging=self.staging_path, repo=self.repo_name,
+                                                                     commit=target_commit)
+                os.makedirs(os.path.dirname(batch_file), exist_ok=True)
+                write_batch = "--write-batch={batch_file}".format(batch_file=batch_file)
+
+            command = "rsync -a --delete {write_batch} --exclude=/{revision} {exclude} {src_path}/ " \
+                      "{mirror_path}/".format(write_batch=write_batch,
+                                              revision=REVISION_FILENAME,
+                                              exclude="--exclude-from={file}".format(
+                                                  file=exclude_file) if exclude_file else "",
+                                              src_path=src_path.rstrip(os.sep),
+                                              mirror_path=mirror_path)
+
+            logger_server.info("Rsync to mirror {batch}[CMD:{cmd}]....".format(
+                batch="and write batch " if batch_file else "", cmd=command))
+            self._run_shell_command(command, step=STEP_RSYNC)
+
+            with open(revision_file, 'w') as f:
+                f.write(target_commit)
+
+            batch['batch'] = batch_file
+            batch['base'] = base_commit
+            batch['done'] = True
+            return batch
+
+    def apply_batch(self, batch_file, host, exclude_file=None):
+        """Ship batch file to host and replay it to deploy directory
+
+        Receiver options are not stored in batch, so replay uses the same --delete and exclude rules as
+        write_batch, exclude file is shipped along with batch. Otherwise deletions are skipped or, with --delete
+        only, excluded files and revision file at host are deleted.
+
+        :param batch_file: batch file written by write_batch
+        :param host: hostname
+        :param exclude_file: filename of exclude if exists
+        :return:
+        """
+        remote_dir = "/tmp/niner_{repo}_{filename}".format(repo=self.repo_name,
+                                                           filename=os.path.basename(batch_file))
+        remote_batch = "{dir}/{filename}".format(dir=remote_dir, filename=os.path.basename(batch_file))
+        remote_exclude = "--exclude-from={dir}/{filename}".format(
+            dir=remote_dir, filename=os.path.basename(exclude_file)) if exclude_file else ""
+
+        command = "rsync -a -e \"{ssh}\" {batch_file} {exclude_file} deploy@{host}:{remote_dir}/".format(
+            ssh=self._ssh_command(host),
+            batch_file=batch_file,
+            exclude_file=exclude_file or "",
+            host=host,
+            remote_dir=remote_dir)
+        logger_server.info("Ship batch to {host}[CMD:{cmd}]....".format(host=host, cmd=command))
+        self._run_shell_command(command, step=STEP_RSYNC)
+
+        command = "{ssh} deploy@{host} \"rsync -a --delete --read-batch={remote_batch} --exclude=/{revision} " \
+                  "{exclude} {path}/; code=$?; rm -rf {remote_dir}; exit $code\"".format(
+                      ssh=self._ssh_command(host),
+                      host=host,
+                      remote_batch=remote_batch,
+                      revision=REVISION_FILENAME,
+                      exclude=remote_exclude,
+                      path=self._remote_deploy_path(),
+                      remote_dir=remote_dir)
+        logger_server.info("Replay batch at {host}[CMD:{cmd}]....".format(host=host, cmd=command))
+        self._run_shell_command(command, step=STEP_RSYNC)
+
+    def clear_batches(self):
+        """Remove batch files of last deployment
+
+        """
+        with self._batch_lock:
+            for target_commit, batch in self._batches.items():
+                if batch['batch']:
+                    # rsync writes a shell script next to batch file
+                    for one_file in (batch['batch'], batch['batch'] + '.sh'):
+                        if os.path.exists(one_file):
+                            os.remove(one_file)
+            self._batches = {}
+
+    def stage_package(self, package):
+        """Decompress package into staging directory once
+
+        Packages are staged in STAGING_PATH/<repo_name>/<package name>, hosts released concurrently wait for
+        the first extraction and then share the result.
+
+        :param package: tar.gz file of package or backup, or snapshot directory of backup
+        :return: path of repository directory in staging directory
+        """
+        if os.path.isdir(package):
+            # snapshot is released as it is
+            return "{snapshot}/{repo_name}".format(snapshot=package.rstrip(os.sep), repo_name=self.repo_name)
+
+        package_name = os.path.basename(package)
+        if package_name.endswith('.tar.gz'):
+            package_name = package_name[:-len('.tar.gz')]
+
+        with self._staging_lock:
+            if package_name not in self._staged_packages:
+                self._staged_packages[package_name] = {'lock': threading.Lock(), 'path': None}
+            staged = self._staged_packages[package_name]
+
+        with staged['lock']:
+            if not staged['path']:
+                staged_path = "{staging}{repo_name}/{package_name}".format(staging=self.staging_path,
+                                                                           repo_name=self.repo_name,
+                                                                           package_name=package_name)
+                partial_path = staged_path + '.partial'
+
+                # Remove leftovers of last deploy, ignore error if not exist.
+                shutil.rmtree(staged_path, ignore_errors=True)
+                shutil.rmtree(partial_path, ignore_errors=True)
+                os.makedirs(partial_path)
+
+                command = "tar -zxvf {package} -C {partial_path}".format(package=package, partial_path=partial_path)
+
+                logger_server.info("Decompress package to staging directory [CMD:{cmd}]...".format(cmd=command))
+
+                self._run_shell_command(command=command, step=STEP_TAR)
+
+                os.rename(partial_path, staged_path)
+                staged['path'] = staged_path
+
+        return "{staged_path}/{repo_name}".format(staged_path=staged['path'], repo_name=self.repo_name)
+
+    def clear_staged_packages(self):
+        """Remove all staged packages of this repository
+
+        """
+        with self._staging_lock:
+            for package_name, staged in self._staged_packages.items():
+                if staged['path']:
+                    logger_server.info("Remove staged package {path}...".format(path=staged['path']))
+                    shutil.rmtree(staged['path'], ignore_errors=True)
+            self._staged_packages = {}
+
+    def release(self, release_package, host, change_files=None, base_commit=None, target_commit=None,
+                release_name=None):
+        """Release release_file to deploy_path
+
+        :param release_package: package to release
+        :param host: hostname to release
+        :param change_files: changed files between base_commit and target_commit, see sync_to_host
+        :param base_commit: commit host should be at before release
+        :param target_commit: commit of package
+        :param release_name: name of release directory, see sync_to_host
+        :return:
+        """
+        src_path = self.stage_package(release_package)
+
+        self.sync_to_host(src_path,
+                          host,
+                          "{src_path}/{filename}".format(src_path=src_path,
+                                                         filename=self.exclude_filename) if self.exclude_filename else None,
+                          change_files,
+                          base_commit,
+                          target_commit,
+                          release_name)
 
         return
 
@@ -0,0 +1,200 @@
+__author__ = 'magus0219'
+import itertools
+import logging
+import threading
+import time
+from config import SERVER_CONFIG as _SERVER_CFG
+from utils.enums import DeployStrategy
+
+logger_server = logging.getLogger("DeployServer.Scheduler")
+
+# Priority classes, the lower number is, the earlier job is admitted
+PRIORITY_PRODUCTION = 0
+PRIORITY_TEST = 1
+
+
+class JobState():
+    QUEUED = 'queued'
+    RUNNING = 'running'
+
+
+class DeployJob():
+    _ids = itertools.count(1)
+
+    def __init__(self, repo_name, branch, event_id, priority, hosts):
+        """A deployment waiting for or holding a slot of scheduler
+
+        :param repo_name:
+        :param branch:
+        :param event_id: event id of payload
+        :param priority: priority class
+        :param hosts: hostnames the deployment writes to, held exclusively while running
+        """
+        self.job_id = next(DeployJob._ids)
+        self.repo_name = repo_name
+        self.branch = branch
+        self.event_id = event_id
+        self.priority = priority
+        self.hosts = set(hosts)
+        self.state = JobState.QUEUED
+        self.enqueue_time = time.time()
+        self.admit_time = None
+        self.aborted = False
+
+    def export(self):
+        now = time.time()
+        return {'job_id': self.job_id,
+                'repo_name': self.repo_name,
+                'branch': self.branch,
+                'event_id': self.event_id,
+                'priority': self.priority,
+                'hosts': sorted(self.hosts),
+                'state': self.state,
+                'enqueue_time': self.enqueue_time,
+                'admit_time': self.admit_time,
+                'waited': round((self.admit_time or now) - self.enqueue_time, 3),
+                'running': round(now - self.admit_time, 3) if self.admit_time else 0}
+
+    def __repr__(self):
+        return "<DeployJob {job_id} {repo}/{branch} Event[{event_id}] {state}>".format(job_id=self.job_id,
+                                                                                    repo=self.repo_name,
+                                                                                    branch=self.branch,
+                                                                                    event_id=self.event_id,
+                                                                                    state=self.state)
+
+
+class DeployScheduler():
+    def __init__(self, max_concurrent):
+        """Admission control of deployments of all repositories
+
+        At most max_concurrent deployments run at the same time, so packing and rsync of many repositories pushed
+        together do not saturate disk and network of deploy server. Deployments sharing a host never run at the
+        same time.
+
+        Queued jobs are admitted by priority then enqueue time. A job whose hosts are busy does not block later
+        jobs on other hosts, but its hosts are reserved so later jobs can not starve it.
+
+        :param max_concurrent: max running deployments, 0 or None means no limit
+        """
+        self.max_concurrent = max_concurrent
+        self._jobs = []
+        self._condition = threading.Condition()
+        self.admitted = 0
+        self.total_wait = 0
+        self.max_wait = 0
+
+    @staticmethod
+    def get_priority(repo):
+        """Priority class of deployments of repository, DEPLOY_PRIORITY in repository config overrides strategy
+
+        :param repo: Repository
+        :return: priority
+        """
+        if repo.deploy_priority is not None:
+            return repo.deploy_priority
+        if repo.strategy == DeployStrategy.PRO_MODE:
+            return PRIORITY_PRODUCTION
+        return PRIORITY_TEST
+
+    def _schedule(self):
+        """Admit queued jobs which can run now, called with condition held
+
+        :return:
+        """
+        running = [one_job for one_job in self._jobs if one_job.state == JobState.RUNNING]
+        busy_hosts = set()
+        for one_job in running:
+            busy_hosts |= one_job.hosts
+        running_count = len(running)
+
+        queued = sorted([one_job for one_job in self._jobs if one_job.state == JobState.QUEUED],
+                        key=lambda one_job: (one_job.priority, one_job.enqueue_time, one_job.job_id))
+        admitted = False
+        for one_job in queued:
+            if self.max_concurrent and running_count >= self.max_concurrent:
+                break
+            if one_job.hosts & busy_hosts:
+                # reserve hosts for this job
+                busy_hosts |= one_job.hosts
+                continue
+
+            one_job.state = JobState.RUNNING
+            one_job.admit_time = time.time()
+            wait = one_job.admit_time - one_job.enqueue_time
+            self.admitted += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            busy_hosts |= one_job.hosts
+            running_count += 1
+            admitted = True
+            logger_server.info("Admit {job} after {wait:.1f}s".format(job=one_job, wait=wait))
+
+        if admitted:
+            self._condition.notify_all()
+
+    def admit(self, repo, event_id, should_abort=None):
+        """Wait until deployment can run
+
+        :param repo: Repository to deploy
+        :param event_id: event id of payload
+        :param should_abort: function returning True to stop waiting, e.g. deployment canceled
+        :return: DeployJob to release after deployment, None if aborted
+        """
+        one_job = DeployJob(repo.repo_name, repo.branch, event_id, self.get_priority(repo), repo.hosts)
+        with self._condition:
+            self._jobs.append(one_job)
+            self._schedule()
+            if one_job.state == JobState.QUEUED:
+                logger_server.info("Queue {job}, {running} deployments running".format(
+                    job=one_job, running=self._count(JobState.RUNNING)))
+
+            while one_job.state == JobState.QUEUED:
+                if should_abort and should_abort():
+                    self._jobs.remove(one_job)
+                    one_job.aborted = True
+                    logger_server.info("Abort {job}".format(job=one_job))
+                    self._schedule()
+                    return None
+                self._condition.wait()
+        return one_job
+
+    def release(self, one_job):
+        """Release slot and hosts of a finished job
+
+        :param one_job: DeployJob returned by admit
+        :return:
+        """
+        with self._condition:
+            if one_job in self._jobs:
+                self._jobs.remove(one_job)
+                logger_server.info("Release {job} after {running:.1f}s".format(job=one_job,
+                                                                               running=time.time() - one_job.admit_time))
+            self._schedule()
+
+    def wake(self):
+        """Wake waiting jobs to check should_abort
+
+        """
+        with self._condition:
+            self._condition.notify_all()
+
+    def _count(self, state):
+        return len([one_job for one_job in self._jobs if one_job.state == state])
+
+    def export_status(self):
+        with self._condition:
+            running = [one_job.export() for one_job in self._jobs if one_job.state == JobState.RUNNING]
+            queued = [one_job.export() for one_job in sorted(self._jobs,
+                                                             key=lambda one_job: (one_job.priority,
+                                                                                  one_job.enqueue_time,
+                                                                                  one_job.job_id))
+                      if one_job.state == JobState.QUEUED]
+            return {'max_concurrent': self.max_concurrent,
+                    'running': running,
+                    'queued': queued,
+                    'admitted': self.admitted,
+                    'max_wait': round(self.max_wait, 3),
+                    'avg_wait': round(self.total_wait / self.admitted, 3) if self.admitted else 0}
+
+
+scheduler = DeployScheduler(_SERVER_CFG.get('MAX_CONCURRENT_DEPLOYS', 2))
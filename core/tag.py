@@ -13,6 +13,37 @@ str_text = """
 """
 
 
+def release_tag_cmp(release_tag):
+    nums = release_tag[1:].split('.')
+    major = int(nums[0])
+    minor = int(nums[1])
+    patch = int(nums[2])
+
+    return major * 10000 * 10000 + minor * 10000 + patch
+
+
+def parse_git_time(timestamp, offset):
+    """Parse raw git time like '1430883775 +0800' to a datetime with timezone
+
+    :param timestamp: seconds since epoch
+    :param offset: timezone offset like +0800
+    :return: datetime
+    """
+    offset_delta = datetime.timedelta(hours=int(offset[1:3]), minutes=int(offset[3:5]))
+    if offset[0] == '-':
+        offset_delta = -offset_delta
+    return datetime.datetime.fromtimestamp(int(timestamp), datetime.timezone(offset_delta))
+
+
+def strip_signature(message):
+    """Remove PGP signature of a signed tag message
+
+    :param message: tag message
+    :return: message without signature
+    """
+    return message.split('-----BEGIN PGP SIGNATURE-----')[0]
+
+
 class Tag():
     def __init__(self, name, author, email, commit_id, desc, tag_time):
         self.name = name
@@ -83,6 +114,50 @@ class Tag():
         else:
             return None
 
+    @staticmethod
+    def create_by_tag_object(tag_object, commit_id=None):
+        """Create a tag object by parsing content of an annotated tag object
+
+        Example of output of git cat-file tag tagname here:
+        ================================================
+        object 04591b7527b85182dc517e1068e4cc94bd7d38d4
+        type commit
+        tag r0.0.3
+        tagger Arthur.Qin <magus0219@gmail.com> 1430883775 +0800
+
+        release3
+        ================================================
+        :param tag_object: content of tag object
+        :param commit_id: commit the tag finally points to, using object in tag if None
+        """
+        name = None
+        author = None
+        email = None
+        desc = None
+        tag_time = None
+
+        header, _, message = tag_object.partition('\n\n')
+
+        for one_line in header.split('\n'):
+            key, _, value = one_line.partition(' ')
+            if key == 'object' and commit_id is None:
+                commit_id = value
+            elif key == 'tag':
+                name = value
+            elif key == 'tagger':
+                rst = re.match('(.+)\s<(.*)>\s(\d+)\s([+-]\d{4})$', value)
+                if rst:
+                    author = rst.group(1)
+                    email = rst.group(2)
+                    tag_time = parse_git_time(rst.group(3), rst.group(4))
+
+        desc = strip_signature(message)
+
+        if name:
+            return Tag(name, author, email, commit_id, desc, tag_time)
+        else:
+            return None
+
     def __repr__(self):
         return self.name
 
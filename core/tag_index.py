@@ -0,0 +1,172 @@
+__author__ = 'magus0219'
+import bisect
+import logging
+import re
+import threading
+from core.tag import Tag, release_tag_cmp, parse_git_time, strip_signature
+
+logger_server = logging.getLogger("DeployServer.TagIndex")
+
+RELEASE_TAG_PATTERN = r'^r\d+\.\d+\.\d+$'
+
+# fields of one tag separated by NUL, records terminated by RS
+TAG_FIELDS = ['%(refname)', '%(objecttype)', '%(*objectname)', '%(taggername)', '%(taggeremail)',
+              '%(taggerdate:raw)', '%(contents)']
+TAG_FORMAT = '%00'.join(TAG_FIELDS) + '%1e'
+
+
+class TagIndex():
+    def __init__(self, repo):
+        """Index of annotated tags of a repository
+
+        All annotated tags are loaded by one git for-each-ref at first use, release tags(r*.*.*) are kept
+        sorted by release_tag_cmp. Tag pushes and deletions update the index incrementally, tags pushed but not
+        fetched yet are kept pending and read by git object reader on next query. Fetch and pull may bring tags
+        without any push event, e.g. a missed webhook, so they invalidate the index and it is loaded again on
+        next query.
+
+        :param repo: Repository object
+        """
+        self.repo = repo
+        self._lock = threading.RLock()
+        self._loaded = False
+        self._pending = set()
+        self._tags = {}  # tag name -> Tag
+        self._commit_tags = {}  # commit id -> set of tag names
+        self._release_keys = []  # ascending release_tag_cmp keys
+        self._release_names = []  # release tag names in the same order of _release_keys
+
+    def load(self):
+        """Load all annotated tags by one git for-each-ref
+
+        :return:
+        """
+        command = "git for-each-ref --format={format} refs/tags".format(format=TAG_FORMAT)
+
+        logger_server.info("Load tags of {repo} [CMD:{cmd}]...".format(repo=self.repo.repo_name, cmd=command))
+
+        content = self.repo._run_shell_command(command=command, cwd=self.repo.git_path)
+
+        with self._lock:
+            self._tags = {}
+            self._commit_tags = {}
+            self._release_keys = []
+            self._release_names = []
+
+            for one_record in content.split('\x1e\n'):
+                fields = one_record.split('\x00')
+                if len(fields) != len(TAG_FIELDS):
+                    continue
+
+                refname, object_type, commit_id, author, email, tag_date, message = fields
+                # lightweight tag is not recognized
+                if object_type != 'tag':
+                    continue
+
+                tag_time = None
+                if tag_date:
+                    timestamp, offset = tag_date.split(' ')
+                    tag_time = parse_git_time(timestamp, offset)
+
+                self._add(Tag(refname[len('refs/tags/'):], author, email.strip('<>'), commit_id,
+                              strip_signature(message), tag_time))
+
+            # tags fetched meanwhile need not be read one by one
+            self._pending.difference_update(self._tags)
+            self._loaded = True
+
+    def _add(self, tag):
+        self._remove(tag.name)
+
+        self._tags[tag.name] = tag
+        self._commit_tags.setdefault(tag.commit_id, set()).add(tag.name)
+
+        if re.match(RELEASE_TAG_PATTERN, tag.name):
+            key = release_tag_cmp(tag.name)
+            index = bisect.bisect_left(self._release_keys, key)
+            self._release_keys.insert(index, key)
+            self._release_names.insert(index, tag.name)
+
+    def _remove(self, tag_name):
+        tag = self._tags.pop(tag_name, None)
+        if not tag:
+            return
+
+        names = self._commit_tags.get(tag.commit_id)
+        if names:
+            names.discard(tag_name)
+            if not names:
+                del self._commit_tags[tag.commit_id]
+
+        if tag_name in self._release_names:
+            index = self._release_names.index(tag_name)
+            del self._release_keys[index]
+            del self._release_names[index]
+
+    def _ensure_fresh(self):
+        """Load index at first use and apply pending tags which can be read now
+
+        """
+        if not self._loaded:
+            self.load()
+
+        for tag_name in list(self._pending):
+            tag = self.repo.get_tag_info(tag_name)
+            if tag:
+                self._add(tag)
+                self._pending.discard(tag_name)
+
+    def invalidate(self):
+        """Load all tags again on next query, called after local repository fetched
+
+        :return:
+        """
+        with self._lock:
+            self._loaded = False
+
+    def add_pending(self, tag_name):
+        """Record a pushed tag, it will be indexed once it exists in local repository
+
+        :param tag_name:
+        :return:
+        """
+        with self._lock:
+            self._pending.add(tag_name)
+
+    def remove(self, tag_name):
+        """Remove a deleted tag
+
+        :param tag_name:
+        :return:
+        """
+        with self._lock:
+            self._pending.discard(tag_name)
+            self._remove(tag_name)
+
+    def get_last_release_tags(self, size):
+        """Get last release tags
+
+        :param size: number of tags
+        :return: list of tag objects, descending by version
+        """
+        with self._lock:
+            self._ensure_fresh()
+            names = self._release_names[-size:] if size > 0 else []
+            return [self._tags[one_name] for one_name in reversed(names)]
+
+    def get_commit_tag(self, commit_id):
+        """Get tag of commit, the highest release tag is preferred if more than one tags
+
+        :param commit_id: full commit id
+        :return: tag object or None
+        """
+        with self._lock:
+            self._ensure_fresh()
+            names = self._commit_tags.get(commit_id)
+            if not names:
+                return None
+
+            release_names = [one_name for one_name in names if re.match(RELEASE_TAG_PATTERN, one_name)]
+            if release_names:
+                return self._tags[max(release_names, key=release_tag_cmp)]
+            return self._tags[sorted(names)[-1]]
@@ -0,0 +1,109 @@
+__author__ = 'magus0219'
+import logging
+from config import DEBUG as _DEBUG
+
+logger_server = logging.getLogger("DeployServer.WavePlanner")
+
+
+class WavePlanner():
+    def __init__(self, repo):
+        """Plan rolling waves of hosts for a repository
+
+        Waves are released one after another while hosts inside one wave are released concurrently.
+        Limits used to build waves:
+            CANARY_HOST: a single host released before any other, hostname or True to use the first host
+            WAVE_ROLE_PERCENT: max percent of hosts of one role in a wave, e.g. {"web": 25}
+            MAX_PARALLEL_HOSTS: max size of a wave
+        Besides, a wave never contains every host of a service which runs on more than one host, so the
+        service always has a host online.
+
+        :param repo: Repository object
+        """
+        self.repo = repo
+
+    def _get_canary(self, hosts):
+        canary = self.repo.canary_host
+        if canary is True:
+            return hosts[0] if hosts else None
+        elif canary in hosts:
+            return canary
+        elif canary:
+            logger_server.info("Canary host {host} is not in host list".format(host=canary))
+        return None
+
+    def _get_role_limits(self, hosts):
+        """Max hosts of every limited role in one wave
+
+        :param hosts: hostnames
+        :return: {role: limit}
+        """
+        role_limits = {}
+        for role, percent in self.repo.wave_role_percent.items():
+            role_count = len([host for host in hosts if role in self.repo.hosts_roles[host]])
+            role_limits[role] = max(1, int(role_count * percent / 100))
+        return role_limits
+
+    def _get_service_limits(self, hosts):
+        """Max hosts of every service in one wave, leave at least one host online
+
+        :param hosts: hostnames
+        :return: {service: (service_hosts, limit)}
+        """
+        service_limits = {}
+        for service, service_hosts in self.repo.service_index.items():
+            service_hosts = set(service_hosts) & set(hosts)
+            if len(service_hosts) > 1:
+                service_limits[service] = (service_hosts, len(service_hosts) - 1)
+        return service_limits
+
+    def _fit(self, wave, host, role_limits, service_limits):
+        if len(wave) >= max(1, self.repo.max_parallel_hosts):
+            return False
+
+        for role in self.repo.hosts_roles[host]:
+            if role in role_limits:
+                role_count = len([one_host for one_host in wave if role in self.repo.hosts_roles[one_host]])
+                if role_count + 1 > role_limits[role]:
+                    return False
+
+        for service_hosts, limit in service_limits.values():
+            if host in service_hosts:
+                if len(service_hosts & set(wave)) + 1 > limit:
+                    return False
+
+        return True
+
+    def plan(self, hosts):
+        """Split hosts into waves
+
+        Hosts are placed into the first wave they fit in, so host order is kept as much as possible.
+
+        :param hosts: hostnames
+        :return: list of waves, each wave is a list of hostnames
+        """
+        hosts = list(hosts)
+        waves = []
+
+        canary = self._get_canary(hosts)
+        if canary:
+            waves.append([canary])
+            hosts.remove(canary)
+
+        role_limits = self._get_role_limits(hosts)
+        service_limits = self._get_service_limits(hosts)
+
+        rolling_waves = []
+        for one_host in hosts:
+            for one_wave in rolling_waves:
+                if self._fit(one_wave, one_host, role_limits, service_limits):
+                    one_wave.append(one_host)
+                    break
+            else:
+                rolling_waves.append([one_host])
+
+        waves.extend(rolling_waves)
+
+        if _DEBUG:
+            logger_server.debug("waves:" + str(waves))
+
+        return waves
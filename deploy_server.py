@@ -47,6 +47,10 @@ if __name__ == "__main__":
         application.listen(listen_port)
         tornado.ioloop.IOLoop.instance().start()
     except KeyboardInterrupt as e:
+        from core.deploy_manager import dmc
+
+        logger_server.info("Waiting for running deployments to finish...")
+        dmc.shutdown()
         logger_server.info("DeployServer Stopped...")
     except Exception as e:
         logger_server.exception(str(e))
@@ -7,4 +7,5 @@ from .rollback_handler import RollbackHandler
 from .login_handler import LoginHandler
 from .logout_handler import LogoutHandler
 from .register_handler import RegisterHandler
-from .chpwd_handler import ChangePasswordHandler
\ No newline at end of file
+from .chpwd_handler import ChangePasswordHandler
+from .scheduler_handler import SchedulerHandler
\ No newline at end of file
@@ -5,7 +5,6 @@ from config import DEBUG as _DEBUG, GITHUB as _GITHUB_CFG
 from .common_handler import CommonHandler
 from core.deploy_manager import dmc
 from core.payload import PayLoad
-import threading
 import json
 import hmac
 from utils.mongo_handler import mongodb_client
@@ -43,20 +42,27 @@ class DeployHandler(CommonHandler):
                 logger_server.debug("Auth pass..")
             self.payload = json.loads(self.request.body.decode("utf8"))
             payload = PayLoad.create_by_payload(self.delivery_uuid, self.event, self.payload)
+            if payload is None:
+                # deleted branch or tag
+                if self.payload['ref'].startswith('refs/tags/'):
+                    dmc.handle_tag_delete(self.payload['repository']['name'],
+                                          self.payload['ref'][len('refs/tags/'):])
+                return
             if _DEBUG == True:
                 logger_server.debug("Is Tag:{istag}".format(istag=str(payload.is_tag)))
             repo_name = payload.repository_name
             if _DEBUG == True:
                 logger_server.debug("Repo Name:{repo_name}".format(repo_name=repo_name))
+            if payload:
+                dmc.handle_tag_push(payload)
             if payload and dmc.need_handle_payload(payload):
                 # Logging to db
                 mongodb_client['deployment']['webhook'].insert({'event': self.event,
                                                                 'signature': self.signature,
                                                                 'delivery_uuid': self.delivery_uuid,
                                                                 'payload': self.payload})
-                t = threading.Thread(target=dmc.get_dm_by_payload(payload).handle_event,
-                                     args=(self.delivery_uuid, self.event, payload))
-                t.start()
+                # Only queued here, deploy worker of the repository runs it
+                dmc.get_dm_by_payload(payload).handle_event(self.delivery_uuid, self.event, payload)
 
 
 
@@ -17,9 +17,7 @@ class OperationHandler(CommonHandler):
         if repo_name in dmc and branch in dmc[repo_name]:
             dm = dmc[repo_name][branch]
             if operation == 'cancel':
-                dm.status.lock_acquire()
-                dm.status.set_cancel_flag(True)
-                dm.status.lock_release()
+                dm.cancel()
 
                 # log to db
                 mongodb_client['deployment']['operation_log'].insert({
@@ -35,9 +33,50 @@ class OperationHandler(CommonHandler):
                 return
 
             elif operation == 'enable_auto':
-                dm.status.lock_acquire()
-                dm.status.enable_auto_deploy()
-                dm.status.lock_release()
+                dm.enable_auto_deploy()
+
+            elif operation in ('resume', 'rollback_interrupted', 'discard_interrupted'):
+                if operation == 'resume':
+                    done = dm.resume_interrupted_task()
+                elif operation == 'rollback_interrupted':
+                    done = dm.rollback_interrupted_task()
+                else:
+                    done = dm.discard_interrupted_task()
+                if not done:
+                    self.set_status(404)
+                    return
+
+                # log to db
+                mongodb_client['deployment']['operation_log'].insert({
+                    "userId": self.get_current_user().user_id,
+                    "username": self.get_current_user().username,
+                    "repoName": repo_name,
+                    "branch": branch,
+                    "operation": operation,
+                    "createTimeStamp": int(time.time())
+                })
+
+            elif operation == 'set_debounce':
+                try:
+                    seconds = int(self.get_body_argument('seconds', '0'))
+                except ValueError:
+                    seconds = -1
+                if seconds < 0:
+                    self.set_status(400)
+                    return
+
+                dm.set_debounce_seconds(seconds)
+
+                # log to db
+                mongodb_client['deployment']['operation_log'].insert({
+                    "userId": self.get_current_user().user_id,
+                    "username": self.get_current_user().username,
+                    "repoName": repo_name,
+                    "branch": branch,
+                    "operation": operation,
+                    "debounceSeconds": seconds,
+                    "createTimeStamp": int(time.time())
+                })
 
             elif operation == 'disable_auto':
                 dm.status.lock_acquire()
@@ -68,6 +107,13 @@ class OperationHandler(CommonHandler):
                 else:
                     task_running = status["task_running"].head_commit
 
+                if not status["task_interrupted"]:
+                    task_interrupted = ''
+                elif status["task_interrupted"].tag:
+                    task_interrupted = status["task_interrupted"].tag
+                else:
+                    task_interrupted = status["task_interrupted"].head_commit
+
                 fresh_status = {
                     "status": status["status"],
                     "hosts_status": status["hosts_status"],
@@ -77,7 +123,14 @@ class OperationHandler(CommonHandler):
                     "cancel_flag": status["cancel_flag"],
                     "auto_deploy_enable": status["auto_deploy_enable"],
                     "task_running": task_running,
+                    "task_interrupted": task_interrupted,
                     "process_percent": status["process_percent"],
+                    "waves": status["waves"],
+                    "current_wave": status["current_wave"],
+                    "queue_metrics": status["queue_metrics"],
+                    "debounce_seconds": status["debounce_seconds"],
+                    "debounce_remaining": round(dm.status.get_debounce_remaining(), 1),
+                    "retry_stats": dm.get_retry_stats(),
                     "task_waiting": [one_payload.tag for one_payload in status["task_waiting"]]
                 }
                 self.set_header('Content-Type', 'application/json; charset=UTF-8')
@@ -5,7 +5,6 @@ from tornado.web import authenticated
 from .common_handler import CommonHandler
 from core.deploy_manager import dmc
 from core.payload import PayLoad
-import threading
 import time
 from utils.mongo_handler import mongodb_client
 
@@ -25,9 +24,7 @@ class RollbackHandler(CommonHandler):
                                                             "branch": branch,
                                                             'payload': vars(payload),
                                                             'createTimeStamp': int(time.time())})
-            t = threading.Thread(target=dm.handle_event,
-                                 args=(payload.event_id, payload.event_type, payload))
-            t.start()
+            dm.handle_event(payload.event_id, payload.event_type, payload)
 
             # log to db
             mongodb_client['deployment']['operation_log'].insert({
@@ -0,0 +1,20 @@
+__author__ = 'magus0219'
+
+import logging
+import json
+from tornado.web import authenticated
+from .common_handler import CommonHandler
+from core.scheduler import scheduler
+
+logger_server = logging.getLogger("DeployServer.SchedulerHandler")
+
+
+class SchedulerHandler(CommonHandler):
+    @authenticated
+    def get(self):
+        """Running and queued deployments of all repositories in global scheduler
+
+        """
+        self.set_header('Content-Type', 'application/json; charset=UTF-8')
+        self.write(json.dumps(scheduler.export_status(), ensure_ascii=False).encode('utf-8'))
+        self.set_status(200)
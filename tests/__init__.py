@@ -0,0 +1,30 @@
+__author__ = 'magus0219'
+import config
+
+# modules read config at import time, tests run with the example configuration
+config.load_config_by_env('example')
+# core.deploy_manager creates a deploy manager for every repository at import, tests create their own
+config.REPOSITORY = []
+
+from core.repository import Repository, SYNC_DELTA, LAYOUT_INPLACE
+
+
+def create_repository(**attributes):
+    """Repository without git work directory, in delta sync mode unless attributes say otherwise
+
+    :param attributes: attributes set on repository, e.g. post_actions or distribution
+    :return: Repository
+    """
+    repo = Repository.__new__(Repository)
+    repo.repo_name = 'myrepo'
+    repo.deploy_path = '/home/deploy/'
+    repo.exclude_filename = None
+    repo.release_layout = LAYOUT_INPLACE
+    repo.sync_mode = SYNC_DELTA
+    repo.post_actions = []
+    repo.step_timeouts = {}
+    repo.cancel_token = None
+    repo.step_timeout_callback = None
+    for name, value in attributes.items():
+        setattr(repo, name, value)
+    return repo
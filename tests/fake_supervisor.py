@@ -0,0 +1,102 @@
+__author__ = 'magus0219'
+import socketserver
+import threading
+import time
+import xmlrpc.client
+from xmlrpc.server import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
+
+from utils.supervisor import FAULT_BAD_NAME, FAULT_NOT_RUNNING
+
+
+class KeepAliveRequestHandler(SimpleXMLRPCRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+
+class ThreadingXMLRPCServer(socketserver.ThreadingMixIn, SimpleXMLRPCServer):
+    daemon_threads = True
+
+
+class FakeSupervisorNamespace():
+    def __init__(self):
+        """supervisor.* methods of a fake supervisord
+
+        """
+        self.processes = {}  # group:name -> {'statename', 'start'}
+        self.calls = []
+
+    def add_process(self, full_name, statename='RUNNING', uptime=0):
+        self.processes[full_name] = {'statename': statename, 'start': int(time.time() - uptime)}
+
+    def _get(self, name):
+        if name not in self.processes:
+            raise xmlrpc.client.Fault(FAULT_BAD_NAME, 'BAD_NAME: {name}'.format(name=name))
+        return self.processes[name]
+
+    def _info(self, name):
+        process = self.processes[name]
+        group, process_name = name.split(':')
+        return {'name': process_name,
+                'group': group,
+                'state': 20 if process['statename'] == 'RUNNING' else 0,
+                'statename': process['statename'],
+                'pid': 1,
+                'start': process['start'],
+                'now': int(time.time()),
+                'description': '',
+                'exitstatus': 0,
+                'spawnerr': ''}
+
+    def getProcessInfo(self, name):
+        self.calls.append(('getProcessInfo', name))
+        self._get(name)
+        return self._info(name)
+
+    def getAllProcessInfo(self):
+        self.calls.append(('getAllProcessInfo',))
+        return [self._info(name) for name in self.processes]
+
+    def stopProcess(self, name, wait=True):
+        self.calls.append(('stopProcess', name))
+        process = self._get(name)
+        if process['statename'] != 'RUNNING':
+            raise xmlrpc.client.Fault(FAULT_NOT_RUNNING, 'NOT_RUNNING')
+        process['statename'] = 'STOPPED'
+        return True
+
+    def startProcess(self, name, wait=True):
+        self.calls.append(('startProcess', name))
+        process = self._get(name)
+        process['statename'] = 'RUNNING'
+        process['start'] = int(time.time())
+        return True
+
+
+class FakeSupervisor():
+    def __init__(self):
+        """Fake supervisord serving XML-RPC at 127.0.0.1 with a free port
+
+        """
+        self.supervisor = FakeSupervisorNamespace()
+        self.server = ThreadingXMLRPCServer(('127.0.0.1', 0), requestHandler=KeepAliveRequestHandler,
+                                           logRequests=False, allow_none=True)
+        self.server.connections = 0
+        self.server.register_instance(self, allow_dotted_names=True)
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, kwargs={'poll_interval': 0.05},
+                                       daemon=True)
+
+    @property
+    def connections(self):
+        return self.server.connections
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
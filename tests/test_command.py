@@ -0,0 +1,84 @@
+__author__ = 'magus0219'
+import os
+import signal
+import subprocess
+import threading
+import time
+import unittest
+from unittest import mock
+
+from utils.command import run_command, CancelToken
+
+# Command exiting on SIGTERM, its child ignores SIGTERM and keeps output open
+STUBBORN_CHILD = 'sh -c \'trap "" TERM; sleep 30; echo child\' & echo started; wait'
+
+
+class RunCommandTest(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.multiple('utils.command', KILL_GRACE_SECONDS=0.3, OUTPUT_DRAIN_SECONDS=1)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        # record processes to check and clean up their groups
+        self.processes = []
+        popen = subprocess.Popen
+
+        def record_popen(*args, **kwargs):
+            process = popen(*args, **kwargs)
+            self.processes.append(process)
+            return process
+
+        patcher = mock.patch('utils.command.subprocess.Popen', side_effect=record_popen)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        for process in self.processes:
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+    def is_group_alive(self, process):
+        # killed orphans may stay zombies if init does not reap them
+        output = subprocess.check_output(['ps', '-o', 'stat=', '-s', str(process.pid)], universal_newlines=True)
+        return any(not one_stat.startswith('Z') for one_stat in output.split())
+
+    def test_success(self):
+        result = run_command(['sh', '-c', 'echo hello; echo error >&2'])
+        self.assertTrue(result.success)
+        self.assertEqual(result.output, 'hello\nerror\n')
+
+    def test_timeout_kills_child_ignoring_sigterm(self):
+        start_time = time.time()
+        result = run_command(['sh', '-c', STUBBORN_CHILD], timeout=0.5)
+
+        self.assertTrue(result.timed_out)
+        self.assertIn('started', result.output)
+        self.assertLess(time.time() - start_time, 5)
+        time.sleep(0.2)
+        self.assertFalse(self.is_group_alive(self.processes[0]))
+
+    def test_cancel_kills_child_ignoring_sigterm(self):
+        token = CancelToken()
+        threading.Timer(0.3, token.cancel).start()
+        start_time = time.time()
+        result = run_command(['sh', '-c', STUBBORN_CHILD], cancel_token=token)
+
+        self.assertTrue(result.cancelled)
+        self.assertLess(time.time() - start_time, 5)
+        time.sleep(0.2)
+        self.assertFalse(self.is_group_alive(self.processes[0]))
+
+    def test_stop_reading_output_held_by_children(self):
+        start_time = time.time()
+        # child is left running and keeps the pipe open after command exited
+        result = run_command(['sh', '-c', 'sleep 30 & echo done'])
+
+        self.assertTrue(result.success)
+        self.assertEqual(result.output, 'done\n')
+        self.assertLess(time.time() - start_time, 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,202 @@
+__author__ = 'magus0219'
+import threading
+import unittest
+from unittest import mock
+
+from core.payload import PayLoad
+
+try:
+    from core.deploy_manager import DeployManagerStatus, GitBaseDeployManager, PackageBaseDeployManager
+except ImportError as ex:
+    # utils.mongo_handler needs pymongo and a reachable mongodb
+    DeployManagerStatus = GitBaseDeployManager = PackageBaseDeployManager = None
+    IMPORT_ERROR = str(ex)
+else:
+    IMPORT_ERROR = None
+
+
+class FakeRepository():
+    def __init__(self, branch='master', skip_superseded_tags=True):
+        self.repo_name = 'myrepo'
+        self.branch = branch
+        self.hosts = ['host1']
+        self.hosts_roles = {'host1': ['web']}
+        self.debounce_seconds = 0
+        self.skip_superseded_tags = skip_superseded_tags
+        self.retry_budget_config = {}
+
+    def get_last_commit(self):
+        return 'c0'
+
+    def get_commit_tag(self, commit):
+        return None
+
+    def get_last_release_tags(self):
+        return []
+
+
+class FakeQueueStore():
+    def __init__(self, waiting_payloads=(), interrupted_payloads=()):
+        self.payloads = {}  # event_id -> state
+        self.waiting_payloads = list(waiting_payloads)
+        self.interrupted_payloads = list(interrupted_payloads)
+
+    def load(self):
+        return self.waiting_payloads, self.interrupted_payloads
+
+    def push(self, payload):
+        self.payloads[payload.event_id] = 'waiting'
+
+    def remove(self, payload):
+        self.payloads.pop(payload.event_id, None)
+
+    def mark_waiting(self, payload):
+        self.payloads[payload.event_id] = 'waiting'
+
+    def mark_interrupted(self, payload):
+        self.payloads[payload.event_id] = 'interrupted'
+
+    def mark_running(self, payload, base_commit):
+        self.payloads[payload.event_id] = 'running'
+
+
+def create_manager(manager_class, repo):
+    """Deploy manager without worker thread, mongodb and git repository
+
+    """
+    manager = manager_class.__new__(manager_class)
+    manager.repo = repo
+    manager.status = DeployManagerStatus(repo)
+    manager.queue_store = FakeQueueStore()
+    manager._stopping = False
+    manager._rollback_event_ids = set()
+    manager._resume_event_ids = set()
+    return manager
+
+
+def branch_payload(event_id):
+    return PayLoad(event_id, 'push', 'myrepo', False, True, event_id, 'user', 'test', branch='master')
+
+
+def tag_payload(tag):
+    return PayLoad(tag, 'push', 'myrepo', True, False, tag, 'user', 'test', tag=tag)
+
+
+@unittest.skipIf(IMPORT_ERROR, "deploy manager can not be imported: {error}".format(error=IMPORT_ERROR))
+class SupersedeWaitingTasksTest(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch('core.deploy_manager.mongodb_client', mock.MagicMock())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def interrupt(self, manager, payload):
+        manager.status.set_interrupted_task(payload)
+        manager.status.disable_auto_deploy()
+        manager.queue_store.mark_interrupted(payload)
+
+    def get_waiting_ids(self, manager):
+        return [one_payload.event_id for one_payload in manager.status.get_waiting_tasks()]
+
+    def test_push_supersedes_waiting_pushes(self):
+        manager = create_manager(GitBaseDeployManager, FakeRepository())
+        for event_id in ['p1', 'p2', 'p3']:
+            manager.handle_event(event_id, 'push', branch_payload(event_id))
+        self.assertEqual(self.get_waiting_ids(manager), ['p3'])
+
+    def test_push_keeps_resumed_task(self):
+        manager = create_manager(GitBaseDeployManager, FakeRepository())
+        self.interrupt(manager, branch_payload('p1'))
+        self.assertTrue(manager.resume_interrupted_task())
+
+        manager.handle_event('p2', 'push', branch_payload('p2'))
+        manager.handle_event('p3', 'push', branch_payload('p3'))
+        self.assertEqual(self.get_waiting_ids(manager), ['p1', 'p3'])
+        self.assertEqual(manager.queue_store.payloads, {'p1': 'waiting', 'p3': 'waiting'})
+
+    def test_push_keeps_rollback_of_interrupted_task(self):
+        manager = create_manager(GitBaseDeployManager, FakeRepository())
+        self.interrupt(manager, branch_payload('p1'))
+        self.assertTrue(manager.rollback_interrupted_task())
+
+        manager.handle_event('p2', 'push', branch_payload('p2'))
+        self.assertEqual(self.get_waiting_ids(manager), ['p1', 'p2'])
+        self.assertIn('p1', manager._rollback_event_ids)
+
+    def test_operator_ids_cleared_after_finish(self):
+        manager = create_manager(GitBaseDeployManager, FakeRepository())
+        manager.repo.clear_batches = lambda: None
+        payload = branch_payload('p1')
+        self.interrupt(manager, payload)
+        manager.rollback_interrupted_task()
+
+        manager._finish_task(payload)
+        self.assertFalse(manager.is_operator_task(payload))
+
+    def test_tag_keeps_resumed_and_rollback_tasks(self):
+        manager = create_manager(PackageBaseDeployManager, FakeRepository())
+        self.interrupt(manager, tag_payload('r1.5.0'))
+        manager.resume_interrupted_task()
+        manager.handle_event('r1.1.0', 'push', tag_payload('r1.1.0'))
+        rollback_payload = PayLoad.create_by_rollback('c', 'r1.0.0', 'myrepo', 'user')
+        manager.handle_event(rollback_payload.event_id, 'rollback', rollback_payload)
+        manager.handle_event('r1.2.0', 'push', tag_payload('r1.2.0'))
+
+        self.assertEqual(self.get_waiting_ids(manager), ['r1.5.0', rollback_payload.event_id, 'r1.2.0'])
+
+
+@unittest.skipIf(IMPORT_ERROR, "deploy manager can not be imported: {error}".format(error=IMPORT_ERROR))
+class DebounceTest(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch('core.deploy_manager.mongodb_client', mock.MagicMock())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.manager = create_manager(PackageBaseDeployManager, FakeRepository())
+        self.manager.status.set_debounce_seconds(60)
+
+    def test_push_starts_quiet_period(self):
+        self.manager.handle_event('r1.1.0', 'push', tag_payload('r1.1.0'))
+        self.assertGreater(self.manager.status.get_debounce_remaining(), 0)
+
+    def test_rollback_does_not_start_quiet_period(self):
+        rollback_payload = PayLoad.create_by_rollback('c', 'r1.0.0', 'myrepo', 'user')
+        self.manager.handle_event(rollback_payload.event_id, 'rollback', rollback_payload)
+        self.assertEqual(self.manager.status.get_debounce_remaining(), 0)
+
+    def test_rollback_skips_quiet_period_of_pushes(self):
+        self.manager.handle_event('r1.1.0', 'push', tag_payload('r1.1.0'))
+        rollback_payload = PayLoad.create_by_rollback('c', 'r1.0.0', 'myrepo', 'user')
+        self.manager.status.add_waiting_task(rollback_payload, first=True)
+
+        result = []
+        worker = threading.Thread(target=lambda: result.append(self.manager._next_task()), daemon=True)
+        worker.start()
+        worker.join(5)
+        self.assertEqual(result, [rollback_payload])
+
+
+@unittest.skipIf(IMPORT_ERROR, "deploy manager can not be imported: {error}".format(error=IMPORT_ERROR))
+class RecoverTest(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch('core.deploy_manager.mongodb_client', mock.MagicMock())
+        self.mongodb_client = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_keep_oldest_interrupted_and_discard_others(self):
+        manager = create_manager(GitBaseDeployManager, FakeRepository())
+        manager.queue_store = FakeQueueStore([branch_payload('p3')],
+                                             [(branch_payload('p1'), 'c0'), (branch_payload('p2'), 'c1')])
+        manager.recover()
+
+        self.assertEqual(manager.status.get_interrupted_task().event_id, 'p1')
+        self.assertEqual(manager.status.get_last_commit(), 'c0')
+        self.assertFalse(manager.status.is_enable_auto_deploy())
+        self.assertEqual([one_payload.event_id for one_payload in manager.status.get_waiting_tasks()], ['p3'])
+        self.assertEqual(manager.queue_store.payloads, {'p1': 'interrupted'})
+
+        logs = [call[0][0] for call in self.mongodb_client['deployment']['deploy_log'].insert.call_args_list]
+        self.assertIn({'event_id': 'p2', 'type': 'deploy_discard', 'repo_name': 'myrepo', 'result': 'discarded',
+                       'base_commit': 'c1', 'kept_event_id': 'p1', 'createdTimeStamp': mock.ANY}, logs)
+
+
+if __name__ == '__main__':
+    unittest.main()
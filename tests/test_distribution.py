@@ -0,0 +1,147 @@
+__author__ = 'magus0219'
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+
+from core.distribution import PackageDistributor, LocalTransport
+from core.repository import RepositoryException, REVISION_FILENAME
+from tests import create_repository
+
+TARGET_COMMIT = 'b' * 40
+HOSTS = ['host{index}'.format(index=index) for index in range(7)]
+
+
+class RecordingTransport(LocalTransport):
+    def __init__(self, repo, root, corrupt=None):
+        """LocalTransport recording every send, corrupt(src_host, dest_host) returns True to damage a copy
+
+        """
+        super().__init__(repo, root)
+        self.sends = []
+        self.commands = []
+        self.corrupt = corrupt
+
+    def run(self, host, command, step=None):
+        self.commands.append((host, command))
+        return super().run(host, command)
+
+    def send(self, src_host, src_path, dest_host, dest_path):
+        self.sends.append((src_host, dest_host))
+        super().send(src_host, src_path, dest_host, dest_path)
+        if self.corrupt and self.corrupt(src_host, dest_host):
+            with open(self.path(dest_host, dest_path), 'ab') as f:
+                f.write(b'broken')
+
+
+class PackageDistributorTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.root = os.path.join(self.tmp_dir, 'hosts')
+        for one_host in HOSTS:
+            os.makedirs(os.path.join(self.root, one_host))
+
+        src_path = os.path.join(self.tmp_dir, 'src', 'myrepo')
+        os.makedirs(os.path.join(src_path, 'app'))
+        with open(os.path.join(src_path, 'app', 'main.py'), 'w') as f:
+            f.write('print("r1.0.0")\n')
+        self.package = os.path.join(self.tmp_dir, 'myrepo_r1.0.0.tar.gz')
+        with tarfile.open(self.package, 'w:gz') as tar:
+            tar.add(src_path, arcname='myrepo')
+
+        self.repo = create_repository(distribution={'MODE': 'tree', 'FANOUT': 2,
+                                                    'REMOTE_PATH': '/tmp/niner_packages/',
+                                                    'TRANSPORT': 'local', 'LOCAL_ROOT': self.root})
+        self.distributor = PackageDistributor(self.repo)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def use_transport(self, corrupt=None):
+        self.distributor.transport = RecordingTransport(self.repo, self.root, corrupt)
+        return self.distributor.transport
+
+    def get_host_package(self, host):
+        return os.path.join(self.root, host, 'tmp/niner_packages/myrepo_r1.0.0.tar.gz')
+
+    def test_children(self):
+        self.assertEqual(self.distributor.get_children(-1, 7), [0, 1])
+        self.assertEqual(self.distributor.get_children(0, 7), [2, 3])
+        self.assertEqual(self.distributor.get_children(2, 7), [6])
+        self.assertEqual(self.distributor.get_children(3, 7), [])
+
+    def test_fanout_tree(self):
+        transport = self.use_transport()
+        received = self.distributor.distribute(self.package, HOSTS)
+
+        self.assertEqual(sorted(received), HOSTS)
+        self.assertEqual(sorted(transport.sends, key=lambda send: send[1]),
+                         [(None, 'host0'), (None, 'host1'), ('host0', 'host2'), ('host0', 'host3'),
+                          ('host1', 'host4'), ('host1', 'host5'), ('host2', 'host6')])
+        checksum = PackageDistributor.get_checksum(self.package)
+        for one_host in HOSTS:
+            self.assertEqual(PackageDistributor.get_checksum(self.get_host_package(one_host)), checksum)
+
+    def test_checksum_mismatch_falls_back_to_server(self):
+        # copies forwarded by host0 are damaged
+        transport = self.use_transport(lambda src_host, dest_host: src_host == 'host0')
+        received = self.distributor.distribute(self.package, HOSTS)
+
+        self.assertEqual(sorted(received), HOSTS)
+        self.assertIn((None, 'host2'), transport.sends)
+        self.assertIn((None, 'host3'), transport.sends)
+        # host2 got a good copy from server at last and forwards it
+        self.assertIn(('host2', 'host6'), transport.sends)
+
+    def test_failed_host_children_seeded_by_server(self):
+        # every copy to host1 is damaged, even from server
+        transport = self.use_transport(lambda src_host, dest_host: dest_host == 'host1')
+        received = self.distributor.distribute(self.package, HOSTS)
+
+        self.assertEqual(sorted(received), sorted(set(HOSTS) - {'host1'}))
+        self.assertIn((None, 'host4'), transport.sends)
+        self.assertIn((None, 'host5'), transport.sends)
+        self.assertNotIn(('host1', 'host4'), transport.sends)
+
+    def test_install_command(self):
+        transport = self.use_transport()
+        transport.run = lambda host, command, step=None: transport.commands.append((host, command))
+        self.distributor.install('host0', '/tmp/niner_packages/myrepo_r1.0.0.tar.gz', TARGET_COMMIT)
+
+        command = transport.commands[-1][1]
+        revision_file = os.path.join(self.root, 'host0/home/deploy/myrepo', REVISION_FILENAME)
+        # revision is written only if rsync succeeds, extract directory is removed anyway
+        self.assertLess(command.index('rsync -a --delete'), command.index("echo {commit} > {file}".format(
+            commit=TARGET_COMMIT, file=revision_file)))
+        self.assertTrue(command.endswith('; code=$?; rm -rf {extract}; exit $code'.format(
+            extract=os.path.join(self.root, 'host0/tmp/niner_packages/myrepo_r1.0.0.extract'))))
+
+    @unittest.skipUnless(shutil.which('rsync'), "rsync is not installed")
+    def test_install(self):
+        self.use_transport()
+        received = self.distributor.distribute(self.package, HOSTS[:1])
+        self.distributor.install('host0', received['host0'], TARGET_COMMIT)
+
+        deploy_path = os.path.join(self.root, 'host0/home/deploy/myrepo')
+        with open(os.path.join(deploy_path, 'app', 'main.py')) as f:
+            self.assertEqual(f.read(), 'print("r1.0.0")\n')
+        with open(os.path.join(deploy_path, REVISION_FILENAME)) as f:
+            self.assertEqual(f.read().strip(), TARGET_COMMIT)
+        self.assertFalse(os.path.exists(os.path.join(self.root, 'host0/tmp/niner_packages/myrepo_r1.0.0.extract')))
+
+    @unittest.skipUnless(shutil.which('rsync'), "rsync is not installed")
+    def test_install_broken_package(self):
+        self.use_transport()
+        received = self.distributor.distribute(self.package, HOSTS[:1])
+        with open(self.get_host_package('host0'), 'wb') as f:
+            f.write(b'broken')
+
+        with self.assertRaises(RepositoryException):
+            self.distributor.install('host0', received['host0'], TARGET_COMMIT)
+        self.assertFalse(os.path.exists(os.path.join(self.root, 'host0/home/deploy/myrepo', REVISION_FILENAME)))
+        self.assertFalse(os.path.exists(os.path.join(self.root, 'host0/tmp/niner_packages/myrepo_r1.0.0.extract')))
+
+
+if __name__ == '__main__':
+    unittest.main()
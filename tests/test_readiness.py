@@ -0,0 +1,161 @@
+__author__ = 'magus0219'
+import http.server
+import threading
+import unittest
+from unittest import mock
+
+from tests.fake_supervisor import FakeSupervisor
+from utils.readiness import wait_until_ready, supervisor_probe, http_probe, ReadinessException
+
+
+class RecordingToken():
+    def __init__(self, cancel_after=None):
+        """CancelToken recording intervals waited, waiting advances a fake clock instead of sleeping
+
+        :param cancel_after: number of waits after which token is canceled, None means never
+        """
+        self.intervals = []
+        self.cancel_after = cancel_after
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+    def wait(self, interval):
+        self.intervals.append(interval)
+        self.now += interval
+        return self.cancel_after is not None and len(self.intervals) >= self.cancel_after
+
+
+def ready_after(polls):
+    calls = []
+
+    def probe():
+        calls.append(1)
+        if len(calls) > polls:
+            return True, None
+        return False, "poll {count}".format(count=len(calls))
+
+    return probe, calls
+
+
+class WaitUntilReadyTest(unittest.TestCase):
+    def wait_until_ready(self, probes, token, **kwargs):
+        with mock.patch('utils.readiness.time', token):
+            return wait_until_ready(probes, cancel_token=token, **kwargs)
+
+    def test_ready_at_once(self):
+        token = RecordingToken()
+        probe, calls = ready_after(0)
+        self.wait_until_ready([probe], token, timeout=10)
+        self.assertEqual(token.intervals, [])
+        self.assertEqual(len(calls), 1)
+
+    def test_backoff(self):
+        token = RecordingToken()
+        probe, calls = ready_after(5)
+        self.wait_until_ready([probe], token, timeout=10, initial_interval=0.2, max_interval=0.5, backoff=2)
+        self.assertEqual(token.intervals, [0.2, 0.4, 0.5, 0.5, 0.5])
+        self.assertEqual(len(calls), 6)
+
+    def test_ready_probes_are_not_polled_again(self):
+        token = RecordingToken()
+        fast_probe, fast_calls = ready_after(0)
+        slow_probe, slow_calls = ready_after(2)
+        self.wait_until_ready([fast_probe, slow_probe], token, timeout=10)
+        self.assertEqual(len(fast_calls), 1)
+        self.assertEqual(len(slow_calls), 3)
+
+    def test_timeout(self):
+        token = RecordingToken()
+        probe, calls = ready_after(1000)
+        with self.assertRaises(ReadinessException) as context:
+            self.wait_until_ready([probe], token, timeout=1, initial_interval=0.2, max_interval=0.5, backoff=2)
+        self.assertIn('Not ready after 1s', str(context.exception))
+        self.assertEqual(token.intervals, [0.2, 0.4])
+
+    def test_timeout_with_sleep(self):
+        probe, calls = ready_after(1000)
+        with self.assertRaises(ReadinessException):
+            wait_until_ready([probe], timeout=0.1, initial_interval=0.02, max_interval=0.05)
+        self.assertGreater(len(calls), 1)
+
+    def test_cancel(self):
+        token = RecordingToken(cancel_after=2)
+        probe, calls = ready_after(1000)
+        with self.assertRaises(ReadinessException) as context:
+            self.wait_until_ready([probe], token, timeout=10)
+        self.assertIn('Canceled', str(context.exception))
+        self.assertEqual(len(calls), 2)
+
+    def test_probe_fails_at_once(self):
+        token = RecordingToken()
+
+        def probe():
+            raise ReadinessException("FATAL")
+
+        with self.assertRaises(ReadinessException):
+            self.wait_until_ready([probe], token, timeout=10)
+        self.assertEqual(token.intervals, [])
+
+
+class SupervisorProbeTest(unittest.TestCase):
+    def setUp(self):
+        self.fake = FakeSupervisor().start()
+
+    def tearDown(self):
+        self.fake.stop()
+
+    def test_running_long_enough(self):
+        self.fake.supervisor.add_process('web:api', uptime=10)
+        probe = supervisor_probe('127.0.0.1', self.fake.port, 'web:api', min_uptime=5)
+        self.assertEqual(probe(), (True, None))
+
+    def test_running_too_short(self):
+        self.fake.supervisor.add_process('web:api', uptime=0)
+        ready, reason = supervisor_probe('127.0.0.1', self.fake.port, 'web:api', min_uptime=5)()
+        self.assertFalse(ready)
+        self.assertIn('uptime', reason)
+
+    def test_failed_state(self):
+        self.fake.supervisor.add_process('web:api', statename='FATAL')
+        probe = supervisor_probe('127.0.0.1', self.fake.port, 'web:api', min_uptime=5)
+        with self.assertRaises(ReadinessException):
+            probe()
+
+    def test_supervisor_error_is_not_ready(self):
+        ready, reason = supervisor_probe('127.0.0.1', self.fake.port, 'web:missing', min_uptime=0)()
+        self.assertFalse(ready)
+        self.assertIn('BAD_NAME', reason)
+
+
+class StatusHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.send_response(int(self.path.strip('/')))
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class HttpProbeTest(unittest.TestCase):
+    def setUp(self):
+        self.server = http.server.HTTPServer(('127.0.0.1', 0), StatusHandler)
+        self.url = "http://127.0.0.1:{port}/".format(port=self.server.server_address[1])
+        threading.Thread(target=self.server.serve_forever, kwargs={'poll_interval': 0.05}, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_ok(self):
+        self.assertEqual(http_probe(self.url + '200')(), (True, None))
+
+    def test_error_status(self):
+        ready, reason = http_probe(self.url + '503')()
+        self.assertFalse(ready)
+        self.assertIn('503', reason)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,228 @@
+__author__ = 'magus0219'
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from core.repository import RepositoryException, CommandCancelled, SYNC_BATCH, LAYOUT_SYMLINK, RELEASE_ACTIVE, \
+    RELEASE_NOT_ACTIVE, RELEASE_RETAINED
+from tests import create_repository
+
+BASE_COMMIT = 'a' * 40
+TARGET_COMMIT = 'b' * 40
+
+
+class DeltaSyncTest(unittest.TestCase):
+    def setUp(self):
+        self.src_path = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.src_path, 'app', 'views'))
+        open(os.path.join(self.src_path, 'app', 'views', 'index.html'), 'w').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.src_path, ignore_errors=True)
+
+    def sync(self, repo, change_files, remote_revision=BASE_COMMIT):
+        calls = mock.Mock()
+        with mock.patch.object(repo, 'get_remote_revision', return_value=remote_revision), \
+                mock.patch.object(repo, 'rsync', calls.rsync) as rsync, \
+                mock.patch.object(repo, 'rsync_files', calls.rsync_files) as rsync_files, \
+                mock.patch.object(repo, 'set_remote_revision', calls.set_remote_revision), \
+                mock.patch.object(repo, '_run_at_host') as run_at_host:
+            repo.sync_to_host(self.src_path, 'host1', change_files=change_files, base_commit=BASE_COMMIT,
+                              target_commit=TARGET_COMMIT)
+        # record is removed before and written after the sync
+        self.assertEqual(len(calls.mock_calls), 3)
+        self.assertEqual(calls.mock_calls[0], mock.call.set_remote_revision('host1', None))
+        self.assertEqual(calls.mock_calls[-1], mock.call.set_remote_revision('host1', TARGET_COMMIT))
+        return rsync, rsync_files, run_at_host
+
+    def test_keep_record_removed_if_sync_fails(self):
+        repo = create_repository()
+        with mock.patch.object(repo, 'get_remote_revision', return_value=BASE_COMMIT), \
+                mock.patch.object(repo, 'rsync_files', side_effect=RepositoryException("rsync: broken pipe")), \
+                mock.patch.object(repo, 'set_remote_revision') as set_remote_revision:
+            with self.assertRaises(RepositoryException):
+                repo.sync_to_host(self.src_path, 'host1', change_files=['app/views/index.html'],
+                                  base_commit=BASE_COMMIT, target_commit=TARGET_COMMIT)
+        set_remote_revision.assert_called_once_with('host1', None)
+
+    def test_delta(self):
+        rsync, rsync_files, run_at_host = self.sync(create_repository(), ['app/views/index.html'])
+        self.assertFalse(rsync.called)
+        self.assertEqual(rsync_files.call_args[0][2], ['app/views/index.html'])
+        self.assertFalse(run_at_host.called)
+
+    def test_full_if_host_at_other_commit(self):
+        rsync, rsync_files, run_at_host = self.sync(create_repository(), ['app/views/index.html'],
+                                                    remote_revision=None)
+        self.assertTrue(rsync.called)
+        self.assertFalse(rsync_files.called)
+
+    def test_full_if_post_actions(self):
+        repo = create_repository(post_actions=[{'cmd': 'npm run build', 'cwd': self.src_path}])
+        rsync, rsync_files, run_at_host = self.sync(repo, ['app/views/index.html'])
+        self.assertTrue(rsync.called)
+        self.assertFalse(rsync_files.called)
+
+    def test_remove_empty_dirs_of_deleted_files(self):
+        change_files = ['app/views/index.html', 'app/views/old.html', 'lib/vendor/js/a.js', 'lib/vendor/b.js']
+        rsync, rsync_files, run_at_host = self.sync(create_repository(), change_files)
+        self.assertTrue(rsync_files.called)
+        script = run_at_host.call_args[0][1]
+        self.assertIn("cd /home/deploy/myrepo && rmdir lib/vendor/js lib/vendor lib 2>/dev/null", script)
+
+    def test_get_deleted_dirs(self):
+        repo = create_repository()
+        self.assertEqual(repo.get_deleted_dirs(self.src_path, ['app/views/gone.html', 'app/old/a/b.txt', 'c.txt']),
+                         ['app/old/a', 'app/old'])
+
+
+class BatchSyncTest(unittest.TestCase):
+    def sync(self, apply_error=None, remote_revision=BASE_COMMIT):
+        repo = create_repository()
+        repo.sync_mode = SYNC_BATCH
+        batch = {'batch': '/tmp/batch', 'base': BASE_COMMIT, 'done': True}
+        with mock.patch.object(repo, 'write_batch', return_value=batch), \
+                mock.patch.object(repo, 'get_remote_revision', return_value=remote_revision), \
+                mock.patch.object(repo, 'apply_batch', side_effect=apply_error) as apply_batch, \
+                mock.patch.object(repo, 'rsync') as rsync, \
+                mock.patch.object(repo, 'set_remote_revision') as set_remote_revision:
+            repo.sync_to_host('/tmp/src', 'host1', exclude_file='/tmp/exclude.txt', target_commit=TARGET_COMMIT)
+        self.assertEqual(set_remote_revision.call_args_list,
+                         [mock.call('host1', None), mock.call('host1', TARGET_COMMIT)])
+        return apply_batch, rsync
+
+    def test_replay_batch(self):
+        apply_batch, rsync = self.sync()
+        apply_batch.assert_called_once_with('/tmp/batch', 'host1', '/tmp/exclude.txt')
+        self.assertFalse(rsync.called)
+
+    def test_replay_command(self):
+        repo = create_repository()
+        with mock.patch.object(repo, '_ssh_command', return_value='ssh'), \
+                mock.patch.object(repo, '_run_shell_command') as run_shell_command:
+            repo.apply_batch('/tmp/staging/myrepo/batch_' + TARGET_COMMIT, 'host1', '/tmp/exclude.txt')
+        remote_dir = '/tmp/niner_myrepo_batch_' + TARGET_COMMIT
+        ship, replay = [args[0] for args, kwargs in run_shell_command.call_args_list]
+        self.assertIn("/tmp/staging/myrepo/batch_{commit} /tmp/exclude.txt deploy@host1:{dir}/".format(
+            commit=TARGET_COMMIT, dir=remote_dir), ship)
+        # same receiver options as write_batch
+        self.assertIn("rsync -a --delete --read-batch={dir}/batch_{commit} --exclude=/.niner_revision "
+                      "--exclude-from={dir}/exclude.txt /home/deploy/myrepo/;".format(dir=remote_dir,
+                                                                                     commit=TARGET_COMMIT), replay)
+        self.assertIn("rm -rf {dir};".format(dir=remote_dir), replay)
+
+    def test_full_if_host_at_other_commit(self):
+        apply_batch, rsync = self.sync(remote_revision=None)
+        self.assertFalse(apply_batch.called)
+        self.assertTrue(rsync.called)
+
+    def test_full_if_replay_fails(self):
+        apply_batch, rsync = self.sync(apply_error=RepositoryException("rsync: failed verification"))
+        self.assertTrue(apply_batch.called)
+        self.assertTrue(rsync.called)
+
+    def test_cancel_while_replaying(self):
+        with self.assertRaises(CommandCancelled):
+            self.sync(apply_error=CommandCancelled("Deployment canceled"))
+
+
+class ReleaseScriptTest(unittest.TestCase):
+    """Run release scripts with sh against a temporary DEPLOY_PATH, rsync copies src_path into release directory
+
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.deploy_path = os.path.join(self.tmp_dir, 'deploy') + os.sep
+        os.makedirs(os.path.join(self.deploy_path, 'myrepo'))
+        self.write_file(os.path.join(self.deploy_path, 'myrepo', 'app.txt'), 'r0')
+
+        self.repo = create_repository(deploy_path=self.deploy_path, release_layout=LAYOUT_SYMLINK, keep_releases=2)
+        self.synced = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def write_file(self, path, content):
+        with open(path, 'w') as f:
+            f.write(content)
+
+    def read_deployed(self):
+        with open(os.path.join(self.deploy_path, 'myrepo', 'app.txt')) as f:
+            return f.read()
+
+    def run_script(self, host, script, step=None):
+        return subprocess.run(['sh', '-c', script], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, check=True,
+                              universal_newlines=True).stdout
+
+    def rsync(self, src_path, dest_path, exclude_file=None):
+        release_path = dest_path.split(':', 1)[1]
+        self.synced.append(release_path)
+        dest = os.path.join(release_path, os.path.basename(src_path))
+        for one_file in os.listdir(src_path):
+            # rsync replaces files instead of writing into hard links shared with other releases
+            shutil.copy(os.path.join(src_path, one_file), os.path.join(dest, one_file + '.tmp'))
+            os.replace(os.path.join(dest, one_file + '.tmp'), os.path.join(dest, one_file))
+
+    def deploy(self, release_name):
+        src_path = os.path.join(self.tmp_dir, 'src', release_name, 'myrepo')
+        os.makedirs(src_path, exist_ok=True)
+        self.write_file(os.path.join(src_path, 'app.txt'), release_name)
+        with mock.patch.object(self.repo, '_run_at_host', self.run_script), \
+                mock.patch.object(self.repo, 'rsync', self.rsync):
+            self.repo.sync_to_host(src_path, 'host1', release_name=release_name)
+
+    def release_path(self, release_name):
+        return os.path.join(self.deploy_path, self.repo.get_release_dir(release_name))
+
+    def test_deploy_and_rollback(self):
+        self.deploy('r1')
+        self.assertEqual(os.readlink(os.path.join(self.deploy_path, 'myrepo')), 'releases/myrepo/r1/myrepo')
+        self.assertEqual(self.read_deployed(), 'r1')
+
+        self.assertNotIn(RELEASE_NOT_ACTIVE, self.run_script('host1', self.repo.get_rollback_release_script('r1')))
+        self.assertEqual(self.read_deployed(), 'r0')
+        self.assertIn(RELEASE_NOT_ACTIVE, self.run_script('host1', self.repo.get_rollback_release_script('r1')))
+
+    def test_prepare_active_release(self):
+        self.deploy('r1')
+        self.assertIn(RELEASE_ACTIVE, self.run_script('host1', self.repo.get_prepare_release_script('r1')))
+
+    def test_activate_retained_release(self):
+        self.deploy('r1')
+        retained_file = os.path.join(self.release_path('r1'), 'myrepo', 'app.txt')
+        inode = os.stat(retained_file).st_ino
+        self.deploy('r2')
+        self.assertEqual(self.read_deployed(), 'r2')
+
+        self.assertIn(RELEASE_RETAINED, self.run_script('host1', self.repo.get_prepare_release_script('r1')))
+        self.deploy('r1')
+        self.assertEqual(self.read_deployed(), 'r1')
+        # release directory is neither removed nor synced again
+        self.assertEqual(os.stat(retained_file).st_ino, inode)
+        self.assertEqual(self.synced.count(self.release_path('r1') + os.sep), 1)
+
+    def test_prepare_incomplete_release_again(self):
+        self.run_script('host1', self.repo.get_prepare_release_script('r1'))
+        self.write_file(os.path.join(self.release_path('r1'), 'myrepo', 'partial.txt'), '')
+
+        self.assertNotIn(RELEASE_RETAINED, self.run_script('host1', self.repo.get_prepare_release_script('r1')))
+        self.assertEqual(sorted(os.listdir(os.path.join(self.release_path('r1'), 'myrepo'))), ['app.txt'])
+
+    def test_remove_old_releases(self):
+        past = time.time() - 100
+        for index, release_name in enumerate(['r1', 'r2', 'r3', 'r4']):
+            self.deploy(release_name)
+            # ls -t orders releases by modification time, which may be equal within a test
+            os.utime(self.release_path(release_name), (past + index, past + index))
+            if os.path.exists(self.release_path('_initial')):
+                os.utime(self.release_path('_initial'), (past - 1, past - 1))
+        self.assertEqual(sorted(os.listdir(os.path.join(self.deploy_path, 'releases', 'myrepo'))), ['r3', 'r4'])
+
+
+if __name__ == '__main__':
+    unittest.main()
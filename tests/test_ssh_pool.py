@@ -0,0 +1,157 @@
+__author__ = 'magus0219'
+import os
+import shutil
+import stat
+import subprocess
+import tempfile
+import unittest
+
+from utils.ssh_pool import SSHConnectionPool
+
+# Fake ssh logging its arguments, a master keeps its control socket(a plain file) until -O exit removes it
+FAKE_SSH = """#!/bin/sh
+echo "$@" >> {log}
+control_path=""
+operation=""
+master=""
+previous=""
+for arg in "$@"; do
+    case "$arg" in
+        ControlPath=*) control_path="${{arg#ControlPath=}}" ;;
+        -M) master=1 ;;
+    esac
+    if [ "$previous" = "-O" ]; then
+        operation="$arg"
+    fi
+    previous="$arg"
+done
+if [ -e {fail_flag} ]; then
+    exit 255
+fi
+if [ -n "$master" ]; then
+    touch "$control_path"
+    while [ -e "$control_path" ]; do sleep 0.05; done
+    exit 0
+fi
+case "$operation" in
+    check) [ -e "$control_path" ] && [ ! -e {check_fail_flag} ] ;;
+    exit) rm -f "$control_path" ;;
+    *) exit 0 ;;
+esac
+"""
+
+
+class SSHConnectionPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.log = os.path.join(self.tmp_dir, 'ssh.log')
+        self.fail_flag = os.path.join(self.tmp_dir, 'fail')
+        self.check_fail_flag = os.path.join(self.tmp_dir, 'check_fail')
+        self.ssh = os.path.join(self.tmp_dir, 'ssh')
+        with open(self.ssh, 'w') as f:
+            f.write(FAKE_SSH.format(log=self.log, fail_flag=self.fail_flag,
+                                    check_fail_flag=self.check_fail_flag))
+        os.chmod(self.ssh, os.stat(self.ssh).st_mode | stat.S_IEXEC)
+
+        self.pool = SSHConnectionPool(os.path.join(self.tmp_dir, 'control'), ssh_command=self.ssh,
+                                      check_interval=0, connect_timeout=5)
+
+    def tearDown(self):
+        self.pool.close_all()
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def get_calls(self, argument):
+        if not os.path.exists(self.log):
+            return []
+        with open(self.log) as f:
+            return [line for line in f.read().splitlines() if argument in line.split()]
+
+    def test_reuse_master(self):
+        options = self.pool.get_options('deploy@host1')
+        self.assertIn('ControlMaster=no', options)
+        self.assertEqual(options, self.pool.get_options('deploy@host1'))
+        self.assertEqual(len(self.get_calls('-M')), 1)
+        self.assertEqual(len(self.get_calls('check')), 1)
+
+    def test_master_per_destination(self):
+        options1 = self.pool.get_options('deploy@host1')
+        options2 = self.pool.get_options('deploy@host2')
+        self.assertNotEqual(options1, options2)
+        self.assertEqual(len(self.get_calls('-M')), 2)
+
+    def test_reconnect_dead_master(self):
+        self.pool.get_options('deploy@host1')
+        master = self.pool._masters['deploy@host1']
+        master['process'].kill()
+        master['process'].wait()
+
+        options = self.pool.get_options('deploy@host1')
+        self.assertIn('ControlMaster=no', options)
+        self.assertEqual(len(self.get_calls('-M')), 2)
+        self.assertIsNone(master['process'].poll())
+
+    def test_reconnect_stale_master(self):
+        self.pool.get_options('deploy@host1')
+        master = self.pool._masters['deploy@host1']
+        old_process = master['process']
+        # master process is alive but does not answer -O check
+        open(self.check_fail_flag, 'w').close()
+        self.pool.get_options('deploy@host1')
+        os.remove(self.check_fail_flag)
+
+        self.assertEqual(len(self.get_calls('exit')), 1)
+        self.assertEqual(len(self.get_calls('-M')), 2)
+        self.assertIsNotNone(old_process.poll())
+        self.assertIsNot(master['process'], old_process)
+        self.assertIsNone(master['process'].poll())
+
+    def test_plain_ssh_if_master_fails(self):
+        open(self.fail_flag, 'w').close()
+        self.assertEqual(self.pool.get_options('deploy@host1'), [])
+        self.assertEqual(self.pool.get_ssh_command('deploy@host1'), self.ssh)
+
+    def test_evict_idle(self):
+        self.pool.idle_timeout = 0
+        self.pool.get_options('deploy@host1')
+        master = self.pool._masters['deploy@host1']
+        master['last_used'] -= 1
+
+        self.pool.evict_idle()
+        self.assertIsNone(master['process'])
+        self.assertFalse(os.path.exists(master['control_path']))
+
+    def test_keep_master_with_running_session(self):
+        self.pool.idle_timeout = 0
+        options = self.pool.get_options('deploy@host1')
+        master = self.pool._masters['deploy@host1']
+        command = ' '.join([self.ssh] + options + ['deploy@host1', 'sleep 0.5'])
+
+        with self.pool.session(command):
+            process = subprocess.Popen(['sleep', '0.5'])
+            master['last_used'] -= 1
+            # another host evicts idle masters while the long command runs
+            self.pool.get_options('deploy@host2')
+            self.assertIsNotNone(master['process'])
+            self.assertTrue(os.path.exists(master['control_path']))
+            process.wait()
+
+        self.assertEqual(master['sessions'], 0)
+        # finished command counts as use
+        self.assertEqual(self.get_calls('exit'), [])
+        master['last_used'] -= 1
+        self.pool.evict_idle()
+        self.assertIsNone(master['process'])
+
+    def test_session_without_master(self):
+        with self.pool.session('rsync -a src dest'):
+            pass
+        self.assertEqual(self.pool._masters, {})
+
+    def test_disabled(self):
+        self.pool.enable = False
+        self.assertEqual(self.pool.get_options('deploy@host1'), [])
+        self.assertEqual(self.get_calls('-M'), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
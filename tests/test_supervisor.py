@@ -0,0 +1,75 @@
+__author__ = 'magus0219'
+import socket
+import unittest
+
+from tests.fake_supervisor import FakeSupervisor
+from utils.supervisor import SupervisorPool, SupervisorException, FAULT_BAD_NAME, is_permanent_fault
+
+
+class SupervisorPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.fake = FakeSupervisor().start()
+        self.fake.supervisor.add_process('web:api', uptime=10)
+        self.pool = SupervisorPool(max_idle_per_host=1, timeout=5)
+
+    def tearDown(self):
+        self.pool.close_all()
+        self.fake.stop()
+
+    def test_restart_process(self):
+        with self.pool.client('127.0.0.1', self.fake.port) as client:
+            client.restart_process('web:api')
+            info = client.get_process_info('web:api')
+        self.assertTrue(info.is_running)
+        self.assertEqual(info.full_name, 'web:api')
+        self.assertEqual([call[0] for call in self.fake.supervisor.calls],
+                         ['stopProcess', 'startProcess', 'getProcessInfo'])
+
+    def test_restart_stopped_process(self):
+        self.fake.supervisor.add_process('web:api', statename='STOPPED')
+        with self.pool.client('127.0.0.1', self.fake.port) as client:
+            client.restart_process('web:api')
+            self.assertTrue(client.get_process_info('web:api').is_running)
+
+    def test_reuse_client_and_connection(self):
+        with self.pool.client('127.0.0.1', self.fake.port) as client:
+            client.get_all_process_info()
+        with self.pool.client('127.0.0.1', self.fake.port) as reused_client:
+            reused_client.get_all_process_info()
+
+        self.assertIs(reused_client, client)
+        self.assertEqual(self.fake.connections, 1)
+
+    def test_concurrent_clients(self):
+        with self.pool.client('127.0.0.1', self.fake.port) as client1:
+            with self.pool.client('127.0.0.1', self.fake.port) as client2:
+                self.assertIsNot(client1, client2)
+                client1.get_all_process_info()
+                client2.get_all_process_info()
+        # only max_idle_per_host clients are kept
+        self.assertEqual(len(self.pool._idle[('127.0.0.1', self.fake.port)]), 1)
+
+    def test_fault(self):
+        with self.assertRaises(SupervisorException) as context:
+            with self.pool.client('127.0.0.1', self.fake.port) as client:
+                client.get_process_info('web:missing')
+        self.assertEqual(context.exception.code, FAULT_BAD_NAME)
+        self.assertTrue(is_permanent_fault(context.exception.code))
+        # client in unknown state is not returned to pool
+        self.assertFalse(self.pool._idle.get(('127.0.0.1', self.fake.port)))
+
+    def test_connection_error(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+
+        with self.assertRaises(SupervisorException) as context:
+            with self.pool.client('127.0.0.1', port) as client:
+                client.get_all_process_info()
+        self.assertIsNone(context.exception.code)
+        self.assertFalse(is_permanent_fault(context.exception.code))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+__author__ = 'magus0219'
+import shlex
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from core.tag_index import TagIndex
+
+
+class GitRepository():
+    def __init__(self, git_path):
+        """Local git repository standing for Repository in tag index
+
+        """
+        self.repo_name = 'myrepo'
+        self.git_path = git_path
+        self.commands = []
+
+    def _run_shell_command(self, command, cwd=None, step=None):
+        self.commands.append(command)
+        return subprocess.check_output(shlex.split(command), cwd=cwd, universal_newlines=True)
+
+    def get_tag_info(self, tag_name):
+        return None
+
+    def git(self, *args):
+        subprocess.check_call(('git',) + args, cwd=self.git_path, stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL)
+
+    def tag(self, tag_name):
+        self.git('tag', '-a', tag_name, '-m', 'release ' + tag_name)
+
+    def head(self):
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=self.git_path,
+                                       universal_newlines=True).strip()
+
+
+class TagIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.git_path = tempfile.mkdtemp()
+        self.repo = GitRepository(self.git_path)
+        self.repo.git('init', '-q')
+        self.repo.git('-c', 'user.name=test', '-c', 'user.email=test@example.com', 'commit', '-q', '--allow-empty',
+                      '-m', 'init')
+        self.repo.git('config', 'user.name', 'test')
+        self.repo.git('config', 'user.email', 'test@example.com')
+        self.repo.tag('r1.2.0')
+        self.repo.tag('r1.10.0')
+        self.index = TagIndex(self.repo)
+
+    def tearDown(self):
+        shutil.rmtree(self.git_path, ignore_errors=True)
+
+    def get_names(self):
+        return [one_tag.name for one_tag in self.index.get_last_release_tags(10)]
+
+    def test_load_once(self):
+        self.assertEqual(self.get_names(), ['r1.10.0', 'r1.2.0'])
+        self.assertEqual(self.index.get_commit_tag(self.repo.head()).name, 'r1.10.0')
+        self.assertEqual(len(self.repo.commands), 1)
+
+    def test_tag_fetched_without_push_event(self):
+        self.get_names()
+        # e.g. auto-followed by git pull, webhook of it was missed
+        self.repo.tag('r1.11.0')
+        self.assertEqual(self.get_names(), ['r1.10.0', 'r1.2.0'])
+
+        self.index.invalidate()
+        self.assertEqual(self.get_names(), ['r1.11.0', 'r1.10.0', 'r1.2.0'])
+
+    def test_pending_tag_indexed_by_reload(self):
+        self.get_names()
+        self.index.add_pending('r1.11.0')
+        self.repo.tag('r1.11.0')
+        self.index.invalidate()
+
+        self.assertEqual(self.get_names(), ['r1.11.0', 'r1.10.0', 'r1.2.0'])
+        self.assertEqual(self.index._pending, set())
+
+    def test_remove(self):
+        self.get_names()
+        self.index.remove('r1.10.0')
+        self.assertEqual(self.get_names(), ['r1.2.0'])
+        self.assertEqual(self.index.get_commit_tag(self.repo.head()).name, 'r1.2.0')
+
+
+if __name__ == '__main__':
+    unittest.main()
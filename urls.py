@@ -9,6 +9,7 @@ URLS = [
             (r'/repo/(.*)/(.*)/rollback/(.*)/(.*)', handlers.RollbackHandler),
             (r'/repo/(.*)/(.*)/(.*)', handlers.OperationHandler),
             (r'/repo/(.*)/(.*)', handlers.IndexHandler),
+            (r'/scheduler', handlers.SchedulerHandler),
             (r'/repo', RedirectHandler, {"url": "/deploy/repo/{repo_with_branch}".format(
                 repo_with_branch=dmc.list_repos_with_branch()[0])}),
             (r'/login', handlers.LoginHandler),
@@ -0,0 +1,282 @@
+__author__ = 'magus0219'
+import collections
+import heapq
+import itertools
+import logging
+import os
+import signal
+import subprocess
+import threading
+import time
+
+logger_server = logging.getLogger("DeployServer.Command")
+
+# Bytes of output kept in memory for one command, older output is dropped
+MAX_OUTPUT_SIZE = 1024 * 1024
+# Seconds between SIGTERM and SIGKILL when killing a command
+KILL_GRACE_SECONDS = 5
+# Seconds to wait for the rest of output after command exited, children may keep the pipe open
+OUTPUT_DRAIN_SECONDS = KILL_GRACE_SECONDS + 1
+
+
+def kill_process_group(process, grace=None):
+    """Kill a command started by run_command together with its children, e.g. ssh spawned by rsync
+
+    SIGTERM first and SIGKILL after grace seconds, return at once. SIGKILL is sent to the process group even if
+    the command itself exited on SIGTERM, children ignoring SIGTERM would keep running and hold its output.
+
+    :param process: Popen object started in a new session
+    :param grace: seconds before SIGKILL, default KILL_GRACE_SECONDS
+    :return:
+    """
+    def send_signal(sig):
+        try:
+            os.killpg(process.pid, sig)
+        except OSError:
+            # ESRCH: the whole group is gone
+            pass
+
+    send_signal(signal.SIGTERM)
+    timer = threading.Timer(KILL_GRACE_SECONDS if grace is None else grace, send_signal, args=(signal.SIGKILL,))
+    timer.daemon = True
+    timer.start()
+
+
+class Watchdog():
+    def __init__(self):
+        """Kill commands running longer than their timeout
+
+        One thread watches deadlines of all commands, so a hung command is killed with its process group even
+        if the thread waiting for it is blocked.
+        """
+        self._heap = []  # (deadline, seq, watch)
+        self._seq = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def watch(self, process, timeout):
+        """Watch a process
+
+        :param process: Popen object started in a new session
+        :param timeout: seconds before killing
+        :return: watch dict, 'expired' is True once killed
+        """
+        watch = {'process': process, 'timeout': timeout, 'expired': False, 'done': False}
+        with self._condition:
+            heapq.heappush(self._heap, (time.time() + timeout, next(self._seq), watch))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="CommandWatchdog")
+                self._thread.daemon = True
+                self._thread.start()
+            self._condition.notify()
+        return watch
+
+    def unwatch(self, watch):
+        with self._condition:
+            watch['done'] = True
+
+    def _run(self):
+        while True:
+            with self._condition:
+                # drop finished commands on top
+                while self._heap and self._heap[0][2]['done']:
+                    heapq.heappop(self._heap)
+                if not self._heap:
+                    self._condition.wait()
+                    continue
+
+                deadline, seq, watch = self._heap[0]
+                wait_seconds = deadline - time.time()
+                if wait_seconds > 0:
+                    self._condition.wait(wait_seconds)
+                    continue
+
+                heapq.heappop(self._heap)
+                watch['expired'] = True
+
+            process = watch['process']
+            logger_server.info("Kill command pid {pid} after {timeout}s: {args}".format(
+                pid=process.pid, timeout=watch['timeout'], args=' '.join(process.args)))
+            kill_process_group(process)
+
+
+watchdog = Watchdog()
+
+
+class CancelToken():
+    def __init__(self):
+        """Token to cancel commands of one deployment
+
+        Commands started by run_command with this token are killed as soon as it is canceled, commands started
+        afterwards are killed at once.
+        """
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._processes = set()
+        self.cancel_time = None
+
+    @property
+    def is_cancelled(self):
+        return self._event.is_set()
+
+    def cancel(self):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self.cancel_time = time.time()
+            self._event.set()
+            processes = list(self._processes)
+
+        for process in processes:
+            logger_server.info("Kill command pid {pid} for cancel".format(pid=process.pid))
+            kill_process_group(process)
+
+    def elapsed(self):
+        """Seconds since canceled
+
+        :return: seconds or None if not canceled
+        """
+        if self.cancel_time is None:
+            return None
+        return time.time() - self.cancel_time
+
+    def wait(self, timeout):
+        """Sleep for timeout seconds unless canceled
+
+        :param timeout: seconds
+        :return: True if canceled
+        """
+        return self._event.wait(timeout)
+
+    def register(self, process):
+        """Track a running process
+
+        :param process: Popen object
+        :return: False if already canceled
+        """
+        with self._lock:
+            if self._event.is_set():
+                return False
+            self._processes.add(process)
+            return True
+
+    def unregister(self, process):
+        with self._lock:
+            self._processes.discard(process)
+
+
+class CommandResult():
+    def __init__(self, args, return_code, output, duration, truncated=False, timed_out=False, cancelled=False):
+        """Result of a finished command
+
+        :param args: argument list of command
+        :param return_code: exit code, negative if killed by signal
+        :param output: tail of stdout/stderr text
+        :param duration: seconds the command ran
+        :param truncated: True if head of output was dropped
+        :param timed_out: True if killed because of timeout
+        :param cancelled: True if killed by cancel token
+        """
+        self.args = args
+        self.return_code = return_code
+        self.output = output
+        self.duration = duration
+        self.truncated = truncated
+        self.timed_out = timed_out
+        self.cancelled = cancelled
+
+    @property
+    def success(self):
+        return self.return_code == 0 and not self.timed_out and not self.cancelled
+
+    def __repr__(self):
+        return "<CommandResult {args} code={code} duration={duration:.3f}s>".format(args=' '.join(self.args),
+                                                                                 code=self.return_code,
+                                                                                 duration=self.duration)
+
+
+class OutputBuffer():
+    def __init__(self, max_size):
+        """Keep the last max_size bytes of output lines
+
+        :param max_size: max bytes to keep
+        """
+        self.max_size = max_size
+        self.size = 0
+        self.dropped = 0
+        self.lines = collections.deque()
+
+    def append(self, line):
+        self.lines.append(line)
+        self.size += len(line)
+        while self.size > self.max_size and len(self.lines) > 1:
+            dropped_line = self.lines.popleft()
+            self.size -= len(dropped_line)
+            self.dropped += len(dropped_line)
+
+    def get_text(self):
+        # snapshot, a reader left behind may still append
+        text = b''.join(list(self.lines)).decode('utf8', errors='replace')
+        if self.dropped:
+            text = "...[{dropped} bytes truncated]...\n".format(dropped=self.dropped) + text
+        return text
+
+
+def run_command(args, cwd=None, timeout=None, line_callback=None, max_output=MAX_OUTPUT_SIZE, cancel_token=None):
+    """Run a command and capture its output through a pipe
+
+    stdout and stderr are merged, only the tail of output is kept in memory. Command runs in its own process
+    group, so children like ssh are killed together on timeout or cancel.
+
+    :param args: argument list of command
+    :param cwd: working directory of command
+    :param timeout: seconds before command is killed by watchdog, None means wait forever
+    :param line_callback: function called with every output line(text) as soon as it is read
+    :param max_output: max bytes of output kept
+    :param cancel_token: CancelToken to kill command
+    :return: CommandResult
+    """
+    buffer = OutputBuffer(max_output)
+    start_time = time.time()
+
+    process = subprocess.Popen(args,
+                               cwd=cwd,
+                               stdin=subprocess.DEVNULL,
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT,
+                               start_new_session=True)
+    if cancel_token and not cancel_token.register(process):
+        kill_process_group(process)
+
+    def read_output():
+        for one_line in iter(process.stdout.readline, b''):
+            buffer.append(one_line)
+            if line_callback:
+                try:
+                    line_callback(one_line.decode('utf8', errors='replace').rstrip('\n'))
+                except Exception as ex:
+                    logger_server.exception(str(ex))
+        process.stdout.close()
+
+    reader = threading.Thread(target=read_output)
+    reader.daemon = True
+    reader.start()
+
+    watch = watchdog.watch(process, timeout) if timeout else None
+    try:
+        process.wait()
+    finally:
+        if watch:
+            watchdog.unwatch(watch)
+        # children left by command, e.g. one ignoring SIGTERM before SIGKILL arrives, may keep pipe open
+        reader.join(OUTPUT_DRAIN_SECONDS)
+        if reader.is_alive():
+            logger_server.info("Output of {args} is still open after it exited, stop reading".format(
+                args=' '.join(args)))
+        if cancel_token:
+            cancel_token.unregister(process)
+    timed_out = bool(watch and watch['expired'] and process.returncode != 0)
+
+    return CommandResult(args, process.returncode, buffer.get_text(), time.time() - start_time,
+                         truncated=buffer.dropped > 0, timed_out=timed_out,
+                         cancelled=bool(cancel_token and cancel_token.is_cancelled and process.returncode != 0))
@@ -1,21 +1,29 @@
 __author__ = 'magus0219'
+import functools
+from utils.retry import RetryPolicy
 
 
-def retry(times):
+def retry(times, no_retry=(), classifier=None, base_delay=0.5, max_delay=30, budget_attr=None):
+    """Retry decorated function on errors with exponential backoff
+
+    Return value of decorated function is returned.
+
+    :param times: max retries
+    :param no_retry: exception types never retried
+    :param classifier: function(exception) to classify errors, see RetryPolicy
+    :param base_delay: seconds before first retry
+    :param max_delay: max seconds between retries
+    :param budget_attr: attribute name of RetryBudget on first argument(usually self), None means no budget
+    """
+    policy = RetryPolicy(times, base_delay=base_delay, max_delay=max_delay, classifier=classifier,
+                         no_retry=no_retry)
+
     def decorator(func):
+        @functools.wraps(func)
         def wrapper(*args, **kwargs):
-            run_times = 0
-            succeed = False
-            while run_times <= times and succeed == False:
-                try:
-                    func(*args, **kwargs)
-                    succeed = True
-                except Exception as ex:
-                    if run_times < times:
-                        run_times += 1
-                    else:
-                        raise ex
+            budget = getattr(args[0], budget_attr, None) if budget_attr and args else None
+            return policy.call(func, args, kwargs, name=func.__qualname__, budget=budget)
 
         return wrapper
 
-    return decorator
\ No newline at end of file
+    return decorator
@@ -1,4 +1,4 @@
-from smtplib import SMTP_SSL as SMTP
+from smtplib import SMTP_SSL as SMTP, SMTPAuthenticationError, SMTPRecipientsRefused, SMTPSenderRefused
 from email.mime.text import MIMEText
 import logging
 import datetime
@@ -126,8 +126,13 @@ class MailManager():
             self.conn.set_debuglevel(True)
         self.conn.login(self.user, self.password)
 
-    @retry(3)
+    @retry(3, no_retry=(SMTPAuthenticationError, SMTPRecipientsRefused, SMTPSenderRefused), base_delay=2)
     def send_mail(self, subject, text, mail_to):
+        """Send a mail, errors of connection are retried with backoff
+
+        :return: True if sent
+        :raise: smtplib exceptions if failed at last
+        """
         msg = MIMEText(text, 'plain')
         msg['Subject'] = subject
         msg['To'] = ','.join(mail_to)
@@ -138,13 +143,9 @@ class MailManager():
         try:
             self.conn.sendmail(self.user, mail_to, msg.as_string())
             return True
-        except Exception as ex:
-            logger_server.exception(str(ex))
         finally:
             self.conn.close()
 
-        return False
-
     def send_success_mail(self, payload, tag, start_time, end_time):
         try:
             self.send_mail(subject=success_title.format(instance_name=_INSTANCE_NAME,
@@ -25,6 +25,7 @@ def serialize_status(status):
     """
     copy_status = copy.deepcopy(status)
     copy_status['task_running'] = repr(copy_status['task_running'])
+    copy_status['task_interrupted'] = repr(copy_status['task_interrupted'])
     for i in range(len(copy_status['task_waiting'])):
         copy_status['task_waiting'][i] = repr(copy_status['task_waiting'][i])
 
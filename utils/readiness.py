@@ -0,0 +1,111 @@
+__author__ = 'magus0219'
+import logging
+import time
+import urllib.request
+
+from utils.supervisor import supervisor_pool, SupervisorException
+
+logger_server = logging.getLogger("DeployServer.Readiness")
+
+# Supervisor states which will never become RUNNING without another start
+FAILED_STATES = ('FATAL', 'EXITED', 'STOPPED', 'UNKNOWN')
+
+
+class ReadinessException(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return self.msg
+
+
+def wait_until_ready(probes, timeout, initial_interval=0.2, max_interval=2.0, backoff=1.5, cancel_token=None):
+    """Poll probes until all of them are ready
+
+    Polling interval starts with initial_interval and grows by backoff up to max_interval, so a fast service
+    is found ready almost at once while a slow one is not polled too often.
+
+    :param probes: list of functions returning (ready, reason), may raise ReadinessException to fail at once
+    :param timeout: seconds to wait
+    :param initial_interval: seconds of first interval
+    :param max_interval: max seconds of interval
+    :param backoff: factor of interval growth
+    :param cancel_token: CancelToken to stop waiting
+    :return: seconds waited
+    :raise: ReadinessException if not ready before timeout or canceled
+    """
+    start_time = time.time()
+    interval = initial_interval
+    pending = list(probes)
+
+    while True:
+        reason = None
+        for one_probe in list(pending):
+            ready, reason = one_probe()
+            if ready:
+                pending.remove(one_probe)
+            else:
+                break
+
+        elapsed = time.time() - start_time
+        if not pending:
+            return elapsed
+        if elapsed + interval > timeout:
+            raise ReadinessException("Not ready after {timeout}s: {reason}".format(timeout=timeout, reason=reason))
+
+        if cancel_token:
+            if cancel_token.wait(interval):
+                raise ReadinessException("Canceled while waiting: {reason}".format(reason=reason))
+        else:
+            time.sleep(interval)
+        interval = min(interval * backoff, max_interval)
+
+
+def supervisor_probe(host, port, service, min_uptime):
+    """Probe of a supervisor process, ready if RUNNING for at least min_uptime seconds
+
+    :param host: hostname
+    :param port: port of supervisor
+    :param service: group:name
+    :param min_uptime: seconds process should be up
+    :return: probe function
+    """
+    def probe():
+        try:
+            with supervisor_pool.client(host, port) as client:
+                info = client.get_process_info(service)
+        except SupervisorException as ex:
+            return False, str(ex)
+
+        if info.statename in FAILED_STATES:
+            raise ReadinessException("{service} at {host} is {state}: {desc}".format(service=service,
+                                                                                    host=host,
+                                                                                    state=info.statename,
+                                                                                    desc=info.description))
+        if info.is_running and info.uptime >= min_uptime:
+            return True, None
+        return False, "{service} at {host} is {state}, uptime {uptime}s".format(service=service,
+                                                                               host=host,
+                                                                               state=info.statename,
+                                                                               uptime=info.uptime)
+
+    return probe
+
+
+def http_probe(url, request_timeout=5):
+    """Probe of a health url, ready if it responds 2xx or 3xx
+
+    :param url: health url
+    :param request_timeout: seconds of one request
+    :return: probe function
+    """
+    def probe():
+        try:
+            with urllib.request.urlopen(url, timeout=request_timeout) as response:
+                if 200 <= response.status < 400:
+                    return True, None
+                return False, "{url} responds {status}".format(url=url, status=response.status)
+        except Exception as ex:
+            return False, "{url} fails: {ex}".format(url=url, ex=str(ex))
+
+    return probe
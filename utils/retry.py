@@ -0,0 +1,258 @@
+__author__ = 'magus0219'
+import logging
+import random
+import re
+import threading
+import time
+
+logger_server = logging.getLogger("DeployServer.Retry")
+
+# Output of git, ssh and rsync which means retrying will never succeed
+PERMANENT_PATTERNS = [
+    r'Permission denied',
+    r'Authentication failed',
+    r'could not read Username',
+    r'Host key verification failed',
+    r'Repository not found',
+    r'does not appear to be a git repository',
+    r'unknown revision',
+    r"couldn't find remote ref",
+    r'not a git repository',
+    r'No such file or directory',
+    r'rsync error: syntax or usage error',
+    r'rsync error: some files/attrs were not transferred',
+    r'No space left on device',
+]
+# Output of git, ssh and rsync which means network or remote is broken for a while
+TRANSIENT_PATTERNS = [
+    r'Connection timed out',
+    r'Connection refused',
+    r'Connection reset',
+    r'Connection closed',
+    r'Could not resolve host',
+    r'Temporary failure in name resolution',
+    r'Network is unreachable',
+    r'early EOF',
+    r'The remote end hung up unexpectedly',
+    r'kex_exchange_identification',
+    r'Broken pipe',
+    r'rsync error: error in rsync protocol data stream',
+    r'rsync error: timeout',
+    r'rsync error: unexplained error',
+    r'Resource temporarily unavailable',
+]
+# Exit codes of rsync, see man rsync
+RSYNC_TRANSIENT_CODES = (10, 12, 24, 30, 35, 255)
+RSYNC_PERMANENT_CODES = (1, 2, 3, 4, 23)
+# ssh exits with 255 if connection fails
+SSH_ERROR_CODE = 255
+
+
+def classify_message(text):
+    """Classify error output of git, ssh or rsync
+
+    :param text: error output
+    :return: True if transient, False if permanent, None if unknown
+    """
+    text = text or ''
+    for pattern in PERMANENT_PATTERNS:
+        if re.search(pattern, text, re.IGNORECASE):
+            return False
+    for pattern in TRANSIENT_PATTERNS:
+        if re.search(pattern, text, re.IGNORECASE):
+            return True
+    return None
+
+
+def classify_command(args, return_code, output):
+    """Classify a failed git, ssh or rsync command by its output, then by its exit code
+
+    :param args: argument list of command
+    :param return_code: exit code
+    :param output: output text
+    :return: True if transient, False if permanent, None if unknown
+    """
+    decision = classify_message(output)
+    if decision is not None:
+        return decision
+
+    program = args[0] if args else None
+    if program == 'rsync':
+        if return_code in RSYNC_TRANSIENT_CODES:
+            return True
+        if return_code in RSYNC_PERMANENT_CODES:
+            return False
+    elif program == 'ssh' and return_code == SSH_ERROR_CODE:
+        return True
+    return None
+
+
+class RetryStats():
+    def __init__(self):
+        """Count of retries and seconds spent waiting to retry, in total and per function
+
+        """
+        self._lock = threading.Lock()
+        self.retries = 0
+        self.retry_seconds = 0
+        self.give_ups = 0
+        self.functions = {}  # name -> {'retries', 'retry_seconds', 'give_ups'}
+
+    def _get_function(self, name):
+        return self.functions.setdefault(name, {'retries': 0, 'retry_seconds': 0, 'give_ups': 0})
+
+    def record_retry(self, name, delay):
+        with self._lock:
+            self.retries += 1
+            self.retry_seconds += delay
+            function_stats = self._get_function(name)
+            function_stats['retries'] += 1
+            function_stats['retry_seconds'] += delay
+
+    def record_give_up(self, name):
+        with self._lock:
+            self.give_ups += 1
+            self._get_function(name)['give_ups'] += 1
+
+    def export(self):
+        with self._lock:
+            return {'retries': self.retries,
+                    'retry_seconds': round(self.retry_seconds, 3),
+                    'give_ups': self.give_ups,
+                    'functions': dict((name, dict(function_stats, retry_seconds=round(function_stats['retry_seconds'], 3)))
+                                      for name, function_stats in self.functions.items())}
+
+
+class RetryBudget(RetryStats):
+    def __init__(self, max_retries=None, max_seconds=None, cancel_token=None):
+        """Retries allowed for one deployment, shared by all of its steps and hosts
+
+        A flaky network should not turn one deployment into hours of retrying, once the budget is spent
+        errors are raised at once.
+
+        :param max_retries: max retries in total, None means no limit
+        :param max_seconds: max seconds waiting to retry in total, None means no limit
+        :param cancel_token: CancelToken of deployment, waiting stops once canceled
+        """
+        super().__init__()
+        self.max_retries = max_retries
+        self.max_seconds = max_seconds
+        self.cancel_token = cancel_token
+
+    def allow(self, delay):
+        with self._lock:
+            if self.max_retries is not None and self.retries >= self.max_retries:
+                return False
+            if self.max_seconds is not None and self.retry_seconds + delay > self.max_seconds:
+                return False
+            return True
+
+    def sleep(self, delay):
+        """Wait before retry
+
+        :param delay: seconds
+        :return: True if deployment is canceled
+        """
+        if self.cancel_token:
+            return self.cancel_token.wait(delay)
+        time.sleep(delay)
+        return False
+
+
+# Retries of the whole process
+retry_stats = RetryStats()
+
+
+class RetryPolicy():
+    def __init__(self, times=3, base_delay=0.5, max_delay=30, multiplier=2, jitter=0.5, classifier=None,
+                 no_retry=()):
+        """How to retry a function
+
+        Delay before n-th retry is base_delay * multiplier ** n, no more than max_delay, then reduced by a random
+        part of jitter so concurrent callers do not retry at the same time.
+
+        :param times: max retries, the function runs at most times + 1
+        :param base_delay: seconds before first retry
+        :param max_delay: max seconds between retries
+        :param multiplier: growth of delay
+        :param jitter: 0~1, max ratio of delay removed randomly
+        :param classifier: function(exception) returning True for transient errors, False for permanent ones,
+                           or a number of seconds to wait before retry, None means transient
+        :param no_retry: exception types never retried
+        """
+        self.times = times
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.jitter = jitter
+        self.classifier = classifier
+        self.no_retry = no_retry
+
+    def get_delay(self, retry_index):
+        delay = min(self.max_delay, self.base_delay * self.multiplier ** retry_index)
+        return delay * (1 - self.jitter * random.random())
+
+    def classify(self, ex):
+        """Decide if ex should be retried
+
+        :param ex: exception
+        :return: None if permanent, else seconds to wait or 0 to use backoff delay
+        """
+        if isinstance(ex, self.no_retry):
+            return None
+        if self.classifier is None:
+            return 0
+
+        decision = self.classifier(ex)
+        if decision is None or decision is True:
+            return 0
+        if decision is False:
+            return None
+        return decision
+
+    def call(self, func, args=(), kwargs=None, name=None, budget=None):
+        """Call func, retry on transient errors
+
+        :param func: function
+        :param args: positional arguments
+        :param kwargs: keyword arguments
+        :param name: name for logging and stats
+        :param budget: RetryBudget shared with other calls
+        :return: return value of func
+        """
+        kwargs = kwargs or {}
+        name = name or getattr(func, '__qualname__', repr(func))
+        retry_index = 0
+
+        while True:
+            try:
+                return func(*args, **kwargs)
+            except Exception as ex:
+                fixed_delay = self.classify(ex)
+                if fixed_delay is None:
+                    logger_server.info("{name} fails with permanent error: {ex}".format(name=name, ex=str(ex)))
+                    raise
+                if retry_index >= self.times:
+                    retry_stats.record_give_up(name)
+                    if budget:
+                        budget.record_give_up(name)
+                    raise
+
+                delay = fixed_delay or self.get_delay(retry_index)
+                if budget and not budget.allow(delay):
+                    logger_server.info("{name} fails and retry budget is spent: {ex}".format(name=name, ex=str(ex)))
+                    retry_stats.record_give_up(name)
+                    budget.record_give_up(name)
+                    raise
+
+                retry_index += 1
+                logger_server.info("{name} fails, retry {index}/{times} after {delay:.2f}s: {ex}".format(
+                    name=name, index=retry_index, times=self.times, delay=delay, ex=str(ex)))
+                retry_stats.record_retry(name, delay)
+                if budget:
+                    budget.record_retry(name, delay)
+                    if budget.sleep(delay):
+                        # canceled while waiting, no more tries
+                        raise
+                else:
+                    time.sleep(delay)
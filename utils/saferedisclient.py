@@ -12,6 +12,7 @@ import time
 import threading
 # import yaml
 from config import REDIS as _REDIS
+from utils.retry import RetryPolicy
 import redis
 
 class SafeRedisClient(object):
@@ -74,38 +75,44 @@ class SafeRedisClient(object):
             SafeRedisClient.REDIS_DB_CONN_POOLS[conn_pool_key] = redis_conn_pool
         self.redis_client = redis.StrictRedis(connection_pool=redis_conn_pool)
 
+    def _classify_error(self, error):
+        """“硬错误”返回重试前等待的秒数，其他错误返回 False 表示不重试；
+
+        :param error: redis 操作抛出的异常；
+        :return: 等待秒数或 False；
+        """
+        if not isinstance(error, (redis.ConnectionError, redis.ResponseError, redis.TimeoutError)):
+            return False
+        error_msg = str(error).lower().strip()
+        if error_msg.startswith('max number of clients'):  # Redis server too many clients
+            return self.error_server_full_wait_sec
+        elif error_msg.startswith('error 111 '):    # Connection refused, redis is dead, waiting for restart
+            return self.error_server_port_dead_wait_sec
+        elif error_msg.startswith('error -2 '):     # Host name or service not known
+            return self.error_host_unknown_wait_sec
+        return False
+
     def __getattr__(self, attr_name):
-        def func(*args, **kwargs):
-            result = None
-            exec_finish = False
-            hard_error_retry = 0
-            while not exec_finish:
+        def execute(*args, **kwargs):
+            while True:
+                redis_command = getattr(self.redis_client, attr_name)
                 try:
-                    redis_command = getattr(self.redis_client, attr_name)
-                    result = redis_command(*args, **kwargs)
-                    exec_finish = True
-                except AttributeError:
-                    raise
-                except (redis.ConnectionError, redis.ResponseError, redis.TimeoutError) as error:
-                    error_msg = str(error).lower().strip()
-                    if error_msg.startswith('too many connections'):    # Redis connection pool full (soft error)
-                        time.sleep(self.error_pool_full_wait_sec)
-                    elif error_msg.startswith('max number of clients'):  # Redis server too many clients
-                        time.sleep(self.error_server_full_wait_sec)
-                        hard_error_retry += 1
-                    elif error_msg.startswith('error 111 '):    # Connection refused, redis is dead, waiting for restart
-                        time.sleep(self.error_server_port_dead_wait_sec)
-                        hard_error_retry += 1
-                    elif error_msg.startswith('error -2 '):     # Host name or service not known
-                        time.sleep(self.error_host_unknown_wait_sec)
-                        hard_error_retry += 1
-                    else:
+                    return redis_command(*args, **kwargs)
+                except redis.ConnectionError as error:
+                    # Redis connection pool full (soft error), not counted as retry
+                    if not str(error).lower().strip().startswith('too many connections'):
                         raise
-                except Exception:
+                    time.sleep(self.error_pool_full_wait_sec)
+
+        def func(*args, **kwargs):
+            # error_hard_retry_limit counts hard errors, the last one is not retried
+            policy = RetryPolicy(max(0, self.error_hard_retry_limit - 1), classifier=self._classify_error)
+            try:
+                return policy.call(execute, args, kwargs, name='redis.' + attr_name)
+            except Exception as error:
+                if self._classify_error(error) is False:
                     raise
-                if hard_error_retry >= self.error_hard_retry_limit:
-                    exec_finish = True  # hard error limit reached, force return None
-            return result
+                return None  # hard error limit reached, force return None
         return func
 
 redis_manager = SafeRedisClient(_REDIS['HOST'],_REDIS['PORT'],_REDIS['DBID'])
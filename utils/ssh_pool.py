@@ -0,0 +1,207 @@
+__author__ = 'magus0219'
+import atexit
+import contextlib
+import hashlib
+import logging
+import os
+import subprocess
+import threading
+import time
+from config import SERVER_CONFIG as _SERVER_CFG
+
+logger_server = logging.getLogger("DeployServer.SSHConnectionPool")
+
+
+class SSHConnectionPool():
+    def __init__(self, control_dir, ssh_command='ssh', idle_timeout=300, check_interval=30, connect_timeout=10,
+                 enable=True):
+        """Pool of ssh master connections, one for every destination like deploy@host
+
+        Commands reuse the master connection through its control socket(ssh -o ControlPath=...), so only the
+        first command to a host pays for handshake and auth. Masters are health checked before reuse at most
+        every check_interval seconds, restarted if dead and closed after idle for idle_timeout seconds. Commands
+        should run inside session(), a master with commands running is never idle.
+
+        :param control_dir: directory of control sockets
+        :param ssh_command: ssh executable, could be a fake ssh wrapper for testing
+        :param idle_timeout: seconds a master can stay unused
+        :param check_interval: min seconds between two health checks of a master
+        :param connect_timeout: seconds to wait for a master to be ready
+        :param enable: False to run plain ssh without multiplexing
+        """
+        self.control_dir = control_dir
+        self.ssh_command = ssh_command
+        self.idle_timeout = idle_timeout
+        self.check_interval = check_interval
+        self.connect_timeout = connect_timeout
+        self.enable = enable
+        # destination -> {'lock', 'control_path', 'process', 'last_used', 'last_check', 'sessions'}
+        self._masters = {}
+        self._lock = threading.Lock()
+
+    def _control_path(self, destination):
+        # unix socket path is limited about 100 chars, so hash destination
+        return os.path.join(self.control_dir, hashlib.sha1(destination.encode('utf8')).hexdigest()[:16])
+
+    def _control_options(self, control_path):
+        return ['-o', 'ControlPath={path}'.format(path=control_path), '-o', 'ControlMaster=no']
+
+    def _get_master(self, destination):
+        with self._lock:
+            if destination not in self._masters:
+                self._masters[destination] = {'lock': threading.Lock(),
+                                              'control_path': self._control_path(destination),
+                                              'process': None,
+                                              'last_used': 0,
+                                              'last_check': 0,
+                                              'sessions': 0}
+            return self._masters[destination]
+
+    def _check_master(self, destination, master):
+        if master['process'] is None or master['process'].poll() is not None:
+            return False
+
+        command = [self.ssh_command, '-O', 'check'] + self._control_options(master['control_path']) + [destination]
+        try:
+            return subprocess.call(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                   stderr=subprocess.DEVNULL, timeout=self.connect_timeout) == 0
+        except subprocess.TimeoutExpired:
+            return False
+
+    def _start_master(self, destination, master):
+        os.makedirs(self.control_dir, exist_ok=True)
+        if os.path.exists(master['control_path']):
+            os.remove(master['control_path'])
+
+        command = [self.ssh_command, '-M', '-N',
+                   '-o', 'ControlPath={path}'.format(path=master['control_path']),
+                   '-o', 'ControlPersist=no',
+                   '-o', 'BatchMode=yes',
+                   '-o', 'ServerAliveInterval=30',
+                   '-o', 'ConnectTimeout={timeout}'.format(timeout=self.connect_timeout),
+                   destination]
+
+        logger_server.info("Start ssh master to {dest} [CMD:{cmd}]...".format(dest=destination,
+                                                                             cmd=' '.join(command)))
+        master['process'] = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                             stderr=subprocess.DEVNULL)
+
+        deadline = time.time() + self.connect_timeout
+        while time.time() < deadline:
+            if master['process'].poll() is not None:
+                break
+            if os.path.exists(master['control_path']):
+                return True
+            time.sleep(0.05)
+
+        logger_server.info("Fail to start ssh master to {dest}".format(dest=destination))
+        self._stop_master(destination, master)
+        return False
+
+    def _stop_master(self, destination, master):
+        process = master['process']
+        master['process'] = None
+        if process is None:
+            return
+
+        if process.poll() is None:
+            command = [self.ssh_command, '-O', 'exit'] + self._control_options(master['control_path']) + [destination]
+            try:
+                subprocess.call(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                stderr=subprocess.DEVNULL, timeout=self.connect_timeout)
+                process.wait(timeout=self.connect_timeout)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+
+    def get_options(self, destination):
+        """Get ssh options to reuse master connection of destination
+
+        Master is started or restarted if needed, plain ssh is used if master can not be started.
+
+        :param destination: user@host
+        :return: list of ssh options
+        """
+        if not self.enable:
+            return []
+
+        self.evict_idle(exclude=destination)
+
+        master = self._get_master(destination)
+        with master['lock']:
+            now = time.time()
+            if now - master['last_check'] >= self.check_interval or master['process'] is None:
+                if not self._check_master(destination, master):
+                    self._stop_master(destination, master)
+                    if not self._start_master(destination, master):
+                        return []
+                master['last_check'] = now
+            master['last_used'] = now
+
+            return self._control_options(master['control_path'])
+
+    def get_ssh_command(self, destination):
+        """Get ssh command string reusing master connection, used as ssh of a shell command or rsync -e
+
+        :param destination: user@host
+        :return: ssh command string
+        """
+        return ' '.join([self.ssh_command] + self.get_options(destination))
+
+    @contextlib.contextmanager
+    def session(self, command):
+        """Mark masters used by command busy while it runs, it is used when it finishes
+
+        Usage:
+            with ssh_pool.session(command):
+                run command
+
+        :param command: command string, masters are found by their control paths in it
+        """
+        with self._lock:
+            masters = [one_master for one_master in self._masters.values()
+                       if one_master['control_path'] in command]
+            for one_master in masters:
+                one_master['sessions'] += 1
+        try:
+            yield
+        finally:
+            now = time.time()
+            with self._lock:
+                for one_master in masters:
+                    one_master['sessions'] -= 1
+                    one_master['last_used'] = now
+
+    def _is_idle(self, master, now):
+        with self._lock:
+            return master['process'] and master['sessions'] == 0 and now - master['last_used'] > self.idle_timeout
+
+    def evict_idle(self, exclude=None):
+        """Close masters idle for more than idle_timeout seconds, masters with commands running are never idle
+
+        :param exclude: destination not to close
+        :return:
+        """
+        now = time.time()
+        with self._lock:
+            masters = list(self._masters.items())
+        for destination, master in masters:
+            if destination != exclude and self._is_idle(master, now):
+                with master['lock']:
+                    if self._is_idle(master, now):
+                        logger_server.info("Close idle ssh master to {dest}".format(dest=destination))
+                        self._stop_master(destination, master)
+
+    def close_all(self):
+        with self._lock:
+            masters = list(self._masters.items())
+        for destination, master in masters:
+            with master['lock']:
+                self._stop_master(destination, master)
+
+
+ssh_pool = SSHConnectionPool(_SERVER_CFG.get('SSH_CONTROL_DIR', '/tmp/niner_ssh'),
+                             ssh_command=_SERVER_CFG.get('SSH_COMMAND', 'ssh'),
+                             idle_timeout=_SERVER_CFG.get('SSH_IDLE_TIMEOUT', 300),
+                             enable=_SERVER_CFG.get('SSH_MULTIPLEXING', True))
+atexit.register(ssh_pool.close_all)
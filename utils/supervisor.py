@@ -0,0 +1,234 @@
+__author__ = 'magus0219'
+import contextlib
+import http.client
+import logging
+import threading
+import xmlrpc.client
+
+logger_server = logging.getLogger("DeployServer.Supervisor")
+
+# Fault codes of supervisor XML-RPC interface
+FAULT_BAD_ARGUMENTS = 3
+FAULT_BAD_NAME = 10
+FAULT_NO_FILE = 20
+FAULT_NOT_EXECUTABLE = 21
+FAULT_ABNORMAL_TERMINATION = 40
+FAULT_SPAWN_ERROR = 50
+FAULT_ALREADY_STARTED = 60
+FAULT_NOT_RUNNING = 70
+# Faults which another try will never fix
+PERMANENT_FAULTS = (FAULT_BAD_ARGUMENTS, FAULT_BAD_NAME, FAULT_NO_FILE, FAULT_NOT_EXECUTABLE)
+
+
+def is_permanent_fault(code):
+    """Check if a fault code means a configuration error, None means a connection error which is transient
+
+    :param code: fault code of SupervisorException
+    :return: True if permanent
+    """
+    return code in PERMANENT_FAULTS
+
+
+class SupervisorException(Exception):
+    def __init__(self, msg, code=None):
+        self.msg = msg
+        self.code = code
+
+    def __str__(self):
+        return self.msg
+
+
+class ProcessInfo():
+    def __init__(self, info):
+        """Structured result of supervisor.getProcessInfo
+
+        :param info: dict returned by supervisor
+        """
+        self.name = info['name']
+        self.group = info['group']
+        self.state = info['state']
+        self.statename = info['statename']
+        self.pid = info['pid']
+        self.start = info['start']
+        self.now = info['now']
+        self.description = info['description']
+        self.exitstatus = info['exitstatus']
+        self.spawnerr = info['spawnerr']
+
+    @property
+    def full_name(self):
+        return "{group}:{name}".format(group=self.group, name=self.name)
+
+    @property
+    def is_running(self):
+        return self.statename == 'RUNNING'
+
+    @property
+    def uptime(self):
+        """Seconds since process started, 0 if not running"""
+        if not self.is_running:
+            return 0
+        return max(0, self.now - self.start)
+
+    def __repr__(self):
+        return "<ProcessInfo {name} {state}>".format(name=self.full_name, state=self.statename)
+
+
+class TimeoutTransport(xmlrpc.client.Transport):
+    def __init__(self, timeout):
+        """Transport with socket timeout, http connection is kept alive between requests"""
+        super().__init__()
+        self.timeout = timeout
+
+    def make_connection(self, host):
+        connection = super().make_connection(host)
+        connection.timeout = self.timeout
+        return connection
+
+
+class SupervisorClient():
+    def __init__(self, host, port=9001, timeout=60):
+        """XML-RPC client of supervisord at host:port
+
+        One client holds one keep-alive http connection, it should not be used by two threads at the same time,
+        use SupervisorPool to share clients.
+
+        :param host: hostname
+        :param port: port of supervisor inet_http_server
+        :param timeout: socket timeout in seconds
+        """
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.url = "http://{host}:{port}/RPC2".format(host=host, port=port)
+        self._proxy = None
+
+    def _call(self, method, *args):
+        if self._proxy is None:
+            self._proxy = xmlrpc.client.ServerProxy(self.url, transport=TimeoutTransport(self.timeout))
+        try:
+            return getattr(self._proxy.supervisor, method)(*args)
+        except xmlrpc.client.Fault as fault:
+            raise SupervisorException("{method}{args} at {host}: {msg}".format(method=method,
+                                                                                args=args,
+                                                                                host=self.host,
+                                                                                msg=fault.faultString),
+                                      fault.faultCode)
+        except (OSError, http.client.HTTPException, xmlrpc.client.ProtocolError) as ex:
+            # drop broken connection, next call reconnects
+            self.close()
+            raise SupervisorException("{method}{args} at {host}: {msg}".format(method=method,
+                                                                                args=args,
+                                                                                host=self.host,
+                                                                                msg=str(ex)))
+
+    def get_all_process_info(self):
+        """Get info of all processes in one call
+
+        :return: {group:name: ProcessInfo}
+        """
+        infos = [ProcessInfo(one_info) for one_info in self._call('getAllProcessInfo')]
+        return dict((one_info.full_name, one_info) for one_info in infos)
+
+    def get_process_info(self, name):
+        """Get info of a process
+
+        :param name: group:name
+        :return: ProcessInfo
+        """
+        return ProcessInfo(self._call('getProcessInfo', name))
+
+    def start_process(self, name, wait=True):
+        return self._call('startProcess', name, wait)
+
+    def stop_process(self, name, wait=True):
+        """Stop a process, ignore it if not running
+
+        :param name: group:name
+        :param wait: wait until process stopped
+        :return:
+        """
+        try:
+            return self._call('stopProcess', name, wait)
+        except SupervisorException as ex:
+            if ex.code != FAULT_NOT_RUNNING:
+                raise ex
+            return True
+
+    def start_process_group(self, group, wait=True):
+        return self._call('startProcessGroup', group, wait)
+
+    def stop_process_group(self, group, wait=True):
+        return self._call('stopProcessGroup', group, wait)
+
+    def restart_process(self, name, wait=True):
+        """Restart a process like supervisorctl restart: stop then start
+
+        :param name: group:name
+        :param wait: wait until process started, see startsecs of supervisor
+        :return:
+        """
+        self.stop_process(name)
+        return self.start_process(name, wait)
+
+    def close(self):
+        if self._proxy is not None:
+            try:
+                self._proxy('close')()
+            except Exception:
+                pass
+            self._proxy = None
+
+
+class SupervisorPool():
+    def __init__(self, max_idle_per_host=4, timeout=60):
+        """Pool of supervisor clients, idle clients of every host are kept for reuse
+
+        :param max_idle_per_host: max idle clients kept for one host
+        :param timeout: socket timeout of clients
+        """
+        self.max_idle_per_host = max_idle_per_host
+        self.timeout = timeout
+        self._idle = {}  # (host, port) -> [SupervisorClient]
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def client(self, host, port=9001):
+        """Borrow a client of host:port
+
+        Usage:
+            with supervisor_pool.client(host) as client:
+                client.restart_process(service)
+        """
+        key = (host, port)
+        with self._lock:
+            idle_clients = self._idle.get(key)
+            one_client = idle_clients.pop() if idle_clients else None
+        if one_client is None:
+            one_client = SupervisorClient(host, port, self.timeout)
+
+        try:
+            yield one_client
+        except Exception:
+            # state of connection is unknown
+            one_client.close()
+            raise
+        else:
+            with self._lock:
+                idle_clients = self._idle.setdefault(key, [])
+                if len(idle_clients) < self.max_idle_per_host:
+                    idle_clients.append(one_client)
+                    one_client = None
+            if one_client is not None:
+                one_client.close()
+
+    def close_all(self):
+        with self._lock:
+            idle = self._idle
+            self._idle = {}
+        for clients in idle.values():
+            for one_client in clients:
+                one_client.close()
+
+
+supervisor_pool = SupervisorPool()